@@ -0,0 +1,216 @@
+import json
+import random
+import sys
+
+# The kinds of region a generated function is built from.
+SHAPES = ["straight", "diamond", "loop", "switch", "irreducible"]
+
+# Registers generated statements read and write.
+REGISTERS = ["R0", "R1", "R2", "R3", "R4", "R5", "R6", "R7", "R8"]
+# Registers holding the loop counter or switch selector at each depth of
+# nesting. Only straight regions are generated at MAX_DEPTH, so each depth
+# with a counter has its own register.
+COUNTERS = ["R9", "R10", "R11", "R12"]
+BINARY_OPS = ["ADD", "SUB", "RSB", "MUL", "AND", "ORR", "EOR", "BIC"]
+SHIFT_KINDS = ["LSL", "LSR", "ASR", "ROR"]
+
+# Deepest nesting of loops, diamonds and switches within one another.
+MAX_DEPTH = 4
+# Most cases in a switch fan.
+MAX_CASES = 8
+
+"""
+Generates a random function of about `size` blocks, in the single function
+format, built from regions of the kinds in `shapes`:
+
+    straight     a block of 10 to 40 statements
+    diamond      an if-then-else, each side a nested region
+    loop         a counted loop around a nested region
+    switch       a chain of comparisons fanning out to 2 to MAX_CASES cases
+    irreducible  a counted loop of two blocks which may each be entered first
+
+Regions are nested up to MAX_DEPTH deep, so every loop finishes and a
+function always returns. The same `seed` always generates the
+same function. Statements use the ARM subset the optimiser handles, including
+loads and stores relative to SP, and the function returns R0.
+"""
+def generate_function(size, seed=0, shapes=SHAPES):
+    builder = _Builder(size, random.Random(seed), shapes)
+    entry = builder.new_block()
+    builder.block(entry)["code"].extend(builder.statements(3))
+    tail = builder.sequence(entry, 0)
+    builder.block(tail)["code"].append({"op": "return", "src1": "R0"})
+    return {"starting_block": [entry], "blocks": builder.blocks}
+
+class _Builder(object):
+    def __init__(self, size, rng, shapes):
+        self.size = size
+        self.rng = rng
+        self.shapes = shapes
+        self.blocks = []
+        self.index = {}
+
+    def block(self, name):
+        return self.blocks[self.index[name]]
+
+    def new_block(self):
+        name = "b%d" % (len(self.blocks) + 1)
+        self.index[name] = len(self.blocks)
+        self.blocks.append({"name": name, "code": [], "next_block": []})
+        return name
+
+    """
+    Returns a new block following `block`.
+    """
+    def follow(self, block):
+        successor = self.new_block()
+        self.block(block)["next_block"] = [successor]
+        return successor
+
+    def remaining(self):
+        return self.size - len(self.blocks)
+
+    """
+    Adds regions after the block `head` until `size` blocks have been
+    generated, or, below the top level, until a few regions have been added.
+    Returns the block the last region ends in.
+    """
+    def sequence(self, head, depth):
+        count = self.rng.randint(1, 3)
+        while self.remaining() > 0 and (depth == 0 or count > 0):
+            head = self.region(head, depth)
+            count -= 1
+        return head
+
+    """
+    Adds a region of a random shape after the block `head`, returning the
+    block it ends in.
+    """
+    def region(self, head, depth):
+        shapes = self.shapes
+        if depth >= MAX_DEPTH:
+            shapes = ["straight"]
+        elif self.remaining() < 4:
+            shapes = [s for s in shapes if s in ("straight", "irreducible")] or ["straight"]
+        return getattr(self, "_" + self.rng.choice(shapes))(head, depth)
+
+    def _straight(self, head, depth):
+        block = self.follow(head)
+        self.block(block)["code"].extend(self.statements(self.rng.randint(10, 40)))
+        return block
+
+    def _diamond(self, head, depth):
+        self.branch(head, self.rng.choice(REGISTERS), self.operand())
+        taken = self.new_block()
+        fallthrough = self.new_block()
+        self.block(head)["next_block"] = [taken, fallthrough]
+        join = self.new_block()
+        for side in [taken, fallthrough]:
+            self.block(side)["code"].extend(self.statements(self.rng.randint(1, 4)))
+            self.block(self.sequence(side, depth + 1))["next_block"] = [join]
+        return join
+
+    def _loop(self, head, depth):
+        counter = COUNTERS[depth % len(COUNTERS)]
+        self.block(head)["code"].append({"op": "MOV", "dest": counter, "src1": "#0"})
+        header = self.follow(head)
+        self.branch(header, counter, "#%d" % self.rng.randint(2, 100), "BGE")
+        exit = self.new_block()
+        body = self.new_block()
+        self.block(header)["next_block"] = [exit, body]
+        self.block(body)["code"].extend(self.statements(self.rng.randint(1, 6)))
+        latch = self.sequence(body, depth + 1)
+        self.block(latch)["code"].extend([
+            {"op": "ADD", "dest": counter, "src1": counter, "src2": "#1"},
+            {"op": "B"}])
+        self.block(latch)["next_block"] = [header]
+        return exit
+
+    def _switch(self, head, depth):
+        selector = self.rng.choice(REGISTERS)
+        cases = self.rng.randint(2, MAX_CASES)
+        index = COUNTERS[depth % len(COUNTERS)]
+        self.block(head)["code"].append(
+            {"op": "AND", "dest": index, "src1": selector, "src2": "#%d" % (cases - 1)})
+        join = self.new_block()
+        test = head
+        for case in range(cases):
+            if self.remaining() <= 0:
+                break
+            self.branch(test, index, "#%d" % case, "BEQ")
+            target = self.new_block()
+            self.block(target)["code"].extend(self.statements(self.rng.randint(1, 4)))
+            following = self.new_block()
+            self.block(test)["next_block"] = [target, following]
+            end = self.sequence(target, depth + 1) if self.rng.random() < 0.3 else target
+            self.block(end)["code"].append({"op": "B"})
+            self.block(end)["next_block"] = [join]
+            test = following
+        self.block(test)["next_block"] = [join]
+        return join
+
+    def _irreducible(self, head, depth):
+        counter = COUNTERS[depth % len(COUNTERS)]
+        limit = "#%d" % self.rng.randint(2, 20)
+        self.block(head)["code"].append({"op": "MOV", "dest": counter, "src1": "#0"})
+        self.branch(head, self.rng.choice(REGISTERS), self.operand())
+        first = self.new_block()
+        second = self.new_block()
+        exit = self.new_block()
+        self.block(head)["next_block"] = [first, second]
+        for block, other in [(first, second), (second, first)]:
+            self.block(block)["code"].extend(self.statements(self.rng.randint(1, 6)))
+            self.block(block)["code"].append(
+                {"op": "ADD", "dest": counter, "src1": counter, "src2": "#1"})
+            self.branch(block, counter, limit, "BLT")
+            self.block(block)["code"].append({"op": "B"})
+            self.block(block)["next_block"] = [other, exit]
+        return exit
+
+    """
+    Ends `block` with a comparison of `value` with `operand` and a
+    conditional branch.
+    """
+    def branch(self, block, value, operand, op=None):
+        if op is None:
+            op = "B" + self.rng.choice(["EQ", "NE", "LT", "GE", "GT", "LE"])
+        self.block(block)["code"].extend([
+            {"op": "CMP", "src1": value, "src2": operand},
+            {"op": op}])
+
+    def statements(self, count):
+        return [self.statement() for _ in range(count)]
+
+    def statement(self):
+        choice = self.rng.random()
+        dest = self.rng.choice(REGISTERS)
+        if choice < 0.1:
+            return {"op": "LDR", "dest": dest, "src1": "SP",
+                    "src2": "#%d" % (4 * self.rng.randint(0, 15))}
+        if choice < 0.2:
+            return {"op": "STR", "src1": self.rng.choice(REGISTERS), "src2": "SP",
+                    "src3": "#%d" % (4 * self.rng.randint(0, 15))}
+        if choice < 0.35:
+            return {"op": "MOV", "dest": dest, "src1": self.operand()}
+        statement = {"op": self.rng.choice(BINARY_OPS), "dest": dest,
+                     "src1": self.rng.choice(REGISTERS), "src2": self.operand()}
+        if statement["op"] == "MUL":
+            statement["src2"] = self.rng.choice(REGISTERS)
+        elif self.rng.random() < 0.1 and statement["src2"].startswith("R"):
+            statement["shift"] = "%s #%d" % (self.rng.choice(SHIFT_KINDS),
+                                             self.rng.randint(1, 31))
+        return statement
+
+    def operand(self):
+        if self.rng.random() < 0.4:
+            return "#%d" % self.rng.randint(0, 255)
+        return self.rng.choice(REGISTERS)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    print json.dumps(generate_function(size, seed), indent=4)
+
+if __name__ == "__main__":
+    main()
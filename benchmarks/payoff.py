@@ -0,0 +1,107 @@
+import copy
+import os
+import random
+import sys
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cs4071_ssa_optimiser.interpreter import compare, InterpreterError, MAX_STEPS
+from cs4071_ssa_optimiser.pipeline import optimise
+from generator import generate_function, REGISTERS
+
+# Numbers of blocks in the functions generated by default.
+SIZES = [10, 30, 100]
+# Number of functions generated for each size.
+SEEDS = 3
+# Number of sets of inputs each function is run with.
+RUNS = 3
+# Largest magnitude of a generated input.
+INPUT_RANGE = 1000
+
+"""
+Returns `count` sets of inputs for the registers of generated functions,
+the same for the same `seed`.
+"""
+def random_inputs(seed, count=RUNS):
+    rng = random.Random(seed)
+    return [dict((r, rng.randint(-INPUT_RANGE, INPUT_RANGE)) for r in REGISTERS)
+            for _ in range(count)]
+
+"""
+Optimises `seeds` generated functions of each size in `sizes` and runs each
+before and after with `runs` sets of inputs. Returns a list of
+(size, seed, before, after, differences) for each function, where `before` and
+`after` are the total instructions executed over the runs, and `differences`
+lists each run where the optimised function computed something else. Runs in
+which the original function does not finish within `max_steps` statements
+are left out, and a function none of whose runs finish is given as None for
+both counts.
+"""
+def run(sizes=SIZES, seeds=SEEDS, runs=RUNS, max_steps=MAX_STEPS, progress=None):
+    results = []
+    for size in sizes:
+        for seed in range(seeds):
+            function = generate_function(size, seed)
+            optimised = optimise(copy.deepcopy(function))
+            before, after, differences = None, None, []
+            for inputs in random_inputs(seed, runs):
+                try:
+                    old, new, found = compare(function, optimised, inputs, max_steps=max_steps)
+                except InterpreterError:
+                    continue
+                before = (before or 0) + old.instructions
+                if new is not None:
+                    after = (after or 0) + new.instructions
+                differences.extend("{}: {}".format(inputs, d) for d in found)
+            results.append((size, seed, before, after, differences))
+            if progress is not None:
+                progress(*results[-1])
+    return results
+
+def print_results(results):
+    print "{:>7} {:>5} {:>12} {:>12} {:>8}".format("blocks", "seed", "before", "after", "ratio")
+    for size, seed, before, after, differences in results:
+        if before is None:
+            print "{:>7} {:>5} {:>12}".format(size, seed, "no run finished")
+            continue
+        ratio = "{:8.3f}".format(float(after) / before) if after is not None and before else ""
+        print "{:>7} {:>5} {:>12} {:>12} {:>8}".format(
+            size, seed, before, after if after is not None else "-", ratio)
+    totals = [(b, a) for _, _, b, a, d in results if b is not None and a is not None and not len(d)]
+    if len(totals):
+        before, after = sum(b for b, _ in totals), sum(a for _, a in totals)
+        print "Executed {} instructions before optimising and {} after ({:.1%} fewer)".format(
+            before, after, 1 - float(after) / before if before else 0)
+
+
+def main():
+    parser = ArgumentParser(description="Check that optimised generated functions compute "
+                                        "the same results, and count the instructions saved.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="Comma separated numbers of blocks to generate functions with")
+    parser.add_argument("--seeds", type=int, default=SEEDS,
+                        help="Number of functions generated for each size")
+    parser.add_argument("--runs", type=int, default=RUNS,
+                        help="Number of sets of inputs each function is run with")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS,
+                        help="Statements a run may execute before it is abandoned")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Report each function as it finishes")
+    args = parser.parse_args()
+
+    progress = None
+    if args.verbose:
+        progress = lambda size, seed, before, after, differences: sys.stderr.write(
+            "{} blocks, seed {}: {} -> {}\n".format(size, seed, before, after))
+    results = run([int(s) for s in args.sizes.split(",")], args.seeds, args.runs,
+                  args.max_steps, progress)
+    print_results(results)
+    failures = [(size, seed, d) for size, seed, _, _, differences in results for d in differences]
+    for size, seed, difference in failures:
+        print "MISMATCH: {} blocks, seed {}, {}".format(size, seed, difference)
+    sys.exit(1 if len(failures) else 0)
+
+if __name__ == "__main__":
+    main()
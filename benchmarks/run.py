@@ -0,0 +1,198 @@
+import json
+import os
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cs4071_ssa_optimiser.pipeline import load_pass, PIPELINE
+from cs4071_ssa_optimiser.util import build_graph
+from generator import generate_function
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Numbers of blocks in the functions generated by default. The passes are
+# quadratic or worse in places, so larger sizes take minutes each.
+SIZES = [10, 30, 100]
+# Number of functions generated for each size.
+SEEDS = 3
+# Longest time, in seconds, allowed for every stage on one function.
+TIMEOUT = 600
+
+# Graph analyses timed on the control flow graph of each function, before the
+# passes are run.
+ANALYSES = ["dominators", "dominance_frontiers", "control_dependence_graph"]
+
+# A stage is only reported as a regression when it is both this fraction
+# slower than the baseline and slower by at least MIN_SECONDS, so that noise in
+# timing very short stages is ignored. Likewise for memory.
+TOLERANCE = 0.25
+MIN_SECONDS = 0.02
+MIN_MEMORY_KB = 1024
+
+"""
+Returns the name of each stage timed on a function: the graph analyses, then
+each pass of PIPELINE, numbered where a pass is run more than once.
+"""
+def stages():
+    names = list(ANALYSES)
+    for name in PIPELINE:
+        count = len([n for n in names if n == name or n.startswith(name + "#")])
+        names.append(name if not count else "{}#{}".format(name, count + 1))
+    return names
+
+"""
+Runs each stage on a function of `size` blocks generated from `seed`, putting
+(stage, seconds, memory) on `queue` as each finishes and None once all are
+done. `memory` is the growth in peak resident memory, in KB, during the stage,
+which is 0 for a stage using less memory than an earlier one. Runs in a child
+process, so the peak is not affected by other functions.
+"""
+def measure(size, seed, queue):
+    function = generate_function(size, seed)
+    for analysis in ANALYSES:
+        graph = build_graph(function)
+        graph.set_root(function["starting_block"][0])
+        queue.put(_timed(analysis, getattr(graph, analysis)))
+    for stage, name in zip(stages()[len(ANALYSES):], PIPELINE):
+        optimisation = load_pass(name)
+        queue.put(_timed(stage, lambda: optimisation(function)))
+    queue.put(None)
+
+def _timed(stage, run):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    run()
+    elapsed = time.time() - start
+    return stage, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak
+
+"""
+Measures every stage on `seeds` functions of each size in `sizes`. Returns a
+dictionary mapping each size, as a string, to a dictionary mapping each stage
+to its mean "seconds" and largest "memory_kb" over the functions. A stage
+which did not finish within `timeout` seconds of the first stage starting is
+given as "timeout", and the stages after it are left out.
+"""
+def run(sizes=SIZES, seeds=SEEDS, timeout=TIMEOUT, progress=None):
+    results = {}
+    for size in sizes:
+        samples = {}
+        for seed in range(seeds):
+            for stage, seconds, memory in _run_function(size, seed, timeout):
+                samples.setdefault(stage, []).append((seconds, memory))
+                if progress is not None:
+                    progress(size, seed, stage, seconds, memory)
+        results[str(size)] = dict((stage, _summarise(samples[stage], seeds))
+                                  for stage in samples)
+    return results
+
+def _run_function(size, seed, timeout):
+    queue = Queue()
+    child = Process(target=measure, args=(size, seed, queue))
+    child.start()
+    deadline = time.time() + timeout
+    try:
+        for stage in stages():
+            try:
+                result = queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                yield stage, None, None
+                return
+            if result is None:
+                return
+            yield result
+    finally:
+        child.terminate()
+        child.join()
+
+def _summarise(samples, seeds):
+    if len(samples) < seeds or any(seconds is None for seconds, _ in samples):
+        return "timeout"
+    return {"seconds": sum(seconds for seconds, _ in samples) / len(samples),
+            "memory_kb": max(memory for _, memory in samples)}
+
+"""
+Returns a list of (size, stage, description) for each stage in `results`
+slower or using more memory than in `baseline` beyond the tolerances.
+"""
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for size in sorted(results, key=int):
+        for stage in stages():
+            new, old = results[size].get(stage), baseline.get(size, {}).get(stage)
+            if new is None or old is None or old == "timeout":
+                continue
+            if new == "timeout":
+                regressions.append((size, stage, "timed out"))
+                continue
+            if (new["seconds"] > old["seconds"] * (1 + tolerance) and
+                    new["seconds"] - old["seconds"] >= MIN_SECONDS):
+                regressions.append((size, stage, "{:.4f}s, was {:.4f}s".format(
+                    new["seconds"], old["seconds"])))
+            if (new["memory_kb"] > old["memory_kb"] * (1 + tolerance) and
+                    new["memory_kb"] - old["memory_kb"] >= MIN_MEMORY_KB):
+                regressions.append((size, stage, "{}KB, was {}KB".format(
+                    new["memory_kb"], old["memory_kb"])))
+    return regressions
+
+def print_results(results):
+    print "{:>7}  {:40} {:>10} {:>10}".format("blocks", "stage", "seconds", "memory KB")
+    for size in sorted(results, key=int):
+        for stage in stages():
+            result = results[size].get(stage)
+            if result == "timeout":
+                print "{:>7}  {:40} {:>10}".format(size, stage, "timeout")
+            elif result is not None:
+                print "{:>7}  {:40} {:10.4f} {:10d}".format(
+                    size, stage, result["seconds"], result["memory_kb"])
+
+
+def main():
+    parser = ArgumentParser(description="Time each pass and analysis on generated functions.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="Comma separated numbers of blocks to generate functions with")
+    parser.add_argument("--seeds", type=int, default=SEEDS,
+                        help="Number of functions generated for each size")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="Seconds allowed for all the stages on one function")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="Baseline results to compare against")
+    parser.add_argument("--update", action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Fraction by which a stage may be slower than the baseline")
+    parser.add_argument("-o", "--output", default=None,
+                        help="File to write the results to as JSON")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Report each stage as it finishes")
+    args = parser.parse_args()
+
+    progress = None
+    if args.verbose:
+        progress = lambda size, seed, stage, seconds, memory: sys.stderr.write(
+            "{} blocks, seed {}: {} {}\n".format(
+                size, seed, stage, "timeout" if seconds is None else "%.4fs" % seconds))
+    results = run([int(s) for s in args.sizes.split(",")], args.seeds, args.timeout, progress)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+    if args.update:
+        with open(args.baseline, "w") as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as baseline:
+        regressions = compare(results, json.load(baseline), args.tolerance)
+    for size, stage, description in regressions:
+        print "REGRESSION: {} blocks, {}: {}".format(size, stage, description)
+    sys.exit(1 if len(regressions) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "bin", "cs4071-ssa-optimiser")
+
+# Largest time, in milliseconds, each command may take to start beyond the
+# time taken to start the interpreter itself. Wall clock times of fresh
+# processes vary by several milliseconds from run to run and between machines,
+# so these only catch large regressions, about twice the time measured when
+# they were set; the modules each command loads are checked exactly instead.
+THRESHOLDS = {
+    "import": 10.0,
+    "cli": 40.0,
+}
+# Number of times each command is run. The fastest run is reported, as the
+# slower ones measure other load on the machine.
+REPEAT = 20
+
+# Modules which importing the package must not load.
+DEFERRED_MODULES = ["pipeline", "batch", "cache", "client", "binary_ir",
+                    "ssa", "fromSSA", "constant_propagation",
+                    "conditional_constant_propagation", "dead_code_elimination",
+                    "jump_threading", "global_value_numbering",
+                    "memory_optimisation", "loop_invariant_code_motion",
+                    "strength_reduction", "peephole",
+                    "aggressive_dead_code_elimination", "if_conversion",
+                    "block_layout", "register_allocation", "interprocedural",
+                    "incremental", "server", "dataflow", "interpreter", "block_profile",
+                    "piecewise", "value_range_propagation",
+                    "util",
+                    "graphs"]
+
+# Modules of DEFERRED_MODULES which `--help` may load, as the script needs them
+# to describe its options.
+CLI_MODULES = ["pipeline", "batch", "cache", "binary_ir"]
+
+# Code run to list the modules each command loads.
+LISTINGS = {
+    "import": "import cs4071_ssa_optimiser\n",
+    "cli": ("import runpy, StringIO\n"
+            "sys.stdout = StringIO.StringIO()\n"
+            "sys.argv = [{0!r}, '--help']\n"
+            "try:\n"
+            "    runpy.run_path({0!r}, run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n").format(SCRIPT),
+}
+
+COMMANDS = {
+    "baseline": ["-c", "pass"],
+    "import": ["-c", "import cs4071_ssa_optimiser"],
+    "cli": [SCRIPT, "--help"],
+}
+
+"""
+Returns the fastest of `repeat` wall clock times, in milliseconds, taken to run
+the interpreter with `arguments`.
+"""
+def time_command(arguments, repeat=REPEAT):
+    environment = dict(os.environ, PYTHONPATH=ROOT)
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable] + arguments, env=environment,
+                                  stdout=devnull)
+            times.append((time.time() - start) * 1000)
+    return min(times)
+
+"""
+Returns the modules in DEFERRED_MODULES loaded by the command `name`, other
+than those it is allowed to load.
+"""
+def eagerly_loaded(name):
+    with open(os.devnull, "w") as devnull:
+        output = subprocess.check_output(
+            [sys.executable, "-c",
+             "import sys\n" + LISTINGS[name] +
+             "sys.stdout = sys.__stdout__\n"
+             "print '\\n'.join(m for m in sys.modules if sys.modules[m])"],
+            env=dict(os.environ, PYTHONPATH=ROOT), stderr=devnull)
+    loaded = set(output.split())
+    allowed = CLI_MODULES if name == "cli" else []
+    return [m for m in DEFERRED_MODULES
+            if m not in allowed and "cs4071_ssa_optimiser." + m in loaded]
+
+"""
+Measures start-up time and prints it for each command. Returns non-zero if any
+command is slower than its threshold or a deferred module is loaded eagerly.
+"""
+def run(repeat=REPEAT, scale=1.0):
+    failed = False
+    for name in sorted(LISTINGS):
+        loaded = eagerly_loaded(name)
+        if len(loaded):
+            print "FAIL: {} loads {}".format(name, ", ".join(loaded))
+            failed = True
+    baseline = time_command(COMMANDS["baseline"], repeat)
+    print "{:10} {:7.1f}ms".format("baseline", baseline)
+    for name in sorted(THRESHOLDS):
+        elapsed = time_command(COMMANDS[name], repeat) - baseline
+        threshold = THRESHOLDS[name] * scale
+        status = "ok" if elapsed <= threshold else "FAIL"
+        print "{:10} {:+7.1f}ms  (threshold {:.1f}ms)  {}".format(name, elapsed, threshold, status)
+        failed = failed or elapsed > threshold
+    return 1 if failed else 0
+
+
+def main():
+    parser = ArgumentParser(description="Check the start-up time of the optimiser.")
+    parser.add_argument("-n", "--repeat", type=int, default=REPEAT,
+                        help="Number of times to run each command")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply every threshold by this, for slow machines")
+    args = parser.parse_args()
+    sys.exit(run(args.repeat, args.scale))
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,55 @@
-from .constant_propagation import constant_propagation
-from .conditional_constant_propagation import conditional_propagation
-from .dead_code_elimination import dead_code_elimination
-from .ssa import toSSA
-from .fromSSA import fromSSA
-from .aggressive_dead_code_elimination import aggressive_dead_code_elimination
-import json
+import sys
+from importlib import import_module
+from types import ModuleType
+from .version import __version__
 
+# The pipeline, batch optimisation, the cache and client, the passes, module
+# and incremental optimisation, the dataflow analyses, the interpreter and the
+# server are slow to import and most programs only need a few of them, so each
+# is only imported when it is first used. Maps each name to the submodule
+# defining it. The passes are looked up in pipeline.PASSES instead, so that
+# importing the package does not import the pipeline.
+_DEFERRED = dict(optimise="pipeline", load_pass="pipeline", PASSES="pipeline",
+                 PIPELINE="pipeline", optimise_batch="batch",
+                 optimise_stream="batch", iter_documents="batch",
+                 ResultCache="cache", Client="client",
+                 optimise_module="interprocedural",
+                 IncrementalOptimiser="incremental", serve="server",
+                 liveness="dataflow", reaching_definitions="dataflow",
+                 available_expressions="dataflow",
+                 check_optimisation="interpreter",
+                 load_profile="block_profile", attach_profile="block_profile",
+                 optimise_piecewise="piecewise")
 
-def optimise(code):
-    toSSA(code)
-    conditional_propagation(code)
-    constant_propagation(code)
-    dead_code_elimination(code)
-    aggressive_dead_code_elimination(code)
-    #conditional_propagation(code)
-    constant_propagation(code)
-    fromSSA(code)
-    return code
+_MISSING = object()
+
+"""
+The package module, which imports the names in _DEFERRED and the passes on
+first use.
+
+Most passes are defined in a submodule of the same name, which importing would
+otherwise bind on the package in place of the pass, so a name bound to a
+submodule, or not bound at all, is looked up in pipeline.PASSES first.
+"""
+class _Package(ModuleType):
+    def __getattribute__(self, name):
+        if name in _DEFERRED:
+            return getattr(import_module("." + _DEFERRED[name], __name__), name)
+        try:
+            value = ModuleType.__getattribute__(self, name)
+        except AttributeError:
+            value = _MISSING
+        if (value is _MISSING or isinstance(value, ModuleType)) and not name.startswith("__"):
+            passes = import_module(".pipeline", __name__).PASSES
+            if name in passes:
+                return getattr(import_module("." + passes[name], __name__), name)
+        if value is _MISSING:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        return value
+
+_package = _Package(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+# The functions above use the globals of this module, which are cleared if it
+# is freed.
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
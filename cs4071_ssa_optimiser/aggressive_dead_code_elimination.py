@@ -7,12 +7,17 @@ from util import (build_graph,
                   get_variables,
                   defines_variable,
                   is_conditional_branch,
+                  is_predicated,
+                  sets_flags,
                   remove_marked_statements,
                   is_var,
                   get_blocks,
+                  split_op,
+                  update_phis,
+                  COMPARISON_OPS,
                  )
 
-LIVE_OPS = ["STR", "BX", "BL", "SWI", "return", "CMP"]
+LIVE_OPS = ["STR", "BX", "BL", "SWI", "return"]
 
 """
 Aggressively finds and eliminates dead code using the algorithm described in the
@@ -24,14 +29,18 @@ Aggressively finds and eliminates dead code using the algorithm described in the
         * Memory writes (STR)
         * Branch & Exchange (BX) and Branch & Link (BL)
         * Software Interrupts (SWI)
-        * Status register updates (CMP), operations with the `S` flag.
+        * Operations with the `S` flag.
     3. Unmarks statements defining variables used in live statements.
-    4. Unmarks conditional branches that directly control execution of live statements.
-    5. Removes blocks that will not be reachable from the START node after deletion.
-    6. Deletes all marked statements.
-    7. Removes variables from phi functions whose definitions have been eliminated.
-    8. Removes blocks which contain no statements.
-    9. Iteratively finds a least fixed point at which no further statements are removed.
+    4. Unmarks conditional branches that directly control execution of live
+       statements, or which decide the predecessor a live phi function is
+       entered from.
+    5. Unmarks the comparisons setting the flags read by live statements, and
+       repeats from 3 until no more statements are unmarked.
+    6. Removes blocks that will not be reachable from the START node after deletion.
+    7. Deletes all marked statements.
+    8. Removes variables from phi functions whose definitions have been eliminated.
+    9. Removes blocks which contain no statements.
+    10. Iteratively finds a least fixed point at which no further statements are removed.
 
 A least fixed point solution is used despite not being mentioned in the description
 of the algorithm as testing showed subsequent attempts calls to the function may
@@ -46,15 +55,22 @@ def aggressive_dead_code_elimination(code):
     while code2 != code:
         code2 = copy.deepcopy(code)
         graph = build_graph(code)
+        phi_graph = build_graph(code)
         cdg = graph.control_dependence_graph()
         live_statements = []
+        defined = set(s["dest"] for b in code["blocks"] for s in b["code"] if "dest" in s)
         mark_all(code)
         unmark_live_ops(code, live_statements)
-        unmark_live_variable_definitions(code, live_statements)
-        unmark_live_conditional_branches(code, live_statements, cdg)
+        live = None
+        while live != len(live_statements):
+            live = len(live_statements)
+            unmark_live_variable_definitions(code, live_statements)
+            unmark_live_conditional_branches(code, live_statements, cdg, graph)
+            unmark_live_comparisons(code, live_statements, graph)
         remove_unreachable_blocks(code, graph)
+        update_phis(code, phi_graph)
         remove_marked_statements(code)
-        remove_dead_variables(code)
+        remove_dead_variables(code, defined)
         remove_dead_blocks(code)
 
 """
@@ -67,14 +83,17 @@ def mark_all(code):
 
 """
 Unmarks all instrinsically live statements. Live statements are operations
-with side effects, such as software interrupts and operations have an effect
-on the CPSR or Link Register such as CMP, BX, BL, and operators with the S flag.
+with side effects, such as software interrupts, stores, and operations that have an effect
+on the CPSR or Link Register such as BX, BL, and operators with the S flag,
+whether or not they are conditionally executed.
+Comparisons only set the flags, so are live only when a live statement reads
+them, as found by `unmark_live_comparisons`.
 """
 def unmark_live_ops(code, live_statements):
     statements = get_statements(code)
     for statement in statements:
         s = statement["statement"]
-        if s["op"] in LIVE_OPS or s["op"].endswith("S"):
+        if split_op(s["op"])[0] in LIVE_OPS or (sets_flags(s) and not _is_comparison(s)):
             del s["delete"]
             live_statements.append(statement)
 
@@ -90,6 +109,10 @@ def unmark_live_variable_definitions(code, live_statements):
         for statement in statements:
             s = statement["statement"]
             statement_vars = [s[var] for var in s if var.startswith("src") and is_var(s[var])]
+            # A predicated definition keeps the previous value when it is
+            # not executed.
+            if is_predicated(s) and "dest" in s:
+                statement_vars.append(s["dest"])
             if "dest" in s and s["dest"] == next_var and "delete" in s:
                 del s["delete"]
                 worklist.extend(statement_vars)
@@ -98,24 +121,104 @@ def unmark_live_variable_definitions(code, live_statements):
 
 """
 Unmarks all conditional branch statements that directly control execution of statements
-that have already been unmarked.
+that have already been unmarked. A comparison followed by a branch in its own
+block does not make the branch live by itself, as it is only needed if the
+branch is.
+
+A live phi function depends on which predecessor its block is entered from, so
+the branches its predecessors are control dependent on are live, as is the
+branch of each predecessor with other successors.
 """
-def unmark_live_conditional_branches(code, live_statements, cdg):
-    statements = get_statements(code)
-    worklist = [block for block in code["blocks"]]
+def unmark_live_conditional_branches(code, live_statements, cdg, graph):
+    blocks = get_blocks(code)
+    live_blocks = set(ls["block"] for ls in live_statements
+                      if not _compares_for_branch(code["blocks"][blocks[ls["block"]]], ls["statement"]))
+    choices = set()
+    for ls in live_statements:
+        if ls["statement"]["op"] == "phi":
+            choices.update(graph.pred(ls["block"]))
+    live_blocks.update(choices)
+    changed = True
+    while changed:
+        changed = False
+        for block in code["blocks"]:
+            if len(block["next_block"]) > 1 and (block["name"] in choices or
+                                                 len(live_blocks.intersection(cdg[block["name"]]))):
+                for statement in block["code"]:
+                    if is_conditional_branch(statement) and "delete" in statement:
+                        del statement["delete"]
+                        live_statements.append({"block": block["name"], "statement": statement})
+                        # Blocks controlling this branch are now live too.
+                        if block["name"] not in live_blocks:
+                            live_blocks.add(block["name"])
+                            changed = True
+
+"""
+Unmarks the statements setting the flags read by live conditionally executed
+statements: the last statement setting them before the reader in its block,
+or else the last in each block the flags may reach it from.
+"""
+def unmark_live_comparisons(code, live_statements, graph):
     blocks = get_blocks(code)
+    for ls in list(live_statements):
+        if split_op(ls["statement"]["op"])[1] is None:
+            continue
+        block = code["blocks"][blocks[ls["block"]]]
+        idx = [i for i, s in enumerate(block["code"]) if s is ls["statement"]][0]
+        setter = _last_flag_setter(block["code"][:idx])
+        if setter is not None:
+            setters = [(block["name"], setter)]
+        else:
+            setters = _flag_setters_on_entry(code, graph, block["name"])
+        for name, s in setters:
+            if "delete" in s:
+                del s["delete"]
+                live_statements.append({"block": name, "statement": s})
+
+"""
+Returns the (block name, statement) of the statements which may have set the
+flags on entry to block `name`.
+"""
+def _flag_setters_on_entry(code, graph, name):
+    blocks = get_blocks(code)
+    setters = []
+    seen = set()
+    worklist = list(graph.pred(name))
     while len(worklist):
-        block = worklist.pop()
-        if len(block["next_block"]) > 1:
-            next_block_index = 0
-            for statement in block["code"]:
-                if is_conditional_branch(statement) and "delete" in statement:
-                    next_block = block["next_block"][next_block_index]
-                    worklist.append(code["blocks"][blocks[next_block]])
-                    for ls in live_statements:
-                        if ls["block"] in cdg[next_block] and "delete" in statement:
-                            del statement["delete"]
-                    next_block_index += 1
+        pred = worklist.pop()
+        if pred in seen:
+            continue
+        seen.add(pred)
+        setter = _last_flag_setter(code["blocks"][blocks[pred]]["code"])
+        if setter is not None:
+            setters.append((pred, setter))
+        else:
+            worklist.extend(graph.pred(pred))
+    return setters
+
+def _last_flag_setter(statements):
+    for statement in reversed(statements):
+        if sets_flags(statement):
+            return statement
+    return None
+
+def _is_comparison(statement):
+    return split_op(statement["op"])[0] in COMPARISON_OPS
+
+"""
+True if `statement` is a comparison in `block` followed by a conditional
+branch reading the flags it sets.
+"""
+def _compares_for_branch(block, statement):
+    if not _is_comparison(statement):
+        return False
+    following = block["code"][[i for i, s in enumerate(block["code"]) if s is statement][0] + 1:]
+    for s in following:
+        if is_conditional_branch(s):
+            return True
+        if sets_flags(s):
+            return False
+    return False
 
 """
 Deletes all blocks that cannot be reached from the START block.
@@ -135,46 +238,59 @@ def remove_unreachable_blocks(code, graph):
             i += 1
 
 """
-Deletes all blocks that contain no statements.
+Deletes all blocks that contain no statements and have a single successor.
+Blocks whose successor begins with phi functions are kept, as the phi functions
+may need to distinguish the edge through the block from other edges. The
+starting block is kept too, as passes take the first block to be the entry.
 """
 def remove_dead_blocks(code):
     graph = build_graph(code)
-    r_graph = graph.reverse()
     blocks = get_blocks(code)
-    worklist = [block for block in code["blocks"]]
-    while len(worklist):
-        block = worklist.pop()
-        if len(block["code"]) == 0:
-            block["delete"] = True
-            for b in r_graph[block["name"]]:
-                previous_block = code["blocks"][blocks[b]]
-                worklist.append(previous_block)
-                for idx,next_block in enumerate(previous_block["next_block"]):
-                    if next_block == block["name"]:
-                        previous_block["next_block"][idx] = block["next_block"][0]
-    i = 0
-    while i < len(code["blocks"]):
-        if "delete" in code["blocks"][i]:
-            if code["blocks"][i]["name"] == code["starting_block"][0]:
-                code["starting_block"][0] = code["blocks"][i]["next_block"][0]
-            del code["blocks"][i]
-        else:
-            i += 1
+    forward = {}
+    for block in code["blocks"]:
+        if (len(block["code"]) == 0 and len(block["next_block"]) == 1 and
+                block["name"] != code["starting_block"][0] and
+                not _has_phis(code["blocks"][blocks[block["next_block"][0]]])):
+            forward[block["name"]] = block["next_block"][0]
+    targets = {}
+    for name in forward:
+        target = name
+        seen = set()
+        while target in forward and target not in seen:
+            seen.add(target)
+            target = forward[target]
+        # An empty infinite loop has nowhere to be redirected to.
+        if target not in forward:
+            targets[name] = target
+    for block in code["blocks"]:
+        block["next_block"] = [targets.get(b, b) for b in block["next_block"]]
+    code["blocks"][:] = [b for b in code["blocks"] if b["name"] not in targets]
+    # Predecessors are numbered in graph order, which deleting blocks may change.
+    update_phis(code, graph)
+
+def _has_phis(block):
+    return any(statement["op"] == "phi" for statement in block["code"])
 
 """
-Deletes mentions of variables in statements whose definitions have been deleted.
+Deletes mentions of variables in statements whose definitions have been deleted,
+`defined` being the variables defined before statements were deleted.
 
-This should only remove variable names from PHI functions.
+This should only remove variable names from PHI functions. Variables which were
+never defined are inputs to the program, eg. R0-0, and are kept.
 """
-def remove_dead_variables(code):
+def remove_dead_variables(code, defined):
     variables = get_variables(code)
     blocks = get_blocks(code)
     for variable in variables:
         v = variables[variable]
-        if "def_site" not in v:
+        if "def_site" not in v and variable in defined:
             for use in v["uses"]:
                 b, s = blocks[use["block"]], use["statement"]
                 statement = code["blocks"][b]["code"][s]
+                # Variables used outside phi functions without a definition
+                # are inputs to the program.
+                if statement["op"] != "phi":
+                    continue
                 for u in [u for u in statement if u.startswith("src") and statement[u] == variable]:
                     del statement[u]
 
@@ -0,0 +1,198 @@
+import glob
+import json
+import os
+import signal
+import sys
+import traceback
+from itertools import imap
+from pipeline import optimise, load_pass
+from cache import ResultCache, CACHE_SIZE
+import binary_ir
+
+# Number of items handed to a worker at a time. Most functions take a few
+# milliseconds to optimise, so items are sent in chunks to keep the cost of
+# passing them between processes small.
+BATCH_CHUNKSIZE = 16
+
+# The ResultCache for each cache directory used in this process.
+_caches = {}
+
+"""
+Returns an iterator over (source, text) pairs for the JSON documents named by
+each entry of `paths`, which may be
+    * a directory, giving every .json and binary IR (.ssab) file in it,
+    * a glob pattern, giving every file it matches,
+    * a .jsonl file, or "-" for standard input, giving each of its lines,
+    * any other file, giving its whole contents.
+`source` describes where the document came from, eg. "functions.jsonl:12".
+Files are read lazily, in sorted order.
+"""
+def iter_documents(paths):
+    for path in paths:
+        if path == "-":
+            for item in _lines("<stdin>", sys.stdin):
+                yield item
+        elif os.path.isdir(path):
+            names = (glob.glob(os.path.join(path, "*.json")) +
+                     glob.glob(os.path.join(path, "*" + binary_ir.BINARY_EXTENSION)))
+            for name in sorted(names):
+                yield name, _read(name)
+        elif os.path.exists(path):
+            for item in _file_documents(path):
+                yield item
+        else:
+            matches = sorted(glob.glob(path))
+            if not len(matches):
+                yield path, None
+            for name in matches:
+                for item in _file_documents(name):
+                    yield item
+
+"""
+Optimises every document from `documents`, an iterator over (source, text)
+pairs, across a pool of `processes` worker processes, by default one for
+each CPU. Yields a result for each document in input order, a dictionary
+with the document's "source" and either its optimised "result" or an "error"
+describing why it could not be optimised. One document failing does not
+stop the rest.
+
+If `cache_dir` is given, results are cached there with a ResultCache bounded
+to `cache_size` bytes, shared by every worker, and each result also has the
+number of cache "hits" and "misses" made optimising it under "cache".
+"""
+def optimise_batch(documents, processes=None, chunksize=BATCH_CHUNKSIZE,
+                   allocate_registers=False, cache_dir=None, cache_size=CACHE_SIZE):
+    options = (allocate_registers, cache_dir, cache_size)
+    items = ((source, text, options) for source, text in documents)
+    if processes == 1:
+        for result in imap(_optimise_item, items):
+            yield result
+        return
+    # Imported here rather than at the top, as it is slow to import and
+    # not needed by the other modes.
+    from multiprocessing import Pool
+    pool = Pool(processes, _ignore_interrupts)
+    try:
+        for result in pool.imap(_optimise_item, items, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+"""
+Optimises each JSON line read from the file `input` in turn, in this process.
+Yields the result for each line, in the same format as `optimise_batch`, as
+soon as it is optimised. Only one document is held in memory at a time.
+"""
+def optimise_stream(input, allocate_registers=False, cache_dir=None, cache_size=CACHE_SIZE):
+    options = (allocate_registers, cache_dir, cache_size)
+    for source, text in read_lines(input):
+        yield _optimise_item((source, text, options))
+
+"""
+Returns an iterator over (source, text) pairs for the non-empty lines of the
+file `input`, reading each line only when it is needed.
+"""
+def read_lines(input):
+    # Iterating over a file reads ahead in large blocks, which would hold
+    # back results until more input arrives.
+    return _lines(input.name, iter(input.readline, ""))
+
+"""
+Returns the number of functions in a result from `optimise_batch`.
+"""
+def count_functions(result):
+    if "result" not in result:
+        return 0
+    return len(result["result"].get("functions", [None]))
+
+"""
+Optimises a single function or module given as JSON text or in the binary
+format. Runs in a worker process, so any exception is returned as an error
+rather than raised.
+"""
+def _optimise_item(item):
+    source, text, options = item
+    if text is None:
+        return {"source": source, "error": "Could not read " + source}
+    try:
+        if binary_ir.is_binary(text):
+            document = binary_ir.loads(text)
+        else:
+            document = json.loads(text)
+    except ValueError as e:
+        return {"source": source, "error": _describe(e)}
+    result = optimise_document(document, *options)
+    result["source"] = source
+    return result
+
+"""
+Optimises `document`, a function or module, in place. Returns a dictionary
+with either the optimised document as "result" or an "error" describing why
+it could not be optimised, and, if `cache_dir` is given, the number of cache
+"hits" and "misses" made optimising it under "cache".
+"""
+def optimise_document(document, allocate_registers=False, cache_dir=None, cache_size=CACHE_SIZE):
+    cache = None
+    if cache_dir is not None:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = ResultCache(cache_dir, cache_size)
+        cache = _caches[cache_dir]
+        hits, misses = cache.stats["hits"], cache.stats["misses"]
+    try:
+        if "functions" in document:
+            from interprocedural import optimise_module
+            optimise_module(document, result_cache=cache)
+            functions = document["functions"]
+        else:
+            optimise(document, cache)
+            functions = [document]
+        if allocate_registers:
+            register_allocation = load_pass("register_allocation")
+            for function in functions:
+                register_allocation(function)
+        result = {"result": document}
+    except Exception as e:
+        result = {"error": _describe(e)}
+    if cache is not None:
+        result["cache"] = {"hits": cache.stats["hits"] - hits,
+                           "misses": cache.stats["misses"] - misses}
+    return result
+
+def _describe(exception):
+    return "".join(traceback.format_exception_only(type(exception), exception)).strip()
+
+def _file_documents(path):
+    if path.endswith(".jsonl"):
+        with open(path) as lines:
+            for item in _lines(path, lines):
+                yield item
+    else:
+        yield path, _read(path)
+
+def _lines(name, lines):
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            yield "%s:%d" % (name, number), line
+
+def _read(path):
+    try:
+        with open(path, "rb") as document:
+            return document.read()
+    except IOError:
+        return None
+
+def _ignore_interrupts():
+    # Leave the parent to handle Ctrl-C and terminate the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def main():
+    for result in optimise_batch(iter_documents(sys.argv[1:] or ["example.json"])):
+        print json.dumps(result)
+
+if __name__ == "__main__":
+    main()
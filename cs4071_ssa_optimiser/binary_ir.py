@@ -0,0 +1,329 @@
+import gc
+import json
+import mmap
+import struct
+import sys
+from array import array
+from itertools import izip
+
+# The first bytes of every binary document.
+MAGIC = "SSAB"
+FORMAT_VERSION = 1
+# Extension used for binary documents.
+BINARY_EXTENSION = ".ssab"
+
+FUNCTION = 0
+MODULE = 1
+
+# Index used where there is no string.
+NONE = 0xFFFFFFFF
+
+# magic, format version, kind, module attributes, then the number of strings,
+# functions, blocks, statements, operands and edges.
+HEADER = struct.Struct("<4sHHIIIIIII")
+
+_FUNCTION_KEYS = ("blocks", "starting_block")
+_BLOCK_KEYS = ("name", "code", "next_block")
+
+"""
+Returns `document`, a function or module, as a string in a compact binary
+format.
+
+Every string - opcodes, operand names, registers, constants and block names -
+is stored once in a string table and referred to by its index. The rest of the
+document is a series of arrays of unsigned 32-bit little-endian integers,
+following the header in this order:
+
+    string_offsets        start of each string in the string data, then its end
+    function_blocks       first block of each function, then the block count
+    function_start        starting block of each function, as a block index
+    function_attributes   other fields of each function as a JSON string, or NONE
+    block_names           name of each block
+    block_statements      first statement of each block, then the statement count
+    block_edges           first edge of each block, then the edge count
+    block_attributes      other fields of each block as a JSON string, or NONE
+    statement_ops         op of each statement
+    statement_operands    first operand of each statement, then the operand count
+    operands              (field, value) string pairs, eg. ("src1", "R1")
+    edges                 block index each edge leads to, in next_block order
+
+followed by the UTF-8 string data. The blocks of every function, statements of
+every block and so on are stored consecutively, so the "first" arrays with one
+extra entry give each range, as in a compressed sparse row matrix. Statement
+fields are stored in sorted order, and must all be strings.
+
+`Document` reads these arrays straight from a memory mapped file.
+
+Raises ValueError if a statement has a field which is not a string.
+"""
+def dumps(document):
+    functions = document["functions"] if "functions" in document else [document]
+    strings = _StringTable()
+    add = strings.add
+    arrays = dict((name, []) for name in _ARRAYS)
+    for name in _RANGES:
+        arrays[name].append(0)
+    block_names = arrays["block_names"]
+    statement_ops = arrays["statement_ops"]
+    statement_operands = arrays["statement_operands"]
+    operands = arrays["operands"]
+    edges = arrays["edges"]
+
+    for function in functions:
+        first = len(block_names)
+        index = dict((b["name"], first + i) for i, b in enumerate(function["blocks"]))
+        for block in function["blocks"]:
+            block_names.append(add(block["name"]))
+            for statement in block["code"]:
+                statement_ops.append(add(statement["op"]))
+                for field, value in sorted(statement.iteritems()):
+                    if field == "op":
+                        continue
+                    if not isinstance(value, basestring):
+                        raise ValueError("Field {} of statement {} is not a string".format(
+                            field, statement))
+                    operands.append(add(field))
+                    operands.append(add(value))
+                statement_operands.append(len(operands) // 2)
+            arrays["block_statements"].append(len(statement_ops))
+            edges.extend(index[name] for name in block["next_block"])
+            arrays["block_edges"].append(len(edges))
+            arrays["block_attributes"].append(strings.attributes(block, _BLOCK_KEYS))
+        arrays["function_blocks"].append(len(block_names))
+        arrays["function_start"].append(index[function["starting_block"][0]])
+        arrays["function_attributes"].append(strings.attributes(function, _FUNCTION_KEYS))
+
+    if "functions" in document:
+        kind, attributes = MODULE, strings.attributes(document, ("functions",))
+    else:
+        kind, attributes = FUNCTION, NONE
+    arrays["string_offsets"] = strings.offsets
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, kind, attributes,
+                         len(strings.offsets) - 1, len(functions), len(block_names),
+                         len(statement_ops), len(operands) // 2, len(edges))
+    parts = [header]
+    for name in _ARRAYS:
+        values = array("I", arrays[name])
+        if sys.byteorder != "little":
+            values.byteswap()
+        parts.append(values.tostring())
+    parts.append(strings.data())
+    return "".join(parts)
+
+"""
+Writes `document`, a function or module, to the file `output` in the binary
+format.
+"""
+def dump(document, output):
+    output.write(dumps(document))
+
+"""
+Returns the function or module encoded in the string `data`, in the same
+format as the JSON schema.
+"""
+def loads(data):
+    return Document(data).decode()
+
+"""
+Returns the function or module in the binary file `input`, which is memory
+mapped where possible rather than read.
+"""
+def load(input):
+    data = _map(input)
+    try:
+        return Document(data).decode()
+    finally:
+        _close(data)
+
+"""
+Returns the function or module in the file `input`, which may hold either the
+binary format or JSON.
+"""
+def load_document(input):
+    data = _map(input)
+    try:
+        if is_binary(data[:len(MAGIC)]):
+            return Document(data).decode()
+        return json.loads(data[:])
+    finally:
+        _close(data)
+
+"""
+True if the string `data` starts like a binary document.
+"""
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+"""
+A binary document held in `data`, a string or mmap. The arrays of the format
+are unpacked from `data` as they are needed, without copying it.
+
+Raises ValueError if `data` is not a binary document of a known version.
+"""
+class Document(object):
+    def __init__(self, data):
+        self.data = data
+        if len(data) < HEADER.size or not is_binary(data[:HEADER.size]):
+            raise ValueError("Not a binary IR document")
+        (_, version, self.kind, self.attributes, self.string_count, self.function_count,
+         self.block_count, self.statement_count, self.operand_count,
+         self.edge_count) = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError("Unsupported binary IR version {}".format(version))
+        self.offsets = {}
+        offset = HEADER.size
+        for name in _ARRAYS:
+            self.offsets[name] = offset
+            offset += 4 * self._length(name)
+        self.string_data = offset
+        if len(data) < self.string_data:
+            raise ValueError("Truncated binary IR document")
+        self._strings = None
+
+    """
+    Returns the array `name` of the format as a tuple of ints.
+    """
+    def array(self, name):
+        return struct.unpack_from("<%dI" % self._length(name), self.data, self.offsets[name])
+
+    """
+    Returns every string in the string table, in order.
+    """
+    def strings(self):
+        if self._strings is None:
+            offsets = self.array("string_offsets")
+            start = self.string_data
+            self._strings = [self.data[start + offsets[i]:start + offsets[i + 1]].decode("utf-8")
+                             for i in xrange(self.string_count)]
+        return self._strings
+
+    """
+    Returns the function or module in the JSON schema. Each distinct string is
+    a single object shared by every field holding it.
+    """
+    def decode(self):
+        # Nothing built here can be garbage, so collecting while building it
+        # only costs time.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._decode()
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _decode(self):
+        string = self.strings().__getitem__
+        block_names = map(string, self.array("block_names"))
+        block_statements = self.array("block_statements")
+        block_edges = self.array("block_edges")
+        block_attributes = self.array("block_attributes")
+        ops = map(string, self.array("statement_ops"))
+        statement_operands = self.array("statement_operands")
+        operands = map(string, self.array("operands"))
+        operands = zip(operands[::2], operands[1::2])
+        edges = map(block_names.__getitem__, self.array("edges"))
+
+        statements = [dict(operands[start:end], op=op) for op, start, end
+                      in izip(ops, statement_operands, statement_operands[1:])]
+
+        blocks = []
+        for i in xrange(self.block_count):
+            block = self._attributes(block_attributes[i])
+            block["name"] = block_names[i]
+            block["code"] = statements[block_statements[i]:block_statements[i + 1]]
+            block["next_block"] = edges[block_edges[i]:block_edges[i + 1]]
+            blocks.append(block)
+
+        functions = []
+        function_blocks = self.array("function_blocks")
+        function_start = self.array("function_start")
+        function_attributes = self.array("function_attributes")
+        for i in xrange(self.function_count):
+            function = self._attributes(function_attributes[i])
+            function["blocks"] = blocks[function_blocks[i]:function_blocks[i + 1]]
+            function["starting_block"] = [block_names[function_start[i]]]
+            functions.append(function)
+
+        if self.kind == FUNCTION:
+            return functions[0]
+        module = self._attributes(self.attributes)
+        module["functions"] = functions
+        return module
+
+    def _attributes(self, index):
+        if index == NONE:
+            return {}
+        return json.loads(self.strings()[index])
+
+    def _length(self, name):
+        counts = {"string": self.string_count, "function": self.function_count,
+                  "block": self.block_count, "statement": self.statement_count}
+        if name == "operands":
+            return 2 * self.operand_count
+        if name == "edges":
+            return self.edge_count
+        kind = name.split("_")[0]
+        return counts[kind] + (1 if name in _RANGES else 0)
+
+class _StringTable(object):
+    def __init__(self):
+        self.index = {}
+        self.offsets = [0]
+        self.parts = []
+
+    """
+    Returns the index of `string`, adding it to the table if it is new.
+    """
+    def add(self, string):
+        index = self.index.get(string)
+        if index is None:
+            encoded = string.encode("utf-8") if isinstance(string, unicode) else string
+            index = self.index[string] = len(self.parts)
+            self.parts.append(encoded)
+            self.offsets.append(self.offsets[-1] + len(encoded))
+        return index
+
+    """
+    Adds the fields of `item` other than `keys` as a JSON string, returning its
+    index, or NONE if there are none.
+    """
+    def attributes(self, item, keys):
+        others = dict((k, v) for k, v in item.iteritems() if k not in keys)
+        if not len(others):
+            return NONE
+        return self.add(json.dumps(others, sort_keys=True))
+
+    def data(self):
+        return "".join(self.parts)
+
+def _map(input):
+    try:
+        return mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # Not a regular file, eg. a pipe, or empty.
+        return input.read()
+
+def _close(data):
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+# The arrays of the format, in the order they are stored.
+_ARRAYS = ["string_offsets", "function_blocks", "function_start", "function_attributes",
+           "block_names", "block_statements", "block_edges", "block_attributes",
+           "statement_ops", "statement_operands", "operands", "edges"]
+# Arrays giving the start of each range, with an extra entry for the end of
+# the last.
+_RANGES = ["string_offsets", "function_blocks", "block_statements", "block_edges",
+           "statement_operands"]
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        data = dumps(code)
+        print "{} bytes of JSON, {} bytes binary".format(len(json.dumps(code)), len(data))
+        print json.dumps(loads(data), indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import json
+from ssa import toSSA
+from fromSSA import fromSSA
+from aggressive_dead_code_elimination import remove_dead_blocks
+from block_profile import block_counts
+from util import (build_graph,
+                  get_blocks,
+                  branch_condition,
+                  INVERSE_CONDITIONS)
+
+"""
+Branch straightening and block placement for code that has been converted out
+of SSA form.
+
+Transforms `code` in place:
+    1. Existing unconditional branches are deleted. Empty blocks with a
+       single successor are removed, redirecting their predecessors to the
+       successor, and conditional branches whose targets are now the same
+       block are deleted.
+    2. A block is merged into its predecessor when it is that predecessor's
+       only successor and has no other predecessors.
+    3. Blocks are grouped into chains, joining the most frequently executed
+       edges first, so that the hot path through each branch falls through
+       to the next block. Blocks in a loop nest of depth d are assumed to
+       execute 10^d times, unless `profile`, a dictionary mapping block
+       names to execution counts, is given or every block has a count from
+       block_profile.attach_profile.
+    4. The blocks are reordered, starting with the chain containing the entry
+       block, and unconditional branches are added or deleted so that every
+       block only falls through to the block placed after it. A conditional
+       branch whose taken target is placed next has its condition inverted
+       rather than adding a branch.
+
+An unconditional `B` jumps to the last entry of `next_block`, so the `B`
+following a conditional branch jumps to the block the condition falls through
+to.
+"""
+def block_layout(code, profile=None):
+    for block in code["blocks"]:
+        _strip_jumps(block)
+    remove_dead_blocks(code)
+    _remove_redundant_branches(code)
+    _merge_blocks(code)
+    frequencies = _block_frequencies(code, profile)
+    order = _build_chains(code, frequencies)
+    blocks = get_blocks(code)
+    code["blocks"][:] = [code["blocks"][blocks[name]] for name in order]
+    _place_branches(code)
+
+"""
+Deletes conditional branches which go to the same block whether or not they
+are taken.
+"""
+def _remove_redundant_branches(code):
+    for block in code["blocks"]:
+        if len(block["next_block"]) == 2 and block["next_block"][0] == block["next_block"][1]:
+            block["code"] = [s for s in block["code"] if not branch_condition(s)]
+            block["next_block"] = block["next_block"][:1]
+
+"""
+Merges every block into its predecessor where the predecessor has it as its
+only successor and it has no other predecessors.
+"""
+def _merge_blocks(code):
+    changed = True
+    while changed:
+        changed = False
+        preds = _predecessors(code)
+        blocks = get_blocks(code)
+        for block in code["blocks"]:
+            if len(block["next_block"]) != 1:
+                continue
+            succ = block["next_block"][0]
+            if (succ == block["name"] or succ == code["starting_block"][0] or
+                    preds[succ] != [block["name"]]):
+                continue
+            succ_block = code["blocks"][blocks[succ]]
+            block["code"].extend(succ_block["code"])
+            block["next_block"] = succ_block["next_block"]
+            del code["blocks"][blocks[succ]]
+            changed = True
+            break
+
+"""
+Returns a dictionary mapping block names to their estimated execution counts.
+"""
+def _block_frequencies(code, profile):
+    if profile is not None:
+        return dict((b["name"], profile.get(b["name"], 0)) for b in code["blocks"])
+    counts = block_counts(code)
+    if counts is not None and len(counts):
+        return counts
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    return dict((name, 10 ** graph.loop_depth(name)) for name in graph)
+
+"""
+Greedily joins blocks into chains along the edges with the highest estimated
+execution counts, taking the count of an edge to be the smaller of the counts
+of its ends. Where counts are equal, edges which already fall through are
+preferred. The chains are then placed after the chain holding the entry block,
+each following a chain which branches to it where possible. Returns the block
+names in layout order.
+"""
+def _build_chains(code, frequencies):
+    start = code["starting_block"][0]
+    edges = []
+    for idx, block in enumerate(code["blocks"]):
+        for n, succ in enumerate(block["next_block"]):
+            weight = min(frequencies[block["name"]], frequencies[succ])
+            falls_through = n == len(block["next_block"]) - 1
+            edges.append(((-weight, not falls_through, idx), block["name"], succ))
+    edges.sort(key=lambda e: e[0])
+
+    chains = dict((b["name"], [b["name"]]) for b in code["blocks"])
+    for _, pred, succ in edges:
+        if pred == succ or succ == start:
+            continue
+        first, second = chains[pred], chains[succ]
+        if first is second or first[-1] != pred or second[0] != succ:
+            continue
+        first.extend(second)
+        for name in second:
+            chains[name] = first
+
+    order = list(chains[start])
+    heads = [b["name"] for b in code["blocks"]
+             if chains[b["name"]][0] == b["name"] and b["name"] != start]
+    while len(heads):
+        # Follow the hottest edge out of the last block placed, otherwise
+        # continue with the hottest chain left.
+        tail = code["blocks"][get_blocks(code)[order[-1]]]
+        successors = [h for h in tail["next_block"] if h in heads]
+        if len(successors):
+            head = max(successors, key=lambda h: frequencies[h])
+        else:
+            head = max(heads, key=lambda h: (frequencies[h], -heads.index(h)))
+        heads.remove(head)
+        order.extend(chains[head])
+    code["starting_block"][0] = order[0]
+    return order
+
+"""
+Adds or deletes unconditional branches, and inverts conditional branches, so
+that each block only falls through to the block placed after it.
+"""
+def _place_branches(code):
+    for idx, block in enumerate(code["blocks"]):
+        following = None
+        if idx + 1 < len(code["blocks"]):
+            following = code["blocks"][idx + 1]["name"]
+        _strip_jumps(block)
+        targets = block["next_block"]
+        if len(targets) == 1 and targets[0] != following:
+            block["code"].append({"op": "B"})
+        elif len(targets) == 2 and targets[1] != following:
+            branch = [s for s in block["code"] if branch_condition(s)]
+            if targets[0] == following and len(branch):
+                condition = branch_condition(branch[-1])
+                branch[-1]["op"] = "B" + INVERSE_CONDITIONS[condition]
+                block["next_block"] = [targets[1], targets[0]]
+            else:
+                block["code"].append({"op": "B"})
+
+def _strip_jumps(block):
+    while len(block["code"]) and block["code"][-1]["op"] == "B":
+        block["code"].pop()
+
+def _predecessors(code):
+    preds = dict((b["name"], []) for b in code["blocks"])
+    for block in code["blocks"]:
+        for succ in block["next_block"]:
+            preds[succ].append(block["name"])
+    return preds
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        fromSSA(code)
+        block_layout(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+from numbers import Number
+from dataflow import reverse_postorder
+from util import build_graph
+
+# Smallest fraction of the blocks of a function a profile must give counts for
+# to be used. A profile naming fewer was most likely recorded from a different
+# version of the function, and is ignored.
+MIN_COVERAGE = 0.5
+
+"""
+Reads a block execution profile from the open file `infile`.
+
+A profile of a function is a dictionary mapping the names of its blocks to the
+number of times each was executed, as recorded on the target or given by the
+interpreter in Execution.block_counts:
+
+    {"main": 1, "loop": 100, "exit": 1}
+
+A profile of a module maps the names of its functions to their profiles.
+Raises ValueError if the file is not JSON or not a dictionary. Entries which
+are not counts are ignored when the profile is attached.
+"""
+def load_profile(infile):
+    profile = json.load(infile)
+    if not isinstance(profile, dict):
+        raise ValueError("A profile must map block names to execution counts")
+    return profile
+
+"""
+Gives each block of `code` its count from `profile`, returning true if it was
+used.
+
+Profiles are matched to blocks by name. Entries for blocks which do not exist
+and counts which are not non-negative numbers are ignored. If fewer than
+MIN_COVERAGE of the blocks then have counts the profile is taken to be stale
+and `code` is left unchanged. Otherwise each block missing from the profile is
+given the count of its nearest dominator in it, and blocks which cannot be
+reached from the entry a count of 0.
+
+The counts are kept in a "count" field of each block, so that they move with
+the blocks through the passes: blocks keep their counts when converted to and
+from SSA form and when merged into their predecessors, counts of deleted
+blocks are dropped with them, and passes creating blocks give them counts
+estimated from the blocks around them. Passes deciding how to optimise code
+by how often it runs use the counts where every block has one, and fall back
+on their static estimates otherwise.
+"""
+def attach_profile(code, profile):
+    counts = dict((name, int(count)) for name, count in profile.iteritems()
+                  if _is_count(count))
+    known = [b for b in code["blocks"] if b["name"] in counts]
+    if not len(known) or len(known) < MIN_COVERAGE * len(code["blocks"]):
+        return False
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    reachable = graph.reachable(graph.root)
+    estimated = {}
+    # Dominators come before the nodes they dominate in reverse postorder.
+    for name in reverse_postorder(graph):
+        if name in counts:
+            estimated[name] = counts[name]
+        elif name in reachable and name != graph.root:
+            estimated[name] = estimated[graph.idom(name)]
+        else:
+            estimated[name] = 0
+    for block in code["blocks"]:
+        block["count"] = estimated[block["name"]]
+    return True
+
+"""
+Removes the counts from the blocks of `code`.
+"""
+def strip_profile(code):
+    for block in code["blocks"]:
+        block.pop("count", None)
+
+"""
+Returns a dictionary mapping the name of each block of `code` to its count, or
+None if some block has no count.
+"""
+def block_counts(code):
+    if not all("count" in b for b in code["blocks"]):
+        return None
+    return dict((b["name"], b["count"]) for b in code["blocks"])
+
+"""
+Returns the names in `names` of the blocks of `code` which have been executed,
+most frequently executed first, if every block has a count, and otherwise all
+of `names` in their original order.
+"""
+def hottest_first(code, names):
+    counts = block_counts(code)
+    if counts is None or not len(code["blocks"]):
+        return list(names)
+    return sorted([n for n in names if counts[n]], key=lambda n: -counts[n])
+
+def _is_count(count):
+    return isinstance(count, Number) and not isinstance(count, bool) and count >= 0
+
+
+def main():
+    from interpreter import run
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        attach_profile(code, run(code).block_counts)
+        print json.dumps(block_counts(code), indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import errno
+import hashlib
+import json
+import os
+import tempfile
+from pipeline import PIPELINE
+from version import __version__
+
+# Default bound on the total size of a cache directory, in bytes.
+CACHE_SIZE = 256 * 1024 * 1024
+# Number of results a ResultCache stores between checks of the cache size.
+EVICT_INTERVAL = 64
+
+"""
+A persistent cache of optimised functions, stored as files under `directory`.
+
+Each result is keyed by the SHA-1 hash of its input function in canonical
+JSON, together with the names of the passes run and the package version, so
+changing either invalidates every entry. A result with key k is stored in
+directory/k[:2]/k[2:].json, spreading entries over 256 subdirectories.
+
+Results are written to a temporary file in the same subdirectory and renamed
+into place, which is atomic, so any number of processes may share a cache
+directory and a reader never sees a partly written result. Reading a result
+updates its modification time, and once the files in the cache take more than
+`max_size` bytes the least recently used are deleted. The size is checked
+every EVICT_INTERVAL stores and whenever `evict` is called.
+
+The hits, misses, stores and evictions made through this object are counted
+in `stats`.
+"""
+class ResultCache(object):
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._unchecked = 0
+
+    """
+    Returns the key for the function `code` optimised by the passes named in
+    `passes`.
+    """
+    def key(self, code, passes=PIPELINE):
+        configuration = json.dumps([__version__] + list(passes))
+        canonical = json.dumps(code, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(configuration + "\0" + canonical).hexdigest()
+
+    """
+    Returns the result stored for `key`, or None if there is none.
+    """
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as result:
+                code = json.load(result)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return code
+
+    """
+    Stores `code` as the result for `key`.
+    """
+    def put(self, key, code):
+        path = self._path(key)
+        shard = os.path.dirname(path)
+        try:
+            os.makedirs(shard)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        handle, temporary = tempfile.mkstemp(dir=shard, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as result:
+                json.dump(code, result)
+            os.rename(temporary, path)
+        except:
+            _remove(temporary)
+            raise
+        self.stats["stores"] += 1
+        self._unchecked += 1
+        if self._unchecked >= EVICT_INTERVAL:
+            self.evict()
+
+    """
+    Deletes the least recently used results until the cache takes at most
+    `max_size` bytes.
+    """
+    def evict(self):
+        self._unchecked = 0
+        entries = []
+        total = 0
+        for shard, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(shard, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    # Deleted by another process.
+                    continue
+                entries.append((status.st_mtime, status.st_size, path))
+                total += status.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if _remove(path):
+                self.stats["evictions"] += 1
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + ".json")
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
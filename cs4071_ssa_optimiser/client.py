@@ -0,0 +1,84 @@
+import json
+import socket
+import struct
+import sys
+
+# Every message is preceded by its length in bytes, as a 4 byte big-endian
+# unsigned integer.
+HEADER = struct.Struct("!I")
+# Largest message accepted, in bytes.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+"""
+A connection to an optimiser server listening on the Unix domain socket
+`path`, which may be used for any number of requests.
+"""
+class Client(object):
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.rfile = self.socket.makefile("rb")
+        self.wfile = self.socket.makefile("wb")
+
+    """
+    Sends `document`, a function or module, to the server and returns its
+    response, a dictionary with either the optimised "result" or an "error".
+    """
+    def optimise(self, document, allocate_registers=False):
+        return self.optimise_text(json.dumps(document), allocate_registers)
+
+    """
+    As `optimise`, for a document given as JSON text, which is passed on to
+    the server without being parsed.
+    """
+    def optimise_text(self, text, allocate_registers=False):
+        request = '{{"allocate_registers": {}, "document": {}}}'.format(
+            json.dumps(allocate_registers), text.strip())
+        write_message(self.wfile, request)
+        response = read_message(self.rfile)
+        if response is None:
+            raise ProtocolError("Server closed the connection")
+        return json.loads(response)
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.socket.close()
+
+"""
+Returns the next message read from the file `stream`, or None at the end of
+the stream.
+"""
+def read_message(stream):
+    header = stream.read(HEADER.size)
+    if not len(header):
+        return None
+    if len(header) < HEADER.size:
+        raise ProtocolError("Truncated message header")
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise ProtocolError("Message of {} bytes is too large".format(size))
+    message = stream.read(size)
+    if len(message) < size:
+        raise ProtocolError("Truncated message")
+    return message
+
+def write_message(stream, message):
+    if isinstance(message, unicode):
+        message = message.encode("utf-8")
+    stream.write(HEADER.pack(len(message)) + message)
+    stream.flush()
+
+
+def main():
+    client = Client(sys.argv[1] if len(sys.argv) > 1 else "optimiser.sock")
+    with open('example.json') as input_code:
+        response = client.optimise_text(input_code.read())
+        client.close()
+        print json.dumps(response, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import json
 from ssa import toSSA
 from constant_propagation import constant_propagation
-from util import (remove_statement,
+from util import (build_graph,
+                  update_phis,
+                  remove_statement,
                   is_copy,
                   is_constant_val,
                   is_constant_phi,
@@ -9,13 +11,20 @@ from util import (remove_statement,
           get_blocks,
           get_statements,
           _fold_constant,
-          _do_op,
+          _apply_identities,
+          _constant,
+          _do_shift,
+          branch_condition,
+          compare_flags,
+          evaluate_condition,
+          FOLDABLE_OPS,
           get_statements_in_block,
-          is_var)
+          is_var,
+          sets_flags,
+          split_op)
+from jump_threading import _reads_flags_on_entry
 
-FOLDABLE_OPS = ["MUL", "SUB", "RSB", "ADD"]
 MEMORY_OPS = ["BL","LDR"]
-CONDITIONAL_BRANCH = ["BEQ","BNE","BLT","BLE","BGT","BGE"]
 
 
 """
@@ -43,62 +52,40 @@ def conditional_propagation(code):
 
     for block in code["blocks"]:
         block["delete"] = True
-        #Entry block is always executable
-        if block["name"] == code["starting_block"][0]:
-            add_block_to_worklist(block, worklist)
-            block["delete"] = False
+    #Entry block is always executable
+    mark_executable(code, blocks, code["blocks"][blocks[code["starting_block"][0]]], worklist)
 
 
-    branch = "nil"
-
 
 
     while len(worklist):
         s = worklist.pop(0)
         # Executable Blocks with only 1 successor, that block must also be executable
-        if len(get_block(s, code, blocks)["next_block"]) >= 1:
-            if get_next_block(code, blocks, s, 0)["delete"] and len(get_block(s, code, blocks)["next_block"]) == 1:
-                get_next_block(code, blocks, s, 0)["delete"] = False
-                add_block_to_worklist(get_next_block(code, blocks, s, 0), worklist)
+        # The same goes for every successor of a block whose branch does not
+        # depend on a CMP, eg. one that tests the flags set by SUBS.
+        block = get_block(s, code, blocks)
+        if len(block["next_block"]) == 1 or not any(x["op"] == "CMP" for x in block["code"]):
+            for direction in range(len(block["next_block"])):
+                mark_executable(code, blocks, get_next_block(code, blocks, s, direction), worklist)
 
         if "dest" in s:
             #any overloaded variable cannot chance state
             if variables[s["dest"]]["evidence"] != "over":
                 #Any executable statement v := x op y with x and y constant and exectuable , set v to constant x op y
                 #Any executable statement v := x op y with x or y is overloaded and exectuable, set v overloaded
-                if is_executable (code, s["src1"], variables):
-                    if s["op"] == "MOV":
-                        if is_constant_val(s["src1"], variables):
-                            if get_value (variables, s["dest"]) == "never":
-                                variables [s["dest"]]["evidence"] = get_value (variables, s["src1"])
-                                update_worklist(code, worklist, s)
-                            elif get_value (variables, s["dest"]) != get_value (variables, s["dest"]):
-                                variables [s["dest"]]["evidence"] = "over"
-                                update_worklist(code, worklist, s)
-                        else:
+                if s["op"] in FOLDABLE_OPS:
+                    srcs = [x for x in s if x.startswith("src")]
+                    if all(is_executable(code, s[x], variables) for x in srcs):
+                        value = _evaluate(s, variables)
+                        if value == "never":
+                            pass
+                        elif get_value (variables, s["dest"]) == "never":
+                            variables [s["dest"]]["evidence"] = value
+                            update_worklist(code, worklist, s)
+                        elif get_value (variables, s["dest"]) != value:
                             variables [s["dest"]]["evidence"] = "over"
                             update_worklist(code, worklist, s)
 
-                    if s["op"] in FOLDABLE_OPS:
-                        if is_executable (code, s["src2"], variables):
-                            if is_constant_val(s["src1"], variables) and is_constant_val(s["src2"], variables):
-                                try:
-                                    val1 = int(get_value(variables, s["src1"])[1:])
-                                    val2 = int(get_value(variables, s["src2"])[1:])
-                                except ValueError:
-                                    return
-                                const = "#" + str(_do_op(s["op"], val1, val2))
-
-                                if get_value (variables, s["dest"]) == "never":
-                                    variables [s["dest"]]["evidence"] = const
-                                    update_worklist(code, worklist, s)
-                                elif get_value (variables, s["dest"]) != const:
-                                    variables [s["dest"]]["evidence"] = "over"
-                                    update_worklist(code, worklist, s)
-                            else:
-                                variables [s["dest"]]["evidence"] = "over"
-                                update_worklist(code, worklist, s)
-
                 # If v assigned from phi op, and if all srcs that are constant and executable are the same and there are no variables that have seen evidence of use, assign constant value to v.
                 # If v assigned from phi op, and at least 2 srcs are different constants and are executable, v is a overloaded
                 # If v assigned from phi op, and at least 1 srcs is overloaded and is executable, v is overloaded
@@ -124,71 +111,15 @@ def conditional_propagation(code):
 
         if s["op"] == "CMP":
             # if branch instruction, if either src is a overloaded, then both paths may be executed and should be added to the worklist to be marked as such and their statements analysed.
-            if is_var(s["src1"], variables) or is_var(s["src2"], variables):
-                add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                get_next_block(code, blocks, s, 0)["delete"] = False
-                add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-                get_next_block(code, blocks, s, 1)["delete"] = False
-
             #If a branch and both srcs are constant, add appropriate path to work path.
-            else:
-                val1 = int(get_value(variables,s["src1"])[1:])
-                val2 = int(get_value(variables,s["src2"])[1:])
-                if val1 > val2 :
-                    branch = "gt"
-                elif val1 < val2 :
-                    branch = "lt"
-                else:
-                    branch = "eq"
-
-        #Note - these do not take in to account all possible instructions in the arm instruction set, such as any operation being conditional
-        if branch != "nil":
-            if s["op"] == "BEQ":
-                if branch == "eq":
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-            if s["op"] == "BNE":
-                if branch != "eq":
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-            if s["op"] == "BLT":
-                if branch == "lt":
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-            if s["op"] == "BLE":
-                if branch == "eq" or branch == "lt" :
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-            if s["op"] == "BGT":
-                if branch == "gt":
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
-            if s["op"] == "BGE":
-                if branch == "eq" or branch == "gt" :
-                    get_next_block(code, blocks, s, 0)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 0) , worklist)
-                else:
-                    get_next_block(code, blocks, s, 1)["delete"] = False
-                    add_block_to_worklist(get_next_block(code, blocks, s, 1) , worklist)
+            #Note - these do not take in to account all possible instructions in the arm instruction set, such as any operation being conditional
+            for direction in _branch_directions(code, blocks, s, variables):
+                mark_executable(code, blocks, get_next_block(code, blocks, s, direction), worklist)
 
 
 
     # Delete any block that is not executed
+    graph = build_graph(code)
     for block in code["blocks"]:
         i = 0
         #delete references to deleted blocks
@@ -209,6 +140,8 @@ def conditional_propagation(code):
             del code["blocks"][i]
         else:
             i += 1
+    update_phis(code, graph)
+    blocks = get_blocks(code)
 
     worklistfix = []
     for block in code["blocks"]:
@@ -222,19 +155,55 @@ def conditional_propagation(code):
             if variables[s["dest"]]["evidence"].startswith('#'):
                 _propagate_constant(code, s, variables[s["dest"]]["evidence"])
 
-        #remove any branch ops that are constant
-        if s["op"] == "CMP":
-            if is_constant_val(s["src1"], variables) and is_constant_val(s["src2"], variables):
-                remove_statement(code, s)
-        if s["op"] in CONDITIONAL_BRANCH:
-            block = get_block(s, code, blocks)["code"]
-            if not any(statement["op"] == "CMP" for statement in block):
-                remove_statement(code, s)
-
         if s["block"]:
                 del s["block"]
 
+    #remove any branch ops that are constant
+    graph = build_graph(code)
+    for block in code["blocks"]:
+        for s in [x for x in block["code"] if x["op"] == "CMP"]:
+            _fold_comparison(code, blocks, block, s)
+    update_phis(code, graph)
+
 
+"""
+Deletes the comparison `s` in `block` if both its operands are constants,
+with any conditional branch reading the flags it sets and the successor the
+branch does not lead to. The comparison is kept if the flags it sets may
+still be read, by a predicated statement or by a successor of `block`.
+"""
+def _fold_comparison(code, blocks, block, s):
+    if not all(s.get(x, "").startswith("#") for x in ["src1", "src2"]):
+        return
+    try:
+        val2 = _constant(s["src2"])
+        if "shift" in s:
+            val2 = _do_shift(s["shift"], val2)
+        flags = compare_flags(_constant(s["src1"]), val2)
+    except ValueError:
+        return
+    following = block["code"][[i for i, x in enumerate(block["code"]) if x is s][0] + 1:]
+    readers = []
+    reaches_end = True
+    for statement in following:
+        if split_op(statement["op"])[1] is not None:
+            readers.append(statement)
+        if sets_flags(statement):
+            reaches_end = False
+            break
+    branches = [x for x in readers if branch_condition(x)]
+    if len(branches) == 1:
+        taken = evaluate_condition(branch_condition(branches[0]), flags)
+        if len(block["next_block"]) == 2:
+            block["next_block"] = [block["next_block"][0 if taken else 1]]
+        # Otherwise the successor not taken was never executed, and has
+        # already been deleted.
+        block["code"] = [x for x in block["code"] if x is not branches[0]]
+        readers.remove(branches[0])
+    if len(readers) or (reaches_end and
+            any(_reads_flags_on_entry(code["blocks"][blocks[name]]) for name in block["next_block"])):
+        return
+    block["code"] = [x for x in block["code"] if x is not s]
 
 def get_block(statement, code, blocks):
     return code["blocks"][blocks[statement["block"]]]
@@ -242,6 +211,21 @@ def get_block(statement, code, blocks):
 def get_next_block(code, blocks, statement, direction):
     return code["blocks"][blocks[get_block(statement, code, blocks)["next_block"][direction]]]
 
+"""
+Marks `block` as executable and adds its statements to the worklist. Only the
+first time a block is found executable has any effect, otherwise a block
+branching to itself would be visited forever. The successors of an empty
+block, which has no statements to mark them, are marked straight away.
+"""
+def mark_executable(code, blocks, block, worklist):
+    if not block["delete"]:
+        return
+    block["delete"] = False
+    add_block_to_worklist(block, worklist)
+    if not len(block["code"]):
+        for name in block["next_block"]:
+            mark_executable(code, blocks, code["blocks"][blocks[name]], worklist)
+
 def add_block_to_worklist(block, worklist):
     for statement in block["code"]:
         statement["block"] = block["name"]
@@ -278,6 +262,9 @@ def is_var(val, variables):
 def is_executable (code, var, variables):
     if var.startswith('#'):
         return True
+    # Variables with no definition are inputs to the program
+    if "def_site" not in variables[var]:
+        return True
     blocks = get_blocks(code)
     return not code["blocks"][blocks[variables[var]["def_site"].get("block")]]["delete"]
 
@@ -294,6 +281,64 @@ def _propagate_constant(code, statement, const):
                     statement[field] = val
 
 
+"""
+Returns the value computed by `s` given the evidence in `variables`: a
+constant, "over", or "never" if it depends on a variable not yet evaluated.
+Operations are folded with the same 32-bit arithmetic and algebraic identities
+as constant_propagation, so eg. MUL v, x, #0 is constant whatever x is.
+"""
+def _evaluate(s, variables):
+    folded = dict(s)
+    for x in s:
+        if x.startswith("src") and is_constant_val(s[x], variables):
+            folded[x] = get_value(variables, s[x])
+    _fold_constant(folded)
+    _apply_identities(folded)
+    if is_copy(folded):
+        # Copies inserted by fromSSA name their operand "src" rather than
+        # "src1".
+        return get_value(variables, folded["src1"] if "src1" in folded else folded["src"])
+    return "over"
+
+"""
+Returns the flags set by the comparison `s` as given by `compare_flags`, or
+None if either operand is not a known constant.
+"""
+def _compare(s, variables):
+    if not (is_constant_val(s["src1"], variables) and is_constant_val(s["src2"], variables)):
+        return None
+    try:
+        val1 = _constant(get_value(variables, s["src1"]))
+        val2 = _constant(get_value(variables, s["src2"]))
+        if "shift" in s:
+            val2 = _do_shift(s["shift"], val2)
+    except ValueError:
+        return None
+    return compare_flags(val1, val2)
+
+"""
+Returns the indexes in `next_block` of the successors which may be executed
+after the comparison `s`. Both successors may be executed unless the block
+ends with a conditional branch reading the flags set by `s` and they are
+known constants, in which case only the successor taken by the branch is
+returned.
+"""
+def _branch_directions(code, blocks, s, variables):
+    block = get_block(s, code, blocks)
+    if len(block["next_block"]) < 2:
+        return []
+    following = block["code"][[i for i, x in enumerate(block["code"]) if x is s][0] + 1:]
+    # The branch may test flags set after `s`, eg. by SUBS.
+    for x in following:
+        if branch_condition(x):
+            flags = _compare(s, variables)
+            if flags is None:
+                break
+            return [0] if evaluate_condition(branch_condition(x), flags) else [1]
+        if sets_flags(x):
+            break
+    return [0, 1]
+
 def get_value (variables, var):
     if var.startswith('#'):
         return var
@@ -5,10 +5,9 @@ from util import (remove_statement,
                   is_copy,
                   is_constant_val,
                   is_constant_phi,
-				  _fold_constant,
-				  _do_op)
-
-FOLDABLE_OPS = ["MUL", "SUB", "RSB", "ADD"]
+                  _fold_constant,
+                  _apply_identities,
+                  FOLDABLE_OPS)
 
 
 
@@ -19,11 +18,14 @@ algorithm specified in the SSA Optimization Algorithms handout.
 Transforms `code` in place with three transformations:
     * Eliminates phi functions where all phi-function operands are equal,
       replacing such functions with a copy operation.
-    * Constant folds operations on two constant variables, eg.
+    * Constant folds operations on constant variables, eg.
         ADD R0, #1, #5
       By performing the specified operation and replacing the statement
       with a copy operation with the result, eg.
         ADD R0, #1, #5  --->  MOV R0, #6
+      Operations where one operand decides the result are replaced with a
+      copy in the same way, eg.
+        MUL R0, R1, #1  --->  MOV R0, R1
     * Copy propagation taking single argument phi functions or copy assignments
       of the form x <- Phi(y) or x <- y, deleting them and replacing all uses
       of `x` by `y`.
@@ -37,9 +39,9 @@ def constant_propagation(code):
         s = worklist.pop(0)
         if is_constant_phi(s):
             _convert_phi_to_copy(s)
-        if s["op"] in FOLDABLE_OPS:
-            if is_constant_val(s["src1"]) and is_constant_val(s["src2"]):
-                _fold_constant(s)
+        if s["op"] in FOLDABLE_OPS and not is_copy(s):
+            _fold_constant(s)
+            _apply_identities(s)
         if is_copy(s) and "src2" not in s:
             _propagate_constant(code, worklist, s)
 
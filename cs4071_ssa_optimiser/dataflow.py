@@ -0,0 +1,287 @@
+import heapq
+import json
+from util import (build_graph,
+                  is_predicated,
+                  is_var,
+                  split_op,
+                  DATA_PROCESSING_OPS)
+
+FORWARD = "forward"
+BACKWARD = "backward"
+
+UNION = "union"
+INTERSECTION = "intersection"
+
+"""
+A numbering of the items a dataflow problem is about, such as variables or
+definitions, so that a set of them can be represented as a Python int with bit
+i set for the item numbered i.
+"""
+class Universe(object):
+    def __init__(self, items=()):
+        self.items = []
+        self.index = {}
+        for item in items:
+            self.add(item)
+
+    """
+    Numbers `item` if it is new, and returns its number.
+    """
+    def add(self, item):
+        if item not in self.index:
+            self.index[item] = len(self.items)
+            self.items.append(item)
+        return self.index[item]
+
+    """
+    Returns the bitset of the items in `items`, each of which must have been
+    added.
+    """
+    def bits(self, items):
+        bits = 0
+        for item in items:
+            bits |= 1 << self.index[item]
+        return bits
+
+    """
+    Returns the set of items in the bitset `bits`.
+    """
+    def members(self, bits):
+        # The binary digits of `bits`, least significant first.
+        digits = bin(bits)[:1:-1]
+        return set(self.items[i] for i, digit in enumerate(digits) if digit == "1")
+
+    """
+    Returns the bitset of every item.
+    """
+    def all(self):
+        return (1 << len(self.items)) - 1
+
+    def __len__(self):
+        return len(self.items)
+
+"""
+Returns the nodes of `graph` in reverse postorder from its root, followed by
+any nodes not reachable from the root, in the order of the graph.
+"""
+def reverse_postorder(graph):
+    graph.check_root()
+    order = []
+    seen = set([graph.root])
+    # Iterative depth first search, as functions may be deeper than the
+    # recursion limit.
+    stack = [(graph.root, iter(graph[graph.root]))]
+    while len(stack):
+        node, successors = stack[-1]
+        for successor in successors:
+            if successor not in seen:
+                seen.add(successor)
+                stack.append((successor, iter(graph[successor])))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    order.reverse()
+    order.extend(n for n in graph if n not in seen)
+    return order
+
+"""
+Solves a bit-vector dataflow problem over the nodes of `graph`, which must
+have a root.
+
+Each node n has the transfer function f(x) = gen[n] | (x & ~kill[n]), with
+`gen` and `kill` dictionaries mapping nodes to bitsets. A `direction` FORWARD
+problem flows from each node's predecessors to its successors, and a BACKWARD
+problem the other way. The values flowing into a node are combined with
+`meet`, UNION or INTERSECTION. `boundary` is the value flowing into the root,
+or, for a backward problem, into every node without successors, and `top` the
+starting value of every other node, usually 0 for UNION and every item for
+INTERSECTION.
+
+Nodes are visited from a worklist ordered by reverse postorder (postorder for
+backward problems), so each node is normally visited after the nodes flowing
+into it, and is only revisited when one of those changes.
+
+Returns the dictionaries `ins` and `outs` mapping each node to the value at
+its start and at its end.
+"""
+def solve(graph, gen, kill, direction=FORWARD, meet=UNION, boundary=0, top=0):
+    order = reverse_postorder(graph)
+    preds = dict((n, []) for n in graph)
+    for node in graph:
+        for successor in graph[node]:
+            preds[successor].append(node)
+    if direction == FORWARD:
+        sources, targets = preds, dict((n, list(graph[n])) for n in graph)
+        boundaries = set(n for n in graph if n == graph.root or not len(preds[n]))
+    else:
+        order.reverse()
+        sources, targets = dict((n, list(graph[n])) for n in graph), preds
+        boundaries = set(n for n in graph if not len(graph[n]))
+    priority = dict((node, idx) for idx, node in enumerate(order))
+
+    before = dict((n, top) for n in graph)
+    after = dict((n, gen[n] | (top & ~kill[n])) for n in graph)
+    worklist = [(priority[n], n) for n in order]
+    queued = set(graph)
+    while len(worklist):
+        _, node = heapq.heappop(worklist)
+        queued.discard(node)
+        value = boundary if node in boundaries else None
+        for source in sources[node]:
+            if value is None:
+                value = after[source]
+            elif meet == UNION:
+                value |= after[source]
+            else:
+                value &= after[source]
+        before[node] = value
+        new = gen[node] | (value & ~kill[node])
+        if new != after[node]:
+            after[node] = new
+            for target in targets[node]:
+                if target not in queued:
+                    queued.add(target)
+                    heapq.heappush(worklist, (priority[target], target))
+
+    if direction == FORWARD:
+        return before, after
+    return after, before
+
+"""
+Live variable analysis. Returns the dictionaries `live_in` and `live_out`
+mapping each block of `code` to the set of variables live at its start and end.
+
+`uses` and `defs` give the variables each statement reads and writes. By
+default every variable operand is used, and a predicated definition also uses
+its destination, which keeps its old value when the statement is not executed.
+Phi functions are treated as using all of their operands.
+"""
+def liveness(code, uses=None, defs=None):
+    uses = uses or _uses
+    defs = defs or _defs
+    universe = Universe()
+    gen = {}
+    kill = {}
+    for block in code["blocks"]:
+        block_gen = 0
+        block_kill = 0
+        for statement in block["code"]:
+            for var in uses(statement):
+                bit = 1 << universe.add(var)
+                if not block_kill & bit:
+                    block_gen |= bit
+            for var in defs(statement):
+                block_kill |= 1 << universe.add(var)
+        gen[block["name"]] = block_gen
+        kill[block["name"]] = block_kill
+    live_in, live_out = solve(_graph(code), gen, kill, BACKWARD, UNION)
+    return _members(universe, live_in), _members(universe, live_out)
+
+"""
+Reaching definitions. A definition is identified by the (block name, index)
+of the statement making it. Returns the dictionaries `reach_in` and
+`reach_out` mapping each block of `code` to the set of definitions reaching
+its start and end. A predicated definition does not remove the definitions it
+may replace.
+"""
+def reaching_definitions(code):
+    universe = Universe()
+    definitions = {}
+    for block in code["blocks"]:
+        for idx, statement in enumerate(block["code"]):
+            for var in _defs(statement):
+                bit = 1 << universe.add((block["name"], idx))
+                definitions[var] = definitions.get(var, 0) | bit
+    gen = {}
+    kill = {}
+    for block in code["blocks"]:
+        block_gen = 0
+        block_kill = 0
+        for idx, statement in enumerate(block["code"]):
+            for var in _defs(statement):
+                bit = 1 << universe.index[(block["name"], idx)]
+                if not is_predicated(statement):
+                    block_gen &= ~definitions[var]
+                    block_kill |= definitions[var]
+                block_gen |= bit
+        gen[block["name"]] = block_gen
+        kill[block["name"]] = block_kill & ~block_gen
+    reach_in, reach_out = solve(_graph(code), gen, kill, FORWARD, UNION)
+    return _members(universe, reach_in), _members(universe, reach_out)
+
+"""
+Available expressions. Each expression is identified by the key
+(op, operands, shift) of a data processing statement computing it, eg.
+("ADD", ("R1", "#4"), None). Returns the dictionaries `avail_in` and
+`avail_out` mapping each block of `code` to the set of expressions computed on
+every path to its start and end, with none of their operands redefined since.
+"""
+def available_expressions(code):
+    universe = Universe()
+    operands = {}
+    for block in code["blocks"]:
+        for statement in block["code"]:
+            key = expression_key(statement)
+            if key is not None:
+                bit = 1 << universe.add(key)
+                for var in key[1]:
+                    operands[var] = operands.get(var, 0) | bit
+    gen = {}
+    kill = {}
+    for block in code["blocks"]:
+        block_gen = 0
+        block_kill = 0
+        for statement in block["code"]:
+            key = expression_key(statement)
+            if key is not None:
+                block_gen |= 1 << universe.index[key]
+            for var in _defs(statement):
+                killed = operands.get(var, 0)
+                block_gen &= ~killed
+                block_kill |= killed
+        gen[block["name"]] = block_gen
+        kill[block["name"]] = block_kill
+    avail_in, avail_out = solve(_graph(code), gen, kill, FORWARD, INTERSECTION,
+                                boundary=0, top=universe.all())
+    return _members(universe, avail_in), _members(universe, avail_out)
+
+"""
+Returns the key identifying the expression computed by `statement`, or None
+if it is not an unconditional data processing statement.
+"""
+def expression_key(statement):
+    base, condition, flags = split_op(statement["op"])
+    if base not in DATA_PROCESSING_OPS or base in ("MOV", "MVN") or condition or flags:
+        return None
+    srcs = sorted(x for x in statement if x.startswith("src"))
+    return (base, tuple(statement[x] for x in srcs), statement.get("shift"))
+
+def _uses(statement):
+    uses = [statement[x] for x in statement if x.startswith("src") and is_var(statement[x])]
+    if is_predicated(statement):
+        uses.extend(_defs(statement))
+    return uses
+
+def _defs(statement):
+    if "dest" in statement and is_var(statement["dest"]):
+        return [statement["dest"]]
+    return []
+
+def _graph(code):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    return graph
+
+def _members(universe, values):
+    return dict((node, universe.members(values[node])) for node in values)
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        live_in, live_out = liveness(code)
+        print json.dumps(dict((b, sorted(live_in[b])) for b in live_in), indent=4)
+
+if __name__ == "__main__":
+    main()
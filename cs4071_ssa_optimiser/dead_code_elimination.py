@@ -4,7 +4,8 @@ from util import (get_variables,
                   is_var,
                   remove_marked_statements)
 
-NO_SIDE_EFFECTS = ["MOV", "ADD", "SUB", "RSB", "MUL"]
+NO_SIDE_EFFECTS = ["MOV", "MVN", "ADD", "SUB", "RSB", "MUL", "MLA", "AND", "ORR",
+                   "EOR", "BIC", "LSL", "LSR", "ASR", "ROR"]
 
 """
 Simple (non-aggressive) dead-code elimination using the algorithm from
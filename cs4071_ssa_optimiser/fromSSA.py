@@ -1,6 +1,18 @@
 import json
 
 import graphs
+from util import split_op
+
+"""
+Inserts `statement` into the list of statements `block` before the branches
+ending it, eg. before both the BLT and the B of a block ending BLT, B, so that
+it is executed whichever successor is taken.
+"""
+def insertBeforeBranches(block, statement):
+    index = len(block)
+    while index > 0 and split_op(block[index - 1]["op"])[0] == "B":
+        index -= 1
+    block.insert(index, statement)
 
 """
 Removes constant parameters to phi-functions, by creating temporary variables in the corresponding
@@ -20,11 +32,7 @@ def fixConstants(code, graph, blocks):
                             insertBlock = blocks[graph.pred(b["name"]).keys()[index]]["code"]
                             toInsert = {"op": "MOV", "dest": "ConstFix" + str(fixed), "src": op[part]}
 
-                            # Make sure to insert before branch
-                            if len(insertBlock) > 0 and insertBlock[-1]["op"].startswith("B"):
-                                insertBlock.insert(-1, toInsert )
-                            else:
-                                insertBlock.append(toInsert)
+                            insertBeforeBranches(insertBlock, toInsert)
 
                             op[part] = "ConstFix" + str(fixed)
 
@@ -48,11 +56,7 @@ def toCSSA(code, graph, blocks):
                         insertBlock = blocks[graph.pred(b["name"]).keys()[index]]["code"]
                         toInsert = {"op": "MOV", "dest": "CSSACopy" + str(copies), "src": op[part]}
                         
-                        # Make sure to insert before branch
-                        if len(insertBlock) > 0 and insertBlock[-1]["op"].startswith("B"):
-                            insertBlock.insert(-1, toInsert )
-                        else:
-                            insertBlock.append(toInsert)
+                        insertBeforeBranches(insertBlock, toInsert)
 
                         op[part] = "CSSACopy" + str(copies)
                         copies += 1
@@ -136,7 +140,7 @@ def coalescePhis(code):
                 if (part == "dest" or part.startswith("src")) and b["code"][i][part] in mappings:
                     b["code"][i][part] = mappings[b["code"][i][part]]
         
-        for i in toremove:
+        for i in reversed(toremove):
             del b["code"][i]
 
 
@@ -0,0 +1,117 @@
+import json
+from ssa import toSSA
+from util import (build_graph,
+                  is_copy)
+
+NUMBERED_OPS = ["ADD", "MUL", "SUB", "RSB", "LSL", "phi"]
+COMMUTATIVE_OPS = ["ADD", "MUL"]
+
+"""
+Dominator-based global value numbering as described in the SSA Optimization
+Algorithms handout.
+
+Transforms `code` in place. Walks the dominator tree from the entry block,
+keeping a hash table mapping expressions to the first variable found to hold
+their value. Any statement recomputing an expression that is already held by
+a variable defined in a dominating block is replaced with a copy of that
+variable, eg.
+
+    ADD R2-1, R0-0, R1-0            ADD R2-1, R0-0, R1-0
+    ...                     --->    ...
+    ADD R3-1, R1-0, R0-0            MOV R3-1, R2-1
+
+Commutative operations (ADD, MUL) have their operands sorted and RSB is
+rewritten as the equivalent SUB before hashing, so that both spellings of an
+expression receive the same value number.
+
+Entries are removed from the table as soon as the walk leaves the dominator
+subtree of the block that added them, so the table only ever holds the
+expressions available along the current path of the tree.
+
+The copies introduced are left for copy propagation to clean up.
+"""
+def global_value_numbering(code):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    tree = graph.dominator_tree()
+    blocks = {b["name"]: b for b in code["blocks"]}
+    _number_block(tree, blocks, graph.root, {}, {})
+
+"""
+Value numbers every statement of `block` and then recursively each block it
+immediately dominates. `table` maps expression keys to the variable holding
+them, `numbers` maps variables to the value number they were given.
+"""
+def _number_block(tree, blocks, block, table, numbers):
+    added = []
+    for statement in blocks[block]["code"]:
+        if "dest" not in statement:
+            continue
+        if is_copy(statement) and "src2" not in statement:
+            numbers[statement["dest"]] = _value_number(statement["src1"], numbers)
+            continue
+        key = _expression_key(statement, block, numbers)
+        if key is None:
+            continue
+        if key in table:
+            _replace_with_copy(statement, table[key])
+            numbers[statement["dest"]] = table[key]
+        else:
+            table[key] = statement["dest"]
+            added.append(key)
+    for child in tree[block]:
+        _number_block(tree, blocks, child, table, numbers)
+    # Leaving this subtree, its expressions are no longer available.
+    for key in added:
+        del table[key]
+
+"""
+Returns a hashable key identifying the value computed by `statement`, or None
+if the statement cannot be value numbered. Phi functions are only equivalent
+to other phi functions in the same block.
+"""
+def _expression_key(statement, block, numbers):
+    op = statement["op"]
+    if op not in NUMBERED_OPS:
+        return None
+    srcs = sorted(x for x in statement if x.startswith("src"))
+    operands = [_value_number(statement[x], numbers) for x in srcs]
+    if op == "phi":
+        return (op, block, tuple(zip(srcs, operands)))
+    if len(operands) != 2:
+        return None
+    if "shift" in statement:
+        # Only the second operand is shifted, so the operands cannot be swapped.
+        return (op, tuple(operands), statement["shift"])
+    if op == "RSB":
+        op = "SUB"
+        operands.reverse()
+    if op in COMMUTATIVE_OPS:
+        operands.sort()
+    return (op, tuple(operands))
+
+"""
+Returns the value number of `val`. Constants are their own value number.
+"""
+def _value_number(val, numbers):
+    return numbers.get(val, val)
+
+"""
+Rewrites `statement` in place as a copy of `val`.
+"""
+def _replace_with_copy(statement, val):
+    for field in [x for x in statement if x != "dest"]:
+        del statement[field]
+    statement["op"] = "MOV"
+    statement["src1"] = val
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        global_value_numbering(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
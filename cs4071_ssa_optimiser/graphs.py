@@ -1,6 +1,7 @@
 from __future__ import print_function
 import copy
 
+import numpy_backend
 from ordered_set import *
 
 
@@ -12,6 +13,8 @@ class Graph(dict):
     def __init__(self):
         self.root = None
         self.dominator_sets = None
+        self.loop_sets = None
+        self.frontier_sets = None
         super(dict, self)
 
     """
@@ -23,8 +26,10 @@ class Graph(dict):
         if node not in self:
             raise GraphException("Cannot set root to node not in graph")
         if node != self.root:
-            #Invalidate dominators if we're changing root
+            #Invalidate dominators and loops if we're changing root
             self.dominator_sets = None
+            self.loop_sets = None
+            self.frontier_sets = None
         self.root = node
 
     """
@@ -34,6 +39,8 @@ class Graph(dict):
     def add_nodes(self, *nodes):
         for node in [node for node in nodes if node not in self]:
             self.dominator_sets = None
+            self.loop_sets = None
+            self.frontier_sets = None
             self[node] = OrderedSet()
 
     """
@@ -48,6 +55,8 @@ class Graph(dict):
                 raise GraphException("Cannot add edge {} to graph. One or more vertices mentioned does not exist.".format(edge))
             if edge[0] != edge[1]:
                 self.dominator_sets = None
+                self.loop_sets = None
+                self.frontier_sets = None
                 self[edge[0]].add(edge[1])
 
     def remove_edges(self, *edges):
@@ -55,6 +64,8 @@ class Graph(dict):
             if edge[0] not in self or edge[1] not in self:
                 raise GraphException("Cannot remove edge {} from graph. One or more vertices mentioned does not exist.".format(edge))
             self.dominator_sets = None
+            self.loop_sets = None
+            self.frontier_sets = None
             self[edge[0]].remove(edge[1])
 
     """
@@ -77,7 +88,9 @@ class Graph(dict):
 
         https://en.wikipedia.org/wiki/Dominator_%28graph_theory%29
 
-    Used because implementing Lengauer-Tarjan was too much effort.
+    Used because implementing Lengauer-Tarjan was too much effort. Graphs of
+    at least numpy_backend.THRESHOLD nodes are handled by NumPy instead, when
+    it is installed.
 
     Requires you to have set a root node for the graph.
 
@@ -85,6 +98,9 @@ class Graph(dict):
     """
     def dominators(self):
         self.check_root()
+        if numpy_backend.enabled(len(self)):
+            self.dominator_sets = numpy_backend.dominators(self)
+            return self.dominator_sets
         dominators = {}
         temp = None
 
@@ -132,12 +148,12 @@ class Graph(dict):
     def idom(self, node):
         if not self.dominator_sets:
             self.dominators()
-        strict_doms = [n for n in self if self.strict_dom(n, node)]
-        for dom in strict_doms:
-            if len([n for n in strict_doms if self.strict_dom(dom, n)]):
-                continue
-            else:
-                return dom
+        strict_doms = [n for n in self.dominator_sets[node] if n != node]
+        if not len(strict_doms):
+            return None
+        # Dominators of a node form a chain, so the immediate dominator is
+        # the strict dominator which itself has the most dominators.
+        return max(strict_doms, key=lambda n: len(self.dominator_sets[n]))
 
     """
     Returns the dominator tree of the graph it is called upon where
@@ -150,9 +166,10 @@ class Graph(dict):
         self.check_root()
         dominator_tree = Graph()
         dominator_tree.add_nodes(*self.keys())
-        for node1 in self:
-            edges = [(node1, node2) for node2 in self if self.idom(node2) == node1]
-            dominator_tree.add_edges(*edges)
+        for node in self:
+            idom = self.idom(node)
+            if idom is not None:
+                dominator_tree.add_edges((idom, node))
         return dominator_tree
 
     """
@@ -165,12 +182,113 @@ class Graph(dict):
         return set(frontier)
 
     """
-    Computes the dominance frontiers of all nodes in the graph.
+    Computes the dominance frontiers of all nodes in the graph. The result is
+    kept until the graph is changed.
 
     Throws GraphException if no root node has been set.
     """
     def dominance_frontiers(self):
-        return {node: self.dominance_frontier(node) for node in self}
+        if self.frontier_sets is None:
+            self.frontier_sets = {node: self.dominance_frontier(node) for node in self}
+        return self.frontier_sets
+
+    """
+    Returns the set of nodes reachable from the given node, including itself.
+    """
+    def reachable(self, node):
+        seen = set([node])
+        worklist = [node]
+        while len(worklist):
+            for next_node in self[worklist.pop()]:
+                if next_node not in seen:
+                    seen.add(next_node)
+                    worklist.append(next_node)
+        return seen
+
+    """
+    Returns a dictionary mapping each node to the set of nodes reachable from
+    it, including itself.
+    """
+    def reachability(self):
+        if numpy_backend.enabled(len(self)):
+            return numpy_backend.reachability(self)
+        return {node: self.reachable(node) for node in self}
+
+    """
+    Returns a list of all back edges in the graph, edges (n, h) where h
+    dominates n. Only nodes reachable from the root are considered.
+
+    Throws GraphException if no root node has been set.
+    """
+    def back_edges(self):
+        self.check_root()
+        reachable = self.reachable(self.root)
+        return [(n, h) for n in self if n in reachable for h in self[n] if self.dom(h, n)]
+
+    """
+    Finds the natural loops of the graph. Returns a dictionary mapping each
+    loop header to the set of nodes in the loop, including the header. Natural
+    loops sharing a header are merged into a single loop.
+
+    The result is cached until the graph is next modified.
+
+    Throws GraphException if no root node has been set.
+    """
+    def loops(self):
+        if self.loop_sets is not None:
+            return self.loop_sets
+        loops = {}
+        back_edges = self.back_edges()
+        reachable = self.reachable(self.root)
+        for latch, header in back_edges:
+            body = loops.setdefault(header, set([header]))
+            worklist = [latch]
+            while len(worklist):
+                node = worklist.pop()
+                if node not in body:
+                    body.add(node)
+                    worklist.extend([p for p in self.pred(node) if p in reachable])
+        self.loop_sets = loops
+        return loops
+
+    """
+    Returns the loop nesting forest of the graph, a graph whose nodes are loop
+    headers and where each loop header's children are the headers of the
+    loops nested immediately inside its loop.
+
+    Throws GraphException if no root node has been set.
+    """
+    def loop_nesting_forest(self):
+        loops = self.loops()
+        forest = Graph()
+        forest.add_nodes(*loops.keys())
+        for header in loops:
+            parent = self.loop_parent(header)
+            if parent is not None:
+                forest.add_edges((parent, header))
+        return forest
+
+    """
+    Finds the header of the innermost loop strictly enclosing the loop headed
+    by `header`, or None if the loop is outermost.
+
+    Throws GraphException if no root node has been set.
+    """
+    def loop_parent(self, header):
+        loops = self.loops()
+        enclosing = [h for h in loops if h != header and header in loops[h]]
+        if not len(enclosing):
+            return None
+        return min(enclosing, key=lambda h: len(loops[h]))
+
+    """
+    Returns the number of loops containing the given node.
+
+    Throws GraphException if no root node has been set.
+    """
+    def loop_depth(self, node):
+        loops = self.loops()
+        return len([h for h in loops if node in loops[h]])
 
     """
     Reverses all edges in the graph, returning the new reversed
@@ -184,8 +302,9 @@ class Graph(dict):
         reverse = Graph()
         reverse.add_nodes(*self.keys())
         for node1 in self:
-            edges = [(node1, node2) for node2 in self if node1 in self[node2]]
-            reverse.add_edges(*edges)
+            for node2 in self[node1]:
+                if node1 != node2:
+                    reverse[node2].add(node1)
         if reverse_root is not None:
             if reverse_root not in self:
                 raise GraphException("Node {} does not exist in the reverse graph".format(reverse_root))
@@ -193,6 +312,22 @@ class Graph(dict):
                 reverse.set_root(reverse_root)
         return reverse
 
+    """
+    Returns the reverse of the graph with an extra root node `exit`, which has
+    an edge to every node without successors. A node dominates another in the
+    returned graph if it post-dominates it in this graph.
+
+    Throws GraphException if `exit` already exists within the graph.
+    """
+    def post_dominance_graph(self, exit=u"exit"):
+        if exit in self:
+            raise GraphException("Cannot add exit node {} already in graph".format(exit))
+        reverse_graph = self.reverse()
+        reverse_graph.add_nodes(exit)
+        reverse_graph.add_edges(*[(exit, node) for node in self if not len(self[node])])
+        reverse_graph.set_root(exit)
+        return reverse_graph
+
     def find_root_candidates(self):
         candidates = self.nodeset()
         for candidate in candidates:
@@ -213,6 +348,11 @@ class Graph(dict):
         graph.add_edges(*edges)
         reverse_graph = graph.reverse()
         rg_starts = reverse_graph.find_root_candidates()
+        if len(rg_starts) > 1:
+            # Join the exits at a single node, so the reverse graph has a root.
+            reverse_graph.add_nodes(u"exit")
+            reverse_graph.add_edges(*[(u"exit", g) for g in rg_starts])
+            rg_starts = [u"exit"]
         edges = [(g, u"start") for g in rg_starts]
         reverse_graph.add_edges(*edges)
         cdg = Graph()
@@ -221,8 +361,100 @@ class Graph(dict):
         for node in rdf:
             edges = [(e, node) for e in rdf[node]]
             cdg.add_edges(*edges)
+            # add_edges ignores self loops, but a node which decides whether
+            # it is executed again is control dependent on itself.
+            if node in rdf[node]:
+                cdg[node].add(node)
         return cdg
 
+    """
+    Finds the canonical single entry single exit (SESE) regions of the graph
+    and returns its program structure tree, as described by Johnson, Pearson
+    and Pingali in "The program structure tree: computing control regions in
+    linear time" (PLDI 1994).
+
+    A region is entered only through its entry edge and left only through
+    its exit edge, so it can be analysed or transformed apart from the rest of
+    the graph. Canonical regions are nested or disjoint. The returned Region
+    is the whole graph, its entry edge (None, root) and its exit None, and its
+    children are the outermost canonical regions, in the order they are
+    reached from the root. Edges out of exits are given as (node, None).
+
+    Only nodes reachable from the root are considered. Nodes from which no
+    exit can be reached are treated as exits too, so they are only placed in
+    regions which also hold the loops they are stuck in.
+
+    Throws GraphException if no root node has been set.
+    """
+    def program_structure_tree(self):
+        self.check_root()
+        reachable = self.reachable(self.root)
+        nodes = [n for n in self if n in reachable]
+        exits = [n for n in nodes if not len([s for s in self[n] if s != n])]
+        reverse = self.reverse()
+        finishing = set(exits)
+        worklist = list(exits)
+        while len(worklist):
+            for pred in reverse[worklist.pop()]:
+                if pred not in finishing:
+                    finishing.add(pred)
+                    worklist.append(pred)
+
+        # Augment the graph with a start node leading to the root and an end
+        # node reached from every exit and leading back to the start, so
+        # that it is strongly connected.
+        edges = [(_START, self.root)]
+        edges.extend((n, s) for n in nodes for s in self[n] if s != n)
+        edges.extend((n, _END) for n in nodes if n in exits or n not in finishing)
+        edges.append((_END, _START))
+        classes = _cycle_equivalence(edges, _START)
+
+        successors = {}
+        for i, (node1, node2) in enumerate(edges):
+            successors.setdefault(node1, []).append(i)
+        # Edges of a class are ordered by dominance, which is the order a
+        # depth first search first examines them in. Each pair of edges
+        # consecutive in this order bounds a canonical region.
+        examined = []
+        seen = set([_START])
+        stack = [iter(successors[_START])]
+        while len(stack):
+            for i in stack[-1]:
+                examined.append(i)
+                if edges[i][1] not in seen:
+                    seen.add(edges[i][1])
+                    stack.append(iter(successors[edges[i][1]]))
+                    break
+            else:
+                stack.pop()
+        last = {}
+        regions = []
+        for i in examined:
+            if classes[i] in last:
+                entry, exit = edges[last[classes[i]]], edges[i]
+                inside = _region_nodes(successors, edges, entry[1], exit)
+                inside.discard(_START)
+                inside.discard(_END)
+                if len(inside) and len(inside) < len(nodes):
+                    regions.append(Region(_edge(entry), _edge(exit), inside))
+            last[classes[i]] = i
+
+        # Nest the regions, smallest first, each node belonging to the
+        # outermost region found so far containing it.
+        root = Region((None, self.root), None, reachable)
+        owner = {}
+        for region in sorted(regions, key=lambda r: len(r.nodes)) + [root]:
+            for node in region.nodes:
+                inner = owner.get(node)
+                if inner is not None and inner.parent is None:
+                    inner.parent = region
+                    region.children.append(inner)
+                owner[node] = region
+        position = dict((region, i) for i, region in enumerate(regions))
+        for region in regions + [root]:
+            region.children.sort(key=lambda r: position[r])
+        return root
+
     def check_root(self):
         if self.root is None:
             candidates = self.find_root_candidates()
@@ -260,6 +492,203 @@ class Graph(dict):
         return False
 
 
+"""
+A single entry single exit region of a Graph, found by
+Graph.program_structure_tree.
+
+    entry     the edge (node1, node2) entering the region, node1 being None
+              for the edge into the root
+    exit      the edge leaving the region, node2 being None for an edge out
+              of an exit, or None if the region holds every exit
+    nodes     the set of nodes in the region, including those of the regions
+              nested in it
+    parent    the smallest region strictly containing it, or None
+    children  the largest regions nested in it, in the order they are reached
+"""
+class Region(object):
+    def __init__(self, entry, exit, nodes):
+        self.entry = entry
+        self.exit = exit
+        self.nodes = nodes
+        self.parent = None
+        self.children = []
+
+    def __repr__(self):
+        return "Region({!r}, {!r}, {} nodes)".format(self.entry, self.exit, len(self.nodes))
+
+# The start and end nodes added when finding the SESE regions of a graph,
+# distinct from any node of the graph.
+_START = object()
+_END = object()
+
+def _edge(edge):
+    if edge == (_END, _START):
+        return None
+    return tuple(None if n is _START or n is _END else n for n in edge)
+
+"""
+Returns the nodes reached from `node` through the edges in `successors`
+without following the edge `exit`.
+"""
+def _region_nodes(successors, edges, node, exit):
+    nodes = set([node])
+    worklist = [node]
+    while len(worklist):
+        for i in successors.get(worklist.pop(), []):
+            if edges[i] != exit and edges[i][1] not in nodes:
+                nodes.add(edges[i][1])
+                worklist.append(edges[i][1])
+    return nodes
+
+class _Bracket(object):
+    __slots__ = ["edge", "prev", "next", "recent_size", "recent_class"]
+
+    def __init__(self, edge):
+        self.edge = edge
+        self.prev = None
+        self.next = None
+        self.recent_size = None
+        self.recent_class = None
+
+"""
+A doubly linked list of brackets, which can be concatenated and have any of
+its brackets deleted in constant time.
+"""
+class _BracketList(object):
+    def __init__(self):
+        self.top = None
+        self.bottom = None
+        self.size = 0
+
+    def push(self, bracket):
+        bracket.prev = None
+        bracket.next = self.top
+        if self.top is not None:
+            self.top.prev = bracket
+        else:
+            self.bottom = bracket
+        self.top = bracket
+        self.size += 1
+
+    def concat(self, other):
+        if not other.size:
+            return
+        if self.top is None:
+            self.top = other.top
+        else:
+            self.bottom.next = other.top
+            other.top.prev = self.bottom
+        self.bottom = other.bottom
+        self.size += other.size
+
+    def delete(self, bracket):
+        if bracket.prev is not None:
+            bracket.prev.next = bracket.next
+        else:
+            self.top = bracket.next
+        if bracket.next is not None:
+            bracket.next.prev = bracket.prev
+        else:
+            self.bottom = bracket.prev
+        self.size -= 1
+
+"""
+Divides the edges of a strongly connected graph into cycle equivalence
+classes, with the bracket set algorithm of Johnson, Pearson and Pingali.
+`edges` is a list of edges (node1, node2), and `start` any node. Returns a
+list of the class of each edge, numbered from 0.
+
+The algorithm works on the undirected graph. A depth first search divides its
+edges into tree edges and back edges, and the brackets of a tree edge are the
+back edges from its subtree to above it. Two edges are cycle equivalent if
+they have the same set of brackets, which is tracked by the size and top of
+the list of brackets of each node's subtree.
+"""
+def _cycle_equivalence(edges, start):
+    adjacent = {}
+    for i, (node1, node2) in enumerate(edges):
+        if node1 != node2:
+            adjacent.setdefault(node1, []).append((i, node2))
+            adjacent.setdefault(node2, []).append((i, node1))
+    number = {start: 0}
+    order = [start]
+    parent_edge = {start: None}
+    children = {start: []}
+    up = dict((node, []) for node in adjacent)
+    down = dict((node, []) for node in adjacent)
+    stack = [(start, iter(adjacent.get(start, [])))]
+    while len(stack):
+        node, neighbours = stack[-1]
+        for i, other in neighbours:
+            if i == parent_edge[node]:
+                continue
+            if other not in number:
+                number[other] = len(order)
+                order.append(other)
+                parent_edge[other] = i
+                children[other] = []
+                children[node].append(other)
+                stack.append((other, iter(adjacent[other])))
+                break
+            if number[other] < number[node]:
+                up[node].append((i, other))
+                down[other].append(i)
+        else:
+            stack.pop()
+
+    classes = [None] * len(edges)
+    counter = [0]
+
+    def new_class():
+        counter[0] += 1
+        return counter[0] - 1
+
+    brackets = {}
+    capping = dict((node, []) for node in order)
+    lists = {}
+    hi = {}
+    for node in reversed(order):
+        hi0 = min([number[other] for _, other in up[node]] or [len(order)])
+        child_his = sorted((hi[c], c) for c in children[node])
+        hi1 = child_his[0][0] if len(child_his) else len(order)
+        hi2 = child_his[1][0] if len(child_his) > 1 else len(order)
+        hi[node] = min(hi0, hi1)
+
+        blist = _BracketList()
+        for child in children[node]:
+            blist.concat(lists.pop(child))
+        for bracket in capping[node]:
+            blist.delete(bracket)
+        for i in down[node]:
+            blist.delete(brackets[i])
+            if classes[i] is None:
+                classes[i] = new_class()
+        for i, _ in up[node]:
+            brackets[i] = _Bracket(i)
+            blist.push(brackets[i])
+        if hi2 < hi0 and hi2 < number[node]:
+            # Brackets from two subtrees pass above the node, so cap them.
+            bracket = _Bracket(None)
+            blist.push(bracket)
+            capping[order[hi2]].append(bracket)
+        lists[node] = blist
+
+        if parent_edge[node] is not None:
+            bracket = blist.top
+            if bracket is None:
+                classes[parent_edge[node]] = new_class()
+                continue
+            if bracket.recent_size != blist.size:
+                bracket.recent_size = blist.size
+                bracket.recent_class = new_class()
+            classes[parent_edge[node]] = bracket.recent_class
+            if bracket.recent_size == 1 and bracket.edge is not None:
+                classes[bracket.edge] = bracket.recent_class
+    for i in range(len(classes)):
+        if classes[i] is None:
+            classes[i] = new_class()
+    return classes
+
 """
 Convenience class. Set-like object defining - operator
 as set difference.
@@ -282,6 +711,7 @@ def main():
 
     print(graph.dominance_frontiers())
     print(graph.reverse("exit").dominance_frontiers())
+    print(graph.loops())
 
 if __name__ == "__main__":
     main()
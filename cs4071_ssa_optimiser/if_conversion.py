@@ -0,0 +1,132 @@
+import json
+from ssa import toSSA
+from fromSSA import fromSSA
+from util import (build_graph,
+                  get_blocks,
+                  new_block_name,
+                  branch_condition,
+                  split_op,
+                  DATA_PROCESSING_OPS,
+                  INVERSE_CONDITIONS)
+
+# Largest number of statements predicated to remove a single branch.
+MAX_PREDICATED = 4
+
+PREDICABLE_OPS = DATA_PROCESSING_OPS + ["LDR", "STR"]
+
+"""
+If-conversion to ARM conditional execution, for code that has been converted
+out of SSA form.
+
+Transforms `code` in place. Finds blocks ending in a conditional branch whose
+successors rejoin at the branch's immediate post-dominator after at most one
+block on each side, and moves the statements of those blocks into the
+branching block, predicated on the condition under which they were executed:
+
+    b1: CMP R1, #0                       b1: CMP R1, #0
+        BEQ b2                               MOVEQ R2, #1
+    b2: MOV R2, #1               --->        ADDNE R2, R3, #4
+    b3: ADD R2, R3, #4                   b4: ...
+    b4: ...
+
+A side is only converted if the branching block is its only predecessor and
+the join its only successor, and none of its statements already have a
+condition or set the flags, so the flags tested stay the same for every
+predicated statement. Where more than `max_size` statements would be
+predicated the branch is kept. If the blocks have counts from
+block_profile.attach_profile, up to twice as many statements may be predicated
+as long as on average at most `max_size / 2` of them are skipped each time the
+branch is executed, so that branches which almost always go the same way are
+kept. Nested hammocks are converted innermost first;
+an outer branch around predicated statements is kept.
+"""
+def if_conversion(code, max_size=MAX_PREDICATED):
+    changed = True
+    while changed:
+        changed = False
+        graph = build_graph(code)
+        exit = new_block_name(code, "exit")
+        post_dominators = graph.post_dominance_graph(exit)
+        blocks = get_blocks(code)
+        for block in code["blocks"]:
+            if _convert_hammock(code, graph, post_dominators, exit, blocks, block, max_size):
+                changed = True
+                break
+
+"""
+Predicates the sides of the hammock branching at `block`, if it is one.
+Returns true if `code` was changed.
+"""
+def _convert_hammock(code, graph, post_dominators, exit, blocks, block, max_size):
+    statements = _without_jumps(block)
+    if (len(block["next_block"]) != 2 or not len(statements) or
+            not branch_condition(statements[-1])):
+        return False
+    join = post_dominators.idom(block["name"])
+    if join is None or join == exit:
+        return False
+    condition = branch_condition(statements[-1])
+    sides = []
+    for target, side_condition in zip(block["next_block"],
+                                      [condition, INVERSE_CONDITIONS[condition]]):
+        if target == join:
+            continue
+        side = code["blocks"][blocks[target]]
+        if (target == code["starting_block"][0] or side["next_block"] != [join] or
+                list(graph.pred(target)) != [block["name"]]):
+            return False
+        body = _without_jumps(side)
+        if not all(_is_predicable(s) for s in body):
+            return False
+        sides.append((target, body, side_condition))
+    if not len(sides) or not _worth_predicating(code, blocks, block, sides, max_size):
+        return False
+
+    block["code"] = statements[:-1]
+    for _, body, side_condition in sides:
+        for statement in body:
+            statement["op"] = split_op(statement["op"])[0] + side_condition
+            block["code"].append(statement)
+    block["next_block"] = [join]
+    removed = [name for name, _, _ in sides]
+    code["blocks"][:] = [b for b in code["blocks"] if b["name"] not in removed]
+    return True
+
+"""
+True if predicating the statements of `sides` in `block` is expected to be
+cheaper than keeping the branch, following the limits of if_conversion.
+"""
+def _worth_predicating(code, blocks, block, sides, max_size):
+    size = sum(len(body) for _, body, _ in sides)
+    executed = block.get("count")
+    counts = [code["blocks"][blocks[target]].get("count") for target, _, _ in sides]
+    if not executed or None in counts:
+        return size <= max_size
+    skipped = sum(len(body) * (executed - min(count, executed))
+                  for (_, body, _), count in zip(sides, counts))
+    return size <= 2 * max_size and skipped <= executed * max_size / 2.0
+
+"""
+True if `statement` may be given a condition code.
+"""
+def _is_predicable(statement):
+    base, condition, sets_flags = split_op(statement["op"])
+    return base in PREDICABLE_OPS and condition is None and not sets_flags
+
+def _without_jumps(block):
+    statements = list(block["code"])
+    while len(statements) and statements[-1]["op"] == "B":
+        statements.pop()
+    return statements
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        fromSSA(code)
+        if_conversion(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import copy
+import json
+from pipeline import load_pass, PIPELINE
+from ssa import toSSA
+from util import build_graph
+
+"""
+Optimises successive versions of a function, such as a function being edited,
+reusing what was computed for the previous version.
+
+Each call to `optimise` compares the function with the previous version block
+by block. An unchanged function is given the previous result straight away.
+Otherwise the dominators and dominance frontiers of its control flow graph are
+only recomputed for the blocks an edit can affect, and used to convert it to
+SSA form, before the rest of `passes` are run over the whole function as
+usual. `passes` must start with toSSA.
+
+If `check` is set, every result is compared with that of optimising the
+function from scratch, raising AssertionError if they differ.
+
+The number of functions optimised each way is counted in `stats`.
+"""
+class IncrementalOptimiser(object):
+    def __init__(self, passes=PIPELINE, check=False):
+        if not len(passes) or passes[0] != "toSSA":
+            raise ValueError("Incremental optimisation must start with toSSA")
+        self.passes = passes
+        self.check = check
+        self.previous = None
+        self.result = None
+        self.graph = None
+        self.stats = {"unchanged": 0, "incremental": 0, "full": 0}
+
+    """
+    Optimises `code` in place and returns it.
+    """
+    def optimise(self, code):
+        original = copy.deepcopy(code)
+        if original == self.previous:
+            self.stats["unchanged"] += 1
+            code.clear()
+            code.update(copy.deepcopy(self.result))
+            return code
+
+        graph = self._graph(code)
+        toSSA(code, graph)
+        for name in self.passes[1:]:
+            load_pass(name)(code)
+
+        if self.check:
+            expected = copy.deepcopy(original)
+            for name in self.passes:
+                load_pass(name)(expected)
+            if code != expected:
+                raise AssertionError("Incremental optimisation differs from a full run")
+        self.previous = original
+        self.result = copy.deepcopy(code)
+        self.graph = graph
+        return code
+
+    """
+    Returns the control flow graph of `code` with its dominators and dominance
+    frontiers, updated from those of the previous version where possible.
+    """
+    def _graph(self, code):
+        graph = build_graph(code)
+        graph.set_root(code["blocks"][0]["name"])
+        if self.graph is None or self.graph.root != graph.root:
+            self.stats["full"] += 1
+            graph.dominance_frontiers()
+            return graph
+        self.stats["incremental"] += 1
+        edges = changed_edges(self.previous, code)
+        affected = update_dominators(self.graph, graph, edges)
+        update_frontiers(self.graph, graph, edges, affected)
+        return graph
+
+"""
+Compares two versions of a function block by block. Returns the names of the
+blocks only in `new`, those only in `old`, and those in both whose code or
+successors differ.
+"""
+def diff_blocks(old, new):
+    old_blocks = dict((b["name"], b) for b in old["blocks"])
+    new_blocks = dict((b["name"], b) for b in new["blocks"])
+    added = set(new_blocks) - set(old_blocks)
+    removed = set(old_blocks) - set(new_blocks)
+    changed = set(name for name in new_blocks if name in old_blocks and
+                  (new_blocks[name]["code"] != old_blocks[name]["code"] or
+                   new_blocks[name]["next_block"] != old_blocks[name]["next_block"]))
+    return added, removed, changed
+
+"""
+Returns the set of control flow edges in one of the functions `old` and `new`
+but not the other.
+"""
+def changed_edges(old, new):
+    added, removed, changed = diff_blocks(old, new)
+    edges = set()
+    for code, names in [(old, removed | changed), (new, added | changed)]:
+        for block in code["blocks"]:
+            if block["name"] in names:
+                edges.symmetric_difference_update(
+                    (block["name"], successor) for successor in set(block["next_block"]))
+    return edges
+
+"""
+Sets the dominators of `graph`, the control flow graph of a new version of the
+function whose previous version had the graph `old_graph`, differing by the
+edges `edges`. Dominators are copied from `old_graph` for nodes which no path
+through a changed edge reaches, as every path to them is the same in both
+graphs, and recomputed for the rest. Returns the set of recomputed nodes.
+
+Gives the same dominators as Graph.dominators.
+"""
+def update_dominators(old_graph, graph, edges):
+    old_dominators = old_graph.dominator_sets
+    affected = set(n for n in graph if n not in old_dominators)
+    affected |= set(graph) - graph.reachable(graph.root)
+    for _, target in edges:
+        if target in graph:
+            affected |= graph.reachable(target)
+        if target in old_graph:
+            affected |= set(n for n in old_graph.reachable(target) if n in graph)
+    affected.discard(graph.root)
+
+    nodes = graph.nodeset()
+    dominators = dict((n, old_dominators[n]) for n in graph if n not in affected)
+    dominators[graph.root] = set([graph.root])
+    preds = dict((n, []) for n in graph)
+    for node in graph:
+        for successor in graph[node]:
+            preds[successor].append(node)
+    for node in affected:
+        dominators[node] = nodes
+
+    order = [n for n in graph if n in affected]
+    changed = True
+    while changed:
+        changed = False
+        for node in order:
+            predom = nodes
+            for pred in preds[node]:
+                predom = predom.intersection(dominators[pred])
+            new = set([node]).union(predom)
+            if new != dominators[node]:
+                dominators[node] = new
+                changed = True
+
+    graph.dominator_sets = dominators
+    return affected
+
+"""
+Sets the dominance frontiers of `graph`, whose dominators have been set by
+`update_dominators` recomputing the nodes `affected`. The frontier of a node
+can only change if it dominates, before or after the change, an affected node
+or an end of a changed edge, so only these frontiers are recomputed.
+"""
+def update_frontiers(old_graph, graph, edges, affected):
+    ends = set(affected)
+    for source, target in edges:
+        ends.update([source, target])
+    stale = set()
+    for node in ends:
+        stale.update(old_graph.dominator_sets.get(node, ()))
+        stale.update(graph.dominator_sets.get(node, ()))
+    old_frontiers = old_graph.dominance_frontiers()
+    frontiers = {}
+    for node in graph:
+        if node in stale or node not in old_frontiers:
+            frontiers[node] = graph.dominance_frontier(node)
+        else:
+            frontiers[node] = old_frontiers[node]
+    graph.frontier_sets = frontiers
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        optimiser = IncrementalOptimiser(check=True)
+        optimiser.optimise(copy.deepcopy(code))
+        code["blocks"][0]["code"][0]["src1"] = "#2"
+        optimiser.optimise(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
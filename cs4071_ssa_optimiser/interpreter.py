@@ -0,0 +1,343 @@
+import copy
+import json
+from pipeline import optimise, PIPELINE
+from util import (build_graph,
+                  compare_flags,
+                  evaluate_condition,
+                  get_blocks,
+                  is_constant_val,
+                  split_op,
+                  COMPARISON_OPS,
+                  OPERATIONS,
+                  _constant,
+                  _do_op,
+                  _shift,
+                  _wrap)
+
+# Most statements run before a function is taken not to terminate.
+MAX_STEPS = 1000000
+# Initial value of SP, unless given in the inputs.
+STACK_POINTER = 0x10000
+# Bytes below the initial SP a function may use for its own stack frame, eg.
+# for spilled registers. Memory there is not compared between two runs.
+STACK_SIZE = 0x1000
+
+class InterpreterError(Exception):
+    pass
+
+"""
+The outcome of running a function with `run`:
+
+    result        value returned, in R0 unless returned explicitly
+    registers     dictionary mapping each register, or SSA variable, written
+                  or read to its final value
+    memory        dictionary mapping each byte address stored to, a multiple
+                  of 4, to the word stored there
+    block_counts  dictionary mapping the names of the blocks of the function
+                  to the number of times each was entered
+    op_counts     dictionary mapping operations, eg. "ADD" for ADD, ADDS and
+                  ADDEQ, to the number of times each was executed, including
+                  in functions called
+    stack_pointer initial value of SP
+
+Values are signed 32-bit ints.
+"""
+class Execution(object):
+    def __init__(self, stack_pointer):
+        self.result = None
+        self.registers = {}
+        self.memory = {}
+        self.block_counts = {}
+        self.op_counts = {}
+        self.stack_pointer = stack_pointer
+
+    """
+    Number of instructions executed, not counting phi functions, which are
+    not instructions. A predicated instruction counts whether or not its
+    condition held, as it takes a cycle either way.
+    """
+    @property
+    def instructions(self):
+        return sum(n for op, n in self.op_counts.iteritems() if op != "phi")
+
+    """
+    Returns the memory a caller of the function could observe: every word
+    except those in its stack frame.
+    """
+    def visible_memory(self):
+        return dict((address, value) for address, value in self.memory.iteritems()
+                    if not self.stack_pointer - STACK_SIZE <= address < self.stack_pointer)
+
+"""
+Runs the function `code`, in SSA form or not, and returns an Execution.
+
+`inputs` maps registers to their initial values, eg. {"R0": 3}, other
+registers starting at 0 and SP at STACK_POINTER. In SSA form, a variable with
+subscript 0, eg. R0-0, is the initial value of its register. `memory` maps
+addresses to the initial words in memory, other words being 0.
+
+Data processing operations, comparisons, conditional execution, branches,
+LDR/STR and phi functions are interpreted as the rest of the optimiser
+understands them. A BL to a function named in `functions`, a dictionary of
+functions in the same format, runs it with the same memory, passing R0-R3 and
+SP and taking back R0-R3, R0 holding its result.
+
+Raises InterpreterError for an operation which cannot be interpreted, a
+variable read before it is defined, or when more than `max_steps` statements
+are executed.
+"""
+def run(code, inputs=None, memory=None, functions=None, max_steps=MAX_STEPS):
+    inputs = dict(inputs or {})
+    inputs.setdefault("SP", STACK_POINTER)
+    execution = Execution(_wrap(inputs["SP"]))
+    execution.memory = dict((address, _wrap(value)) for address, value in (memory or {}).iteritems())
+    machine = _Machine(execution, inputs, functions or {}, max_steps)
+    execution.result = machine.call(code)
+    return execution
+
+"""
+Runs `original` and `optimised` with the same inputs, returning the two
+Executions and a list describing each difference between what they compute:
+their results and the memory visible to a caller. The arguments are as for
+`run`.
+
+If `optimised` cannot be run, eg. as it reads a variable which is not
+defined, its Execution is None and the error is the only difference. Raises
+InterpreterError if `original` cannot be run.
+"""
+def compare(original, optimised, inputs=None, memory=None, functions=None, max_steps=MAX_STEPS):
+    before = run(original, inputs, memory, functions, max_steps)
+    try:
+        after = run(optimised, inputs, memory, functions, max_steps)
+    except InterpreterError as e:
+        return before, None, ["failed: {}".format(e)]
+    differences = []
+    if before.result != after.result:
+        differences.append("returned {}, not {}".format(after.result, before.result))
+    old_memory, new_memory = before.visible_memory(), after.visible_memory()
+    for address in sorted(set(old_memory) | set(new_memory)):
+        old, new = old_memory.get(address, 0), new_memory.get(address, 0)
+        if old != new:
+            differences.append("stored {} at {:#x}, not {}".format(new, address, old))
+    return before, after, differences
+
+"""
+Optimises a copy of `code` with `optimise` and `passes`, then compares it with
+the original for each set of inputs in `inputs`. Returns a list of
+(inputs, before, after, differences) as from `compare`.
+"""
+def check_optimisation(code, inputs, passes=PIPELINE, max_steps=MAX_STEPS):
+    optimised = optimise(copy.deepcopy(code), passes=passes)
+    return [(values,) + compare(code, optimised, values, max_steps=max_steps)
+            for values in inputs]
+
+class _Machine(object):
+    def __init__(self, execution, inputs, functions, max_steps):
+        self.execution = execution
+        self.inputs = inputs
+        self.functions = functions
+        self.max_steps = max_steps
+        self.steps = 0
+
+    """
+    Runs `code` from its starting block with the registers of the execution,
+    returning its result.
+    """
+    def call(self, code):
+        flags = {"N": False, "Z": False, "C": False, "V": False}
+        blocks = get_blocks(code)
+        graph = build_graph(code)
+        preds = {}
+        previous = None
+        block = code["blocks"][blocks[code["starting_block"][0]]]
+        while True:
+            name = block["name"]
+            counts = self.execution.block_counts
+            counts[name] = counts.get(name, 0) + 1
+            phis = [s for s in block["code"] if s["op"] == "phi"]
+            if len(phis):
+                if previous is None:
+                    raise InterpreterError("Phi function in entry block {}".format(name))
+                if name not in preds:
+                    preds[name] = list(graph.pred(name))
+                self._phis(phis, preds[name].index(previous))
+
+            taken = None
+            for statement in block["code"]:
+                if statement["op"] == "phi":
+                    continue
+                self._step(statement)
+                if statement["op"] == "return":
+                    return self._value(statement["src1"]) if "src1" in statement else self._latest("R0")
+                base, condition, _ = split_op(statement["op"])
+                if condition is not None and not evaluate_condition(condition, flags):
+                    if base == "B":
+                        taken = False
+                    continue
+                if base == "BX":
+                    return self._latest("R0")
+                if base == "B":
+                    # A taken conditional branch leads to the first
+                    # successor. An unconditional branch leads to the
+                    # fall through successor if a conditional branch before
+                    # it was not taken.
+                    if condition is not None:
+                        taken = True
+                    break
+                elif base == "BL":
+                    self._call_function(statement)
+                else:
+                    self._execute(statement, base, flags)
+
+            successors = block["next_block"]
+            if not len(successors):
+                return self._latest("R0")
+            if taken is False:
+                if len(successors) < 2:
+                    raise InterpreterError("Block {} has no fall through successor".format(name))
+                successor = successors[1]
+            elif len(successors) > 1 and taken is None:
+                raise InterpreterError("Block {} has two successors and no branch".format(name))
+            else:
+                successor = successors[0]
+            previous = name
+            block = code["blocks"][blocks[successor]]
+
+    def _step(self, statement):
+        self.steps += 1
+        if self.steps > self.max_steps:
+            raise InterpreterError("More than {} statements executed".format(self.max_steps))
+        op = split_op(statement["op"])[0]
+        counts = self.execution.op_counts
+        counts[op] = counts.get(op, 0) + 1
+
+    """
+    Assigns every phi function of a block entered from its predecessor number
+    `index`, reading all operands before assigning any.
+    """
+    def _phis(self, phis, index):
+        values = []
+        for statement in phis:
+            self._step(statement)
+            src = "src" + str(index + 1)
+            if src not in statement:
+                raise InterpreterError("Phi function for {} has no operand {}".format(
+                    statement["dest"], src))
+            values.append(self._value(statement[src]))
+        for statement, value in zip(phis, values):
+            self._write(statement["dest"], value)
+
+    def _execute(self, statement, base, flags):
+        _, _, sets_flags = split_op(statement["op"])
+        if base == "LDR":
+            self._write(statement["dest"], self.execution.memory.get(
+                self._address(statement, "src1", "src2"), 0))
+        elif base == "STR":
+            address = self._address(statement, "src2", "src3")
+            self.execution.memory[address] = self._value(statement["src1"])
+        elif base in OPERATIONS or base in COMPARISON_OPS:
+            vals = self._operands(statement)
+            if base in COMPARISON_OPS:
+                result = None
+            else:
+                result = _do_op(base, *vals)
+                self._write(statement["dest"], result)
+            if sets_flags:
+                flags.update(_flags(base, vals, result, flags))
+        else:
+            raise InterpreterError("Cannot interpret {}".format(statement["op"]))
+
+    def _operands(self, statement):
+        srcs = sorted(x for x in statement if x.startswith("src"))
+        vals = [self._value(statement[x]) for x in srcs]
+        if "shift" in statement:
+            kind, amount = statement["shift"].split()
+            vals[-1] = _shift(kind, vals[-1], self._value(amount))
+        return vals
+
+    def _address(self, statement, base, offset):
+        address = self._value(statement[base])
+        if offset in statement:
+            address += self._value(statement[offset])
+        return _wrap(address)
+
+    def _call_function(self, statement):
+        if statement.get("label") not in self.functions:
+            raise InterpreterError("Cannot call {}".format(statement.get("label", "unknown function")))
+        callee = _Machine(Execution(self.execution.stack_pointer),
+                          dict((r, self._latest(r)) for r in ["R0", "R1", "R2", "R3", "SP"]),
+                          self.functions, self.max_steps - self.steps)
+        callee.execution.memory = self.execution.memory
+        callee.execution.result = callee.call(self.functions[statement["label"]])
+        self.steps += callee.steps
+        # Block names are only unique within a function, so only the
+        # operations of the callee are counted.
+        counts = self.execution.op_counts
+        for op, count in callee.execution.op_counts.iteritems():
+            counts[op] = counts.get(op, 0) + count
+        for register in ["R1", "R2", "R3"]:
+            self._write(register, callee._latest(register))
+        self._write("R0", callee.execution.result)
+
+    def _value(self, val):
+        if is_constant_val(val):
+            return _wrap(_constant(val))
+        registers = self.execution.registers
+        if val not in registers:
+            name, _, version = val.rpartition("-")
+            if not name:
+                registers[val] = _wrap(self.inputs.get(val, 0))
+            elif version == "0":
+                registers[val] = _wrap(self.inputs.get(name, 0))
+            else:
+                raise InterpreterError("{} is read before it is defined".format(val))
+        return registers[val]
+
+    """
+    Returns the value last written to the register `register`, under any SSA
+    name.
+    """
+    def _latest(self, register):
+        if register in self.execution.registers:
+            return self.execution.registers[register]
+        return _wrap(self.inputs.get(register, 0))
+
+    def _write(self, var, value):
+        self.execution.registers[var] = _wrap(value)
+        # Also keep the value under the register name, for calls and returns
+        # reading the registers of code in SSA form.
+        self.execution.registers[var.rpartition("-")[0] or var] = _wrap(value)
+
+"""
+Returns the flags set by the flag setting operation `base` with operands
+`vals` and result `result`, from the flags `flags` before it.
+"""
+def _flags(base, vals, result, flags):
+    if base in ("CMP", "SUB"):
+        return compare_flags(vals[0], vals[1])
+    if base == "RSB":
+        return compare_flags(vals[1], vals[0])
+    if base in ("CMN", "ADD"):
+        total = _wrap(vals[0] + vals[1])
+        return {"N": total < 0, "Z": total == 0,
+                "C": (vals[0] & 0xFFFFFFFF) + (vals[1] & 0xFFFFFFFF) > 0xFFFFFFFF,
+                "V": vals[0] + vals[1] != total}
+    if base == "TST":
+        result = _wrap(vals[0] & vals[1])
+    elif base == "TEQ":
+        result = _wrap(vals[0] ^ vals[1])
+    # Logical operations and multiplies leave C and V unchanged, ignoring the
+    # carry out of the barrel shifter.
+    return {"N": result < 0, "Z": result == 0, "C": flags["C"], "V": flags["V"]}
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        _, before, after, differences = check_optimisation(code, [{}])[0]
+        print json.dumps({"result": before.result,
+                          "instructions": [before.instructions, after and after.instructions],
+                          "differences": differences}, indent=4)
+
+if __name__ == "__main__":
+    main()
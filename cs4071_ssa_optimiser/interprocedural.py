@@ -0,0 +1,316 @@
+import copy
+import hashlib
+import json
+from collections import OrderedDict
+from block_profile import attach_profile
+from pipeline import optimise
+from util import (get_blocks,
+                  is_constant_val,
+                  is_copy,
+                  is_var,
+                  new_block_name,
+                  split_op)
+
+# Registers holding the arguments to a call, R0 also holding the result.
+ARGUMENT_REGISTERS = ["R0", "R1", "R2", "R3"]
+# Registers shared between a caller and an inlined callee.
+SHARED_REGISTERS = ARGUMENT_REGISTERS + ["SP", "LR", "PC", "R13", "R14", "R15"]
+
+# Largest callee, in statements, inlined at every call site.
+INLINE_SIZE = 8
+# Statements a callee may grow by for each argument constant at a call site.
+CONSTANT_ARGUMENT_BONUS = 4
+# Times more often than its function is entered a call site must be executed,
+# by its block count, to have twice the usual size limit for inlining.
+HOT_CALL_RATIO = 10
+
+# Number of optimised functions kept by the default cache.
+CACHE_SIZE = 256
+
+_cache = OrderedDict()
+
+"""
+Optimises a module of several functions.
+
+`module` is a dictionary with a list "functions" of functions in the single
+function format, each also having a "name", and optionally a list "entry" of
+the names of functions which may be called from outside the module. By default
+the functions not called from within the module are the entry points. A call
+is a BL statement naming the function called in its "label":
+
+    {"op": "BL", "label": "square"}
+
+Arguments are passed in R0-R3 and a result returned in R0, as with the ARM
+procedure call standard.
+
+Transforms `module` in place and returns it:
+    1. Calls to leaf functions, which make no calls themselves, are inlined
+       where the callee has at most INLINE_SIZE statements, increased by
+       CONSTANT_ARGUMENT_BONUS for each argument the call site sets to a
+       constant. Functions are visited callees first, so a callee whose own
+       calls have all been inlined becomes a leaf. If `profile` is given, a
+       dictionary mapping function names to block execution profiles as
+       read by block_profile.load_profile, call sites which were never
+       executed are not inlined and the limit is doubled for call sites
+       executed at least HOT_CALL_RATIO times as often as their function is
+       entered.
+    2. An argument which is the same constant at every remaining call site of
+       a function that is not an entry point is assigned that constant on
+       entry to the function.
+    3. Each function is optimised with `optimise`. Results are kept in
+       `cache`, a dictionary keyed on the contents of the function, so a
+       function which is unchanged since it was last optimised is not
+       optimised again. By default a cache of the CACHE_SIZE most recently
+       optimised functions, shared between calls, is used. Functions not
+       found there are looked up in `result_cache`, a persistent ResultCache,
+       if one is given.
+
+Registers other than R0-R3 and the special registers are renamed when a
+callee is inlined, as the callee would preserve them.
+"""
+def optimise_module(module, cache=None, result_cache=None, profile=None):
+    functions = OrderedDict((f["name"], f) for f in module["functions"])
+    for name, counts in (profile or {}).iteritems():
+        if name in functions and isinstance(counts, dict):
+            attach_profile(functions[name], counts)
+    for name in _bottom_up(functions):
+        _inline_calls(functions, functions[name])
+    _propagate_constant_arguments(module, functions)
+    for function in module["functions"]:
+        _optimise_function(function, cache, result_cache)
+    return module
+
+"""
+Returns the names of the functions in `functions` ordered so that, outside of
+recursion, every function comes after the functions it calls.
+"""
+def _bottom_up(functions):
+    order = []
+    seen = set()
+
+    def visit(name):
+        seen.add(name)
+        for callee in _callees(functions[name]):
+            if callee in functions and callee not in seen:
+                visit(callee)
+        order.append(name)
+
+    for name in functions:
+        if name not in seen:
+            visit(name)
+    return order
+
+"""
+Inlines every call in `function` to a small leaf function of the module.
+"""
+def _inline_calls(functions, function):
+    site = 0
+    changed = True
+    while changed:
+        changed = False
+        for block in function["blocks"]:
+            for idx, statement in enumerate(block["code"]):
+                # A conditional call, eg. BLEQ, is left in place, as the
+                # callee's body would have to be run conditionally too.
+                callee = functions.get(statement.get("label")) if statement["op"] == "BL" else None
+                if (callee is None or callee is function or
+                        not _should_inline(function, callee, block, idx)):
+                    continue
+                _inline(function, block, idx, callee, site)
+                site += 1
+                changed = True
+                break
+            if changed:
+                break
+
+"""
+True if `callee`, called by statement `idx` of `block` in `function`, should
+be inlined.
+"""
+def _should_inline(function, callee, block, idx):
+    statements = [s for b in callee["blocks"] for s in b["code"]]
+    if any(_is_call(s) for s in statements) or not any(s["op"] == "return" for s in statements):
+        return False
+    size = len([s for s in statements if s["op"] != "return"])
+    read = set(s[x] for s in statements for x in s if x.startswith("src"))
+    constants = [r for r in _constant_arguments(block, idx) if r in read]
+    limit = INLINE_SIZE + CONSTANT_ARGUMENT_BONUS * len(constants)
+    if "count" in block:
+        if not block["count"]:
+            return False
+        if block["count"] >= HOT_CALL_RATIO * max(_entry_count(function), 1):
+            limit *= 2
+    return size <= limit
+
+"""
+Replaces the call at statement `idx` of `block` in `caller` with a copy of
+the blocks of `callee`. The statements after the call are moved to a new block
+which each return of the callee jumps to, after copying its result to R0.
+
+If `block` has a count, each copied block is given the count of its original
+scaled by the share of the executions of `callee` made from the call site.
+"""
+def _inline(caller, block, idx, callee, site):
+    prefix = "%s_%d_" % (callee["name"], site)
+    names = {}
+    taken = {"blocks": list(caller["blocks"])}
+    for callee_block in callee["blocks"]:
+        names[callee_block["name"]] = new_block_name(taken, prefix + callee_block["name"])
+        taken["blocks"].append({"name": names[callee_block["name"]]})
+    tail = {"name": new_block_name(taken, block["name"] + "_" + prefix + "return"),
+            "code": block["code"][idx + 1:],
+            "next_block": block["next_block"]}
+    if "count" in block:
+        tail["count"] = block["count"]
+
+    inlined = []
+    for callee_block in callee["blocks"]:
+        new_block = {"name": names[callee_block["name"]], "code": [],
+                     "next_block": [names[b] for b in callee_block["next_block"]]}
+        if "count" in block:
+            new_block["count"] = _inlined_count(block, callee, callee_block)
+        for statement in callee_block["code"]:
+            statement = _rename(statement, prefix)
+            if statement["op"] == "return":
+                if "src1" in statement and statement["src1"] != "R0":
+                    new_block["code"].append({"op": "MOV", "dest": "R0", "src1": statement["src1"]})
+                new_block["next_block"] = []
+                break
+            new_block["code"].append(statement)
+        if not len(new_block["next_block"]):
+            new_block["next_block"] = [tail["name"]]
+        inlined.append(new_block)
+
+    block["code"] = block["code"][:idx]
+    block["next_block"] = [names[callee["starting_block"][0]]]
+    position = get_blocks(caller)[block["name"]] + 1
+    caller["blocks"][position:position] = inlined + [tail]
+
+"""
+Estimates how often `callee_block`, inlined from `callee` at a call site in
+`block`, is executed there.
+"""
+def _inlined_count(block, callee, callee_block):
+    entry = _entry_count(callee)
+    if "count" not in callee_block or not entry:
+        return block["count"]
+    return callee_block["count"] * block["count"] // entry
+
+"""
+Returns a copy of `statement` from an inlined callee with each register the
+callee preserves renamed with `prefix`.
+"""
+def _rename(statement, prefix):
+    renamed = dict(statement)
+    for field in statement:
+        if ((field == "dest" or field.startswith("src")) and is_var(statement[field]) and
+                statement[field] not in SHARED_REGISTERS):
+            renamed[field] = prefix + statement[field]
+    return renamed
+
+"""
+Gives each argument of a function which is the same constant at every call
+site its value on entry to the function. Functions which may be called from
+outside the module are left unchanged.
+"""
+def _propagate_constant_arguments(module, functions):
+    called = set(c for f in functions.values() for c in _callees(f))
+    entry = set(module.get("entry", [n for n in functions if n not in called]))
+    arguments = {}
+    for function in functions.values():
+        for block in function["blocks"]:
+            for idx, statement in enumerate(block["code"]):
+                if _is_call(statement) and statement.get("label") in functions:
+                    arguments.setdefault(statement["label"], []).append(
+                        _constant_arguments(block, idx))
+    for name in arguments:
+        if name in entry:
+            continue
+        sites = arguments[name]
+        constants = [(r, sites[0][r]) for r in ARGUMENT_REGISTERS
+                     if r in sites[0] and all(s.get(r) == sites[0][r] for s in sites)]
+        if len(constants):
+            _assign_on_entry(functions[name], constants)
+
+"""
+Adds a new entry block to `function` assigning each (register, constant) pair
+in `constants`.
+"""
+def _assign_on_entry(function, constants):
+    name = new_block_name(function, "entry")
+    entry = {"name": name,
+             "code": [{"op": "MOV", "dest": r, "src1": c} for r, c in constants],
+             "next_block": [function["starting_block"][0]]}
+    if _entry_count(function) is not None:
+        entry["count"] = _entry_count(function)
+    function["blocks"].insert(0, entry)
+    function["starting_block"][0] = name
+
+"""
+Returns a dictionary mapping each argument register set to a constant before
+statement `idx` of `block`, and not changed before the statement, to that
+constant.
+"""
+def _constant_arguments(block, idx):
+    constants = {}
+    seen = set()
+    for statement in reversed(block["code"][:idx]):
+        if _is_call(statement):
+            break
+        dest = statement.get("dest")
+        if dest in ARGUMENT_REGISTERS and dest not in seen:
+            seen.add(dest)
+            if is_copy(statement) and "src1" in statement and is_constant_val(statement["src1"]):
+                constants[dest] = statement["src1"]
+    return constants
+
+"""
+Optimises `function`, reusing the result in `cache` if an
+identical function has already been optimised.
+"""
+def _optimise_function(function, cache, result_cache):
+    body = {"blocks": function["blocks"], "starting_block": function["starting_block"]}
+    key = hashlib.sha1(json.dumps(body, sort_keys=True)).hexdigest()
+    shared = cache is None
+    if shared:
+        cache = _cache
+    if key in cache:
+        result = cache[key]
+        if shared:
+            # Most recently used entries are kept at the end.
+            del cache[key]
+            cache[key] = result
+    else:
+        result = optimise(copy.deepcopy(body), result_cache)
+        cache[key] = result
+        if shared and len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    result = copy.deepcopy(result)
+    function["blocks"] = result["blocks"]
+    function["starting_block"] = result["starting_block"]
+
+def _entry_count(function):
+    return function["blocks"][get_blocks(function)[function["starting_block"][0]]].get("count")
+
+def _callees(function):
+    return [s["label"] for b in function["blocks"] for s in b["code"]
+            if _is_call(s) and "label" in s]
+
+"""
+True if `statement` calls a function, whether or not it has a condition, eg.
+BL or BLEQ.
+"""
+def _is_call(statement):
+    return split_op(statement["op"])[0] == "BL"
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        code["name"] = "main"
+        module = {"functions": [code]}
+        optimise_module(module)
+        print json.dumps(module, indent=4)
+
+if __name__ == "__main__":
+    main()
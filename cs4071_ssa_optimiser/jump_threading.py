@@ -0,0 +1,263 @@
+import json
+from ssa import toSSA
+from dead_code_elimination import NO_SIDE_EFFECTS
+from util import (build_graph,
+                  get_blocks,
+                  get_variables,
+                  branch_condition,
+                  compare_flags,
+                  evaluate_condition,
+                  is_constant_val,
+                  is_copy,
+                  phi_operands,
+                  set_phi_operands,
+                  update_phis,
+                  new_variable,
+                  new_block_name,
+                  delete_unreachable_blocks,
+                  _fold_constant,
+                  _apply_identities,
+                  _constant,
+                  _do_shift,
+                  split_op)
+
+# Total number of statements the pass may duplicate.
+THREADING_BUDGET = 32
+# Largest block, excluding phi functions, the pass will duplicate.
+MAX_BLOCK_SIZE = 8
+
+"""
+Jump threading over code in SSA form.
+
+Transforms `code` in place. Finds blocks ending in a comparison and a
+conditional branch whose outcome is known when the block is entered from some
+of its predecessors, eg. because a phi function merges a constant from that
+predecessor:
+
+    b1: MOV R1-1, #0                   b1: MOV R1-1, #0
+        B b3                               B b3'
+    b2: ...                            b2: ...
+    b3: R1-3 <- phi(R1-1, R1-2)  --->  b3: R1-3 <- phi(R1-2)
+        CMP R1-3, #0                       CMP R1-3, #0
+        BEQ b4                             BEQ b4
+                                       b3': B b4
+
+For each such predecessor the block is duplicated, with every phi function
+replaced by the value from that predecessor and the comparison and branch
+replaced by a jump to the successor taken, and the predecessor is redirected
+to the copy. Phi functions in the successor gain an operand for the copy.
+Values defined in the block which are used outside it are now defined in both
+copies, so phi functions are inserted where the two definitions meet.
+
+Only blocks of at most MAX_BLOCK_SIZE statements with no side effects other
+than setting the flags are duplicated, and at most `budget` statements are
+duplicated in total. Loop headers are never duplicated, so that no loop gains
+a second entry. Blocks left without predecessors are deleted.
+"""
+def jump_threading(code, budget=THREADING_BUDGET):
+    threaded = True
+    while threaded:
+        threaded = False
+        graph = build_graph(code)
+        graph.set_root(code["starting_block"][0])
+        loops = graph.loops()
+        for block in code["blocks"]:
+            body = _threadable_body(block)
+            if body is None or block["name"] in loops or len(body) - 2 > budget:
+                continue
+            for pred in graph.pred(block["name"]):
+                direction = _resolve(code, graph, block, pred, body)
+                if direction is None:
+                    continue
+                _thread(code, graph, block, pred, body, block["next_block"][direction])
+                # Once its last predecessor is threaded, the block and its
+                # definitions are dead. They are deleted before repairing SSA
+                # form for any other block, which would otherwise find no
+                # definition on paths through them.
+                delete_unreachable_blocks(code)
+                budget -= max(len(body) - 2, 1)
+                threaded = True
+                break
+            if threaded:
+                break
+    delete_unreachable_blocks(code)
+
+"""
+Returns the statements of `block` after its phi functions if it can be
+duplicated, otherwise None. The last two statements are the comparison and
+conditional branch.
+"""
+def _threadable_body(block):
+    body = [s for s in block["code"] if s["op"] != "phi"]
+    if (len(block["next_block"]) != 2 or block["name"] in block["next_block"] or
+            block["next_block"][0] == block["next_block"][1] or
+            len(body) < 2 or len(body) > MAX_BLOCK_SIZE):
+        return None
+    if body[-2]["op"] != "CMP" or not branch_condition(body[-1]):
+        return None
+    if not all(s["op"] in NO_SIDE_EFFECTS and "dest" in s for s in body[:-2]):
+        return None
+    return body
+
+"""
+Returns the index in `next_block` of the successor `block` branches to when
+entered from `pred`, or None if it is not known or it may read the flags set
+in `block`.
+"""
+def _resolve(code, graph, block, pred, body):
+    if len([b for b in code["blocks"][get_blocks(code)[pred]]["next_block"]
+            if b == block["name"]]) != 1:
+        return None
+    values = {}
+    for phi in [s for s in block["code"] if s["op"] == "phi"]:
+        operands = phi_operands(graph, block["name"], phi)
+        if pred in operands and is_constant_val(operands[pred]):
+            values[phi["dest"]] = operands[pred]
+    for statement in body[:-2]:
+        folded = _rename(statement, values)
+        _fold_constant(folded)
+        _apply_identities(folded)
+        if is_copy(folded) and is_constant_val(folded["src1"]):
+            values[statement["dest"]] = folded["src1"]
+    test = _rename(body[-2], values)
+    if not (is_constant_val(test["src1"]) and is_constant_val(test["src2"])):
+        return None
+    try:
+        val2 = _constant(test["src2"])
+        if "shift" in test:
+            val2 = _do_shift(test["shift"], val2)
+        flags = compare_flags(_constant(test["src1"]), val2)
+    except ValueError:
+        return None
+    direction = 0 if evaluate_condition(branch_condition(body[-1]), flags) else 1
+    succ = code["blocks"][get_blocks(code)[block["next_block"][direction]]]
+    if _reads_flags_on_entry(succ):
+        return None
+    return direction
+
+"""
+Redirects the edge from `pred` to `block` to a copy of `block` which jumps
+straight to `succ`, then repairs SSA form.
+"""
+def _thread(code, graph, block, pred, body, succ):
+    blocks = get_blocks(code)
+    succ_block = code["blocks"][blocks[succ]]
+    succ_phis = [s for s in succ_block["code"] if s["op"] == "phi"]
+    succ_operands = [phi_operands(graph, succ, phi) for phi in succ_phis]
+    renamed = {}
+    for phi in [s for s in block["code"] if s["op"] == "phi"]:
+        operands = phi_operands(graph, block["name"], phi)
+        if pred in operands:
+            renamed[phi["dest"]] = operands[pred]
+
+    name = new_block_name(code, block["name"] + "_" + pred)
+    copy = {"name": name, "code": [], "next_block": [succ]}
+    if "count" in block and "count" in code["blocks"][blocks[pred]]:
+        # The copy takes over the executions of `block` entered from `pred`.
+        copy["count"] = min(block["count"], code["blocks"][blocks[pred]]["count"])
+        block["count"] -= copy["count"]
+    code["blocks"].insert(blocks[block["name"]] + 1, copy)
+    for statement in body[:-2]:
+        new_statement = _rename(statement, renamed)
+        new_statement["dest"] = new_variable(code, statement["dest"])
+        renamed[statement["dest"]] = new_statement["dest"]
+        copy["code"].append(new_statement)
+    pred_block = code["blocks"][get_blocks(code)[pred]]
+    pred_block["next_block"] = [name if b == block["name"] else b for b in pred_block["next_block"]]
+
+    update_phis(code, graph)
+    new_graph = build_graph(code)
+    for phi, operands in zip(succ_phis, succ_operands):
+        if block["name"] in operands:
+            operands[name] = renamed.get(operands[block["name"]], operands[block["name"]])
+        set_phi_operands(new_graph, succ, phi, operands)
+
+    variables = get_variables(code)
+    for var in renamed:
+        uses = [u for u in variables[var].get("uses", []) if u["block"] not in (block["name"], name)]
+        if len(uses):
+            _update_ssa(code, new_graph, var, {block["name"]: var, name: renamed[var]})
+
+"""
+Rewrites the uses of `var` outside the blocks in `definitions`, which maps
+each block defining a version of `var` to the name of that version, with the
+version reaching them. Phi functions are inserted at the join points reached
+by more than one version.
+"""
+def _update_ssa(code, graph, var, definitions):
+    blocks = get_blocks(code)
+    at_entry = {}
+    at_exit = dict(definitions)
+
+    def value_at_exit(block):
+        if block not in at_exit:
+            at_exit[block] = value_at_entry(block)
+        return at_exit[block]
+
+    def value_at_entry(block):
+        if block in at_entry:
+            return at_entry[block]
+        preds = list(graph.pred(block))
+        if not len(preds):
+            # The starting block, which no definition reaches.
+            at_entry[block] = var
+        elif len(preds) == 1:
+            at_entry[block] = var
+            at_entry[block] = value_at_exit(preds[0])
+        else:
+            phi = {"op": "phi", "dest": new_variable(code, var)}
+            code["blocks"][blocks[block]]["code"].insert(0, phi)
+            at_entry[block] = phi["dest"]
+            operands = dict((p, value_at_exit(p)) for p in preds)
+            set_phi_operands(graph, block, phi, operands)
+        return at_entry[block]
+
+    for block in code["blocks"]:
+        if block["name"] in definitions:
+            continue
+        for statement in list(block["code"]):
+            if statement["op"] == "phi":
+                operands = phi_operands(graph, block["name"], statement)
+                if var in operands.values():
+                    for p in operands:
+                        if operands[p] == var:
+                            operands[p] = value_at_exit(p)
+                    set_phi_operands(graph, block["name"], statement, operands)
+            else:
+                for field in [x for x in statement if x.startswith("src")]:
+                    if statement[field] == var:
+                        statement[field] = value_at_entry(block["name"])
+
+"""
+Returns a copy of `statement` with every operand in `values` replaced by its
+value.
+"""
+def _rename(statement, values):
+    renamed = dict(statement)
+    for field in [x for x in statement if x.startswith("src")]:
+        renamed[field] = values.get(statement[field], statement[field])
+    return renamed
+
+"""
+True if `block` may test the flags before setting them, with a conditional
+branch or predicated statement.
+"""
+def _reads_flags_on_entry(block):
+    for statement in block["code"]:
+        _, condition, sets_flags = split_op(statement["op"])
+        if condition is not None:
+            return True
+        if sets_flags:
+            return False
+    return False
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        jump_threading(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import json
+from ssa import toSSA
+from block_profile import hottest_first
+from dead_code_elimination import NO_SIDE_EFFECTS
+from util import (build_graph,
+                  get_blocks,
+                  get_variables,
+                  is_var,
+                  phi_operands,
+                  set_phi_operands,
+                  new_variable,
+                  new_block_name)
+
+"""
+Loop-invariant code motion over code in SSA form.
+
+Transforms `code` in place. For every natural loop, innermost first, finds the
+statements whose operands are all constants, defined outside the loop, or
+defined by other loop-invariant statements, and moves them into the loop's
+preheader, which is created in front of the loop header if the loop has none.
+Statements hoisted out of an inner loop land in its preheader, which is part
+of the enclosing loop, and so may be hoisted again out of that loop.
+
+Only operations in NO_SIDE_EFFECTS are moved. CMP and the operations with the
+`S` flag, which aggressive dead code elimination keeps live because they write
+the status register, stay where they are so that the flags seen by every
+conditional branch are unchanged. As none of the moved operations can trap,
+it is safe to hoist them from blocks which are not executed on every iteration.
+
+No preheader is created for loops which have no invariant statements, nor
+for loops which block counts from block_profile.attach_profile show are never
+entered.
+"""
+def loop_invariant_code_motion(code):
+    graph = _build_rooted_graph(code)
+    forest = graph.loop_nesting_forest()
+    order = []
+    for header in forest:
+        if graph.loop_parent(header) is None:
+            _postorder(forest, header, order)
+    executed = set(hottest_first(code, order))
+    for header in order:
+        if header not in executed:
+            continue
+        # Each preheader inserted changes the graph, so rebuild it every time.
+        graph = _build_rooted_graph(code)
+        body = graph.loops()[header]
+        invariants = _find_invariants(code, body)
+        if len(invariants):
+            preheader = get_preheader(code, graph, header)
+            for statement in invariants:
+                _remove_by_identity(code, statement)
+            code["blocks"][get_blocks(code)[preheader]]["code"].extend(invariants)
+
+"""
+Returns the name of the preheader of the loop headed by `header`, inserting
+one if the loop does not already have a single predecessor outside the loop
+whose only successor is the header.
+
+`graph` must be the control flow graph of `code`.
+"""
+def get_preheader(code, graph, header):
+    outside = [p for p in graph.pred(header) if p not in graph.loops()[header]]
+    if len(outside) == 1 and list(graph[outside[0]]) == [header]:
+        return outside[0]
+    return insert_preheader(code, graph, header)
+
+"""
+Creates a preheader for the loop headed by `header`: a new block placed before
+the header in `code["blocks"]` through which every edge entering the loop from
+outside now passes. Phi functions in the header have their operands from
+outside the loop merged by a new phi function in the preheader where they
+differ. Returns the name of the new block.
+
+`graph` must be the control flow graph of `code` before the preheader is
+inserted.
+"""
+def insert_preheader(code, graph, header):
+    body = graph.loops()[header]
+    outside = [p for p in graph.pred(header) if p not in body]
+    blocks = get_blocks(code)
+    header_block = code["blocks"][blocks[header]]
+    name = new_block_name(code, header + "_preheader")
+    preheader = {"name": name, "code": [], "next_block": [header]}
+    entering = [code["blocks"][blocks[p]].get("count") for p in outside]
+    if "count" in header_block and None not in entering:
+        preheader["count"] = min(sum(entering), header_block["count"])
+
+    phis = [s for s in header_block["code"] if s["op"] == "phi"]
+    operands = [phi_operands(graph, header, phi) for phi in phis]
+
+    for pred in outside:
+        pred_block = code["blocks"][blocks[pred]]
+        pred_block["next_block"] = [name if b == header else b for b in pred_block["next_block"]]
+    code["blocks"].insert(blocks[header], preheader)
+    if code["starting_block"][0] == header:
+        code["starting_block"][0] = name
+
+    new_graph = build_graph(code)
+    for phi, ops in zip(phis, operands):
+        entering = [ops[p] for p in outside if p in ops]
+        new_ops = dict((p, ops[p]) for p in ops if p in body)
+        if len(set(entering)) == 1:
+            new_ops[name] = entering[0]
+        elif len(entering):
+            merge = {"op": "phi", "dest": new_variable(code, phi["dest"])}
+            set_phi_operands(new_graph, name, merge,
+                             dict((p, ops[p]) for p in outside if p in ops))
+            preheader["code"].append(merge)
+            new_ops[name] = merge["dest"]
+        set_phi_operands(new_graph, header, phi, new_ops)
+    return name
+
+"""
+Returns a list of the loop-invariant statements in the loop made up of the
+blocks in `body`, ordered so that every statement comes after the invariant
+statements whose results it uses.
+"""
+def _find_invariants(code, body):
+    variables = get_variables(code)
+    invariants = []
+    invariant_vars = set()
+    changed = True
+    while changed:
+        changed = False
+        for block in [b for b in code["blocks"] if b["name"] in body]:
+            for statement in block["code"]:
+                if (statement["op"] not in NO_SIDE_EFFECTS or
+                        "dest" not in statement or
+                        statement["dest"] in invariant_vars):
+                    continue
+                srcs = [statement[x] for x in statement if x.startswith("src")]
+                if all(_is_invariant(src, variables, body, invariant_vars) for src in srcs):
+                    invariants.append(statement)
+                    invariant_vars.add(statement["dest"])
+                    changed = True
+    return invariants
+
+"""
+True if `val` is a constant, a variable defined outside `body`, or a variable
+already known to be loop invariant.
+"""
+def _is_invariant(val, variables, body, invariant_vars):
+    if not is_var(val) or val in invariant_vars:
+        return True
+    def_site = variables[val].get("def_site")
+    return def_site is None or def_site["block"] not in body
+
+def _remove_by_identity(code, statement):
+    for block in code["blocks"]:
+        for i, s in enumerate(block["code"]):
+            if s is statement:
+                del block["code"][i]
+                return
+
+def _build_rooted_graph(code):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    return graph
+
+def _postorder(tree, node, order):
+    for child in tree[node]:
+        _postorder(tree, child, order)
+    order.append(node)
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        loop_invariant_code_motion(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import json
+from dataflow import solve, Universe, BACKWARD, INTERSECTION
+from ssa import toSSA
+from util import (build_graph,
+                  is_constant_val,
+                  is_var,
+                  remove_marked_statements,
+                  split_op,
+                  _constant,
+                  _replace_with_copy)
+
+CALL_OPS = ["BL", "SWI"]
+# Statements leaving the function, after which any memory may be read.
+EXIT_OPS = ["BX", "return"]
+
+"""
+Redundant load elimination, store to load forwarding and dead store
+elimination over code in SSA form.
+
+Memory is accessed with
+    LDR dest, base, #offset    dest <- memory[base + offset]
+    STR value, base, #offset   memory[base + offset] <- value
+that is, for LDR src1 is the base register and src2 the offset, and for STR
+src1 is the value stored, src2 the base register and src3 the offset. The
+offset may be omitted, meaning #0, or be a register.
+
+Transforms `code` in place. Walks the dominator tree from the entry block,
+keeping a table mapping addresses to a variable known to hold the word in
+memory at that address. Addresses are compared symbolically: as every
+variable in SSA form has a single value, two accesses with the same base
+variable and the same offset use the same address, and accesses with the same
+base and constant offsets at least a word apart cannot overlap. Any other pair
+of addresses may refer to the same word.
+
+    * A load from an address in the table is replaced by a copy of the
+      variable holding its value, whether that was loaded or stored there:
+        STR R1-1, SP-0, #4            STR R1-1, SP-0, #4
+        ...                   --->    ...
+        LDR R2-1, SP-0, #4            MOV R2-1, R1-1
+    * A store removes every address it may overwrite from the table.
+    * A BL or SWI may read or write any memory, and empties the table.
+    * A store is deleted if, on every path from it, the same address is
+      stored to again before anything may read it, found by
+      `_dead_stores`.
+
+A block inherits the table of its immediate dominator less the addresses that
+may be overwritten on some path between the two, so a load is only removed if
+no path to it contains a store which may alias it or a call.
+
+The copies introduced are left for copy propagation to clean up.
+"""
+def memory_optimisation(code):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    tree = graph.dominator_tree()
+    blocks = {b["name"]: b for b in code["blocks"]}
+    preds = dict((name, []) for name in blocks)
+    for block in code["blocks"]:
+        for succ in block["next_block"]:
+            preds[succ].append(block["name"])
+    kills = dict((name, _kills(blocks[name])) for name in blocks)
+    # The dominator tree is walked with a stack, as it may be deeper than the
+    # recursion limit.
+    stack = [(graph.root, {})]
+    while len(stack):
+        block, available = stack.pop()
+        available = _optimise_block(blocks[block], available)
+        for child in tree[block]:
+            stack.append((child, _inherited(preds, kills, block, child, available)))
+    _dead_stores(code, graph)
+    remove_marked_statements(code)
+
+"""
+Optimises the loads of `block`, given the table `available` of values in
+memory on entry to it. Returns the table at the end of the block.
+"""
+def _optimise_block(block, available):
+    available = dict(available)
+    for statement in block["code"]:
+        if statement["op"] == "LDR":
+            address = _address(statement)
+            if address in available:
+                _replace_with_copy(statement, available[address])
+            else:
+                available[address] = statement["dest"]
+        elif statement["op"] == "STR":
+            address = _address(statement)
+            available = _without_aliases(available, address)
+            available[address] = statement["src1"]
+        elif _writes_memory(statement):
+            available = {}
+    return available
+
+"""
+Returns the addresses `block` stores to, and whether it may write any other
+memory, through a call or another kind of store.
+"""
+def _kills(block):
+    stores = []
+    for statement in block["code"]:
+        if statement["op"] == "STR":
+            stores.append(_address(statement))
+        elif _writes_memory(statement):
+            return stores, True
+    return stores, False
+
+"""
+Returns the entries of the table `available` at the end of `parent` which
+still hold on entry to `child`, which it immediately dominates. Entries are
+removed if a block on some path from `parent` to `child`, including `child`
+itself if it is in a loop, may overwrite them. Such a path need only be
+followed from the last time it leaves `parent`: entries made in `parent` are
+made again each time it is run.
+
+`preds` maps each block to its predecessors, and `kills` to the result of
+`_kills` for it.
+"""
+def _inherited(preds, kills, parent, child, available):
+    between = set()
+    worklist = [child]
+    while len(available) and len(worklist):
+        for pred in preds[worklist.pop()]:
+            if pred == parent or pred in between:
+                continue
+            between.add(pred)
+            worklist.append(pred)
+            stores, clobbers = kills[pred]
+            if clobbers:
+                return {}
+            for address in stores:
+                available = _without_aliases(available, address)
+    return available
+
+"""
+Marks for deletion each store to an address which, on every path from it, is
+stored to again before anything may read it. This is a backward dataflow
+problem over the addresses stored to, solved with dataflow.solve, where an
+address is overwritten on entry to a statement if it is stored to there, or
+is overwritten after it and not read there. An address is no longer known to
+be overwritten before the definition of the variables it is made of, which in
+a loop name a different address each time round, and nothing is known to be
+overwritten at the end of the function, where any memory may be read.
+"""
+def _dead_stores(code, graph):
+    universe = Universe()
+    for block in code["blocks"]:
+        for statement in block["code"]:
+            if statement["op"] == "STR":
+                universe.add(_address(statement))
+    if not len(universe):
+        return
+    # The addresses with each base, and the bitset of those made of each
+    # variable, so that a statement need not be compared with every address.
+    bases = {}
+    variables = {}
+    for idx, address in enumerate(universe.items):
+        bases.setdefault(address[0], []).append((idx, address))
+        for var in _variables(address):
+            variables[var] = variables.get(var, 0) | 1 << idx
+
+    gen = {}
+    kill = {}
+    for block in code["blocks"]:
+        block_gen = 0
+        block_kill = 0
+        for statement in reversed(block["code"]):
+            statement_gen, statement_kill = _overwritten(statement, universe, bases, variables)
+            block_gen = statement_gen | (block_gen & ~statement_kill)
+            block_kill |= statement_kill
+        gen[block["name"]] = block_gen
+        kill[block["name"]] = block_kill
+    _, outs = solve(graph, gen, kill, BACKWARD, INTERSECTION, 0, universe.all())
+    for block in code["blocks"]:
+        overwritten = outs[block["name"]]
+        for statement in reversed(block["code"]):
+            if statement["op"] == "STR" and overwritten & universe.bits([_address(statement)]):
+                statement["delete"] = True
+            statement_gen, statement_kill = _overwritten(statement, universe, bases, variables)
+            overwritten = statement_gen | (overwritten & ~statement_kill)
+
+"""
+Returns the bitsets of the addresses in `universe` that are known to be
+overwritten before `statement`, and that are no longer known to be after it,
+for `_dead_stores`. `bases` maps each base to the (number, address) pairs of
+the addresses with that base, and `variables` each variable to the bitset of
+the addresses made of it.
+"""
+def _overwritten(statement, universe, bases, variables):
+    if statement["op"] == "STR":
+        return universe.bits([_address(statement)]), 0
+    if statement["op"] == "LDR":
+        # Only addresses with the same base can be known not to alias.
+        address = _address(statement)
+        kill = universe.all()
+        for idx, other in bases.get(address[0], []):
+            if not _may_alias(address, other):
+                kill &= ~(1 << idx)
+        return 0, kill | variables.get(statement["dest"], 0)
+    if (_writes_memory(statement) or _reads_memory(statement) or
+            split_op(statement["op"])[0] in EXIT_OPS):
+        return 0, universe.all()
+    if "dest" in statement:
+        return 0, variables.get(statement["dest"], 0)
+    return 0, 0
+
+"""
+Returns the address accessed by the LDR or STR `statement` as a pair of the
+base variable and the offset, an int for constant offsets.
+"""
+def _address(statement):
+    base, offset = ("src1", "src2") if statement["op"] == "LDR" else ("src2", "src3")
+    offset = statement.get(offset, "#0")
+    if is_constant_val(offset):
+        try:
+            offset = _constant(offset)
+        except ValueError:
+            pass
+    elif "shift" in statement:
+        offset = (offset, statement["shift"])
+    return (statement[base], offset)
+
+"""
+True unless the words accessed at `a` and `b` are known not to overlap.
+"""
+def _may_alias(a, b):
+    if a == b:
+        return True
+    if a[0] == b[0] and isinstance(a[1], int) and isinstance(b[1], int):
+        return abs(a[1] - b[1]) < 4
+    return True
+
+"""
+Returns the variables the address `address` is computed from.
+"""
+def _variables(address):
+    base, offset = address
+    if isinstance(offset, tuple):
+        offset = offset[0]
+    return [v for v in (base, offset) if isinstance(v, basestring) and is_var(v)]
+
+def _without_aliases(table, address):
+    return dict((a, table[a]) for a in table if not _may_alias(a, address))
+
+def _writes_memory(statement):
+    return (split_op(statement["op"])[0] in CALL_OPS or statement["op"].startswith("ST") or
+            statement["op"] == "PUSH")
+
+def _reads_memory(statement):
+    return statement["op"].startswith("LD") or statement["op"] == "POP"
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        memory_optimisation(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
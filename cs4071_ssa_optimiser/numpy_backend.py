@@ -0,0 +1,153 @@
+import json
+from itertools import izip
+
+# Number of nodes from which graphs are analysed with NumPy, when it is
+# installed. Below this, importing NumPy takes longer than analysing the graph
+# without it.
+THRESHOLD = 100
+
+# Rows converted to sets at a time, bounding the memory used to unpack them.
+_CHUNK_WORDS = 1 << 20
+
+numpy = None
+_imported = False
+
+"""
+True if NumPy is installed. It is only imported when first needed, as it is
+slow to import and only used for very large functions.
+"""
+def available():
+    global numpy, _imported
+    if not _imported:
+        _imported = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy is not None
+
+"""
+True if a graph of `size` nodes should be analysed with NumPy.
+"""
+def enabled(size):
+    return size >= THRESHOLD and available()
+
+"""
+Computes the dominators of `graph`, which must have a root, giving the same
+result as Graph.dominators.
+
+Each node's dominators are a row of a bit matrix of uint64 words, with a bit
+for each node, so the dominators of a node's predecessors are intersected by
+ANDing whole rows at once. Rows are swept in reverse postorder until none
+change. The matrix takes n * n / 8 bytes for n nodes.
+"""
+def dominators(graph):
+    from dataflow import reverse_postorder
+    order = reverse_postorder(graph)
+    index = dict((node, i) for i, node in enumerate(order))
+    preds = _preds(graph, order, index)
+    root = index[graph.root]
+
+    matrix = _matrix(len(order), len(order))
+    matrix[:] = _full_row(len(order))
+    matrix[root] = 0
+    _set_bits(matrix, [root], [root])
+    selves = _matrix(len(order), len(order))
+    _set_bits(selves, range(len(order)), range(len(order)))
+
+    changed = True
+    while changed:
+        changed = False
+        for i in xrange(len(order)):
+            if i == root or not len(preds[i]):
+                continue
+            new = numpy.bitwise_and.reduce(matrix[preds[i]], axis=0) | selves[i]
+            if not numpy.array_equal(new, matrix[i]):
+                matrix[i] = new
+                changed = True
+    return dict(izip(order, _sets(matrix, order)))
+
+"""
+Returns a dictionary mapping each node of `graph` to the set of nodes
+reachable from it, including itself. The rows of reachable nodes are ORed
+together, sweeping in postorder until none change.
+"""
+def reachability(graph):
+    order = list(graph)
+    if graph.root is not None:
+        from dataflow import reverse_postorder
+        order = reverse_postorder(graph)
+    index = dict((node, i) for i, node in enumerate(order))
+    succs = [numpy.array([index[s] for s in graph[node]], dtype=numpy.intp) for node in order]
+
+    matrix = _matrix(len(order), len(order))
+    _set_bits(matrix, range(len(order)), range(len(order)))
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(xrange(len(order))):
+            if not len(succs[i]):
+                continue
+            new = matrix[i] | numpy.bitwise_or.reduce(matrix[succs[i]], axis=0)
+            if not numpy.array_equal(new, matrix[i]):
+                matrix[i] = new
+                changed = True
+    return dict(izip(order, _sets(matrix, order)))
+
+def _preds(graph, order, index):
+    preds = [[] for _ in order]
+    for node in order:
+        for successor in graph[node]:
+            preds[index[successor]].append(index[node])
+    return [numpy.array(p, dtype=numpy.intp) for p in preds]
+
+def _words(bits):
+    return max((bits + 63) // 64, 1)
+
+def _matrix(rows, bits):
+    return numpy.zeros((rows, _words(bits)), dtype=numpy.uint64)
+
+def _full_row(bits):
+    row = numpy.zeros(_words(bits), dtype=numpy.uint64)
+    row[:] = numpy.uint64(0xFFFFFFFFFFFFFFFF)
+    if bits % 64:
+        row[-1] = numpy.uint64((1 << (bits % 64)) - 1)
+    return row
+
+def _set_bits(matrix, rows, columns):
+    columns = numpy.asarray(columns, dtype=numpy.uint64)
+    matrix[numpy.asarray(rows, dtype=numpy.intp), (columns >> numpy.uint64(6)).astype(numpy.intp)] |= (
+        numpy.uint64(1) << (columns & numpy.uint64(63)))
+
+"""
+Converts the rows of `matrix` to sets of `items`, the items numbered by each
+bit. Only the nonzero words are unpacked, a chunk of rows at a time.
+"""
+def _sets(matrix, items):
+    sets = [set() for _ in xrange(len(matrix))]
+    chunk = max(_CHUNK_WORDS // matrix.shape[1], 1)
+    for first in xrange(0, len(matrix), chunk):
+        rows, words = numpy.nonzero(matrix[first:first + chunk])
+        values = matrix[first:first + chunk][rows, words].astype("<u8")
+        # unpackbits gives the bits of each byte from the most significant.
+        unpacked = numpy.unpackbits(values.view(numpy.uint8).reshape(-1, 8, 1), axis=2)
+        entries, octets, bits = numpy.nonzero(unpacked[:, :, ::-1])
+        columns = words[entries] * 64 + octets * 8 + bits
+        for row, column in izip((rows[entries] + first).tolist(), columns.tolist()):
+            sets[row].add(items[column])
+    return sets
+
+
+def main():
+    from util import build_graph
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        graph = build_graph(code)
+        graph.set_root(code["starting_block"][0])
+        if not available():
+            print "NumPy is not installed"
+            return
+        print dominators(graph) == graph.dominators()
+
+if __name__ == "__main__":
+    main()
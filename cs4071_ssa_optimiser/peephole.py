@@ -0,0 +1,197 @@
+import json
+from ssa import toSSA
+from util import (get_blocks,
+                  get_variables,
+                  branch_condition,
+                  is_var,
+                  sets_flags,
+                  SHIFT_OPS)
+
+SHIFTABLE_OPS = ["ADD", "SUB", "RSB", "AND", "ORR", "EOR", "BIC"]
+COMMUTATIVE_OPS = ["ADD", "AND", "ORR", "EOR"]
+FLAG_SETTING_OPS = ["MOV", "ADD", "SUB", "RSB", "MUL", "MLA", "AND", "ORR", "EOR", "BIC"]
+# Conditions which only test the N and Z flags. An S-suffixed operation sets
+# these exactly as CMP x, #0 would, but may set C and V differently.
+ZERO_TEST_CONDITIONS = ["EQ", "NE", "MI", "PL"]
+
+"""
+ARM specific peephole optimisation over code in SSA form.
+
+Transforms `code` in place, repeatedly applying every rule in PATTERNS until
+none of them match. Def-use chains from `get_variables` are used to check that
+the intermediate value a rule removes is used only by the statement it is
+folded into.
+
+    * Multiply-accumulate:
+        MUL t, a, b                --->  MLA d, a, b, c
+        ADD d, t, c
+    * Barrel shifter operands:
+        LSL t, a, #2               --->  ADD d, b, a, LSL #2
+        ADD d, b, t
+    * Flag setting operations:
+        SUB x, a, b                --->  SUBS x, a, b
+        CMP x, #0
+        BEQ                              BEQ
+
+Fused statements are kept within a basic block, so that no work is moved into
+a loop. The flag setting rule is only applied when every instruction reading
+the flags tests only the N and Z flags.
+
+Dead phi functions count as uses, so this should be run after aggressive dead
+code elimination has removed them.
+"""
+def peephole(code):
+    changed = True
+    while changed:
+        changed = False
+        for _, rule in PATTERNS:
+            variables = get_variables(code)
+            blocks = get_blocks(code)
+            for block in code["blocks"]:
+                for statement in list(block["code"]):
+                    if rule(code, blocks, variables, block, statement):
+                        changed = True
+                        break
+                if changed:
+                    break
+            if changed:
+                break
+
+"""
+Fuses a multiplication into the addition which is its only use.
+"""
+def _fuse_multiply_accumulate(code, blocks, variables, block, statement):
+    if statement["op"] != "ADD" or "shift" in statement:
+        return False
+    for product, addend in [("src1", "src2"), ("src2", "src1")]:
+        mul = _single_use_def(block, variables, statement[product], statement)
+        if (mul is None or mul["op"] != "MUL" or "shift" in mul or
+                not is_var(mul["src1"]) or not is_var(mul["src2"]) or
+                not is_var(statement[addend])):
+            continue
+        addend = statement[addend]
+        statement["op"] = "MLA"
+        statement["src1"] = mul["src1"]
+        statement["src2"] = mul["src2"]
+        statement["src3"] = addend
+        block["code"].remove(mul)
+        return True
+    return False
+
+"""
+Fuses a shift into the data processing operation which is its only use, as
+the shifted second operand of that operation.
+"""
+def _fuse_shifted_operand(code, blocks, variables, block, statement):
+    if statement["op"] not in SHIFTABLE_OPS or "shift" in statement or "src2" not in statement:
+        return False
+    for field in ["src2", "src1"]:
+        shift = _single_use_def(block, variables, statement[field], statement)
+        if shift is None:
+            continue
+        if shift["op"] in SHIFT_OPS and "shift" not in shift and not is_var(shift["src2"]):
+            amount = shift["op"] + " " + shift["src2"]
+        elif shift["op"] == "MOV" and "shift" in shift and "src2" not in shift:
+            amount = shift["shift"]
+        else:
+            continue
+        if not is_var(shift["src1"]):
+            continue
+        if field == "src1":
+            if statement["op"] in COMMUTATIVE_OPS:
+                statement["src1"] = statement["src2"]
+            elif statement["op"] == "SUB":
+                statement["op"] = "RSB"
+                statement["src1"] = statement["src2"]
+            elif statement["op"] == "RSB":
+                statement["op"] = "SUB"
+                statement["src1"] = statement["src2"]
+            else:
+                continue
+        statement["src2"] = shift["src1"]
+        statement["shift"] = amount
+        block["code"].remove(shift)
+        return True
+    return False
+
+"""
+Replaces a comparison of a result with zero by setting the flags in the
+operation computing the result.
+"""
+def _fuse_compare_with_zero(code, blocks, variables, block, statement):
+    if (statement["op"] != "CMP" or statement["src2"] != "#0" or
+            not is_var(statement["src1"]) or "shift" in statement):
+        return False
+    site = variables[statement["src1"]].get("def_site")
+    if site is None or site["block"] != block["name"]:
+        return False
+    definition = block["code"][site["statement"]]
+    if definition["op"] not in FLAG_SETTING_OPS:
+        return False
+    idx = [i for i, s in enumerate(block["code"]) if s is statement][0]
+    between = block["code"][site["statement"] + 1:idx]
+    if any(sets_flags(s) or branch_condition(s) for s in between):
+        return False
+    readers = _flag_readers(code, blocks, block, idx + 1)
+    if any(c not in ZERO_TEST_CONDITIONS for c in readers):
+        return False
+    definition["op"] += "S"
+    block["code"].remove(statement)
+    return True
+
+"""
+Returns the condition codes of every instruction that may read the flags set
+before position `idx` of `block`, following control flow into successors
+while the flags are unchanged.
+"""
+def _flag_readers(code, blocks, block, idx):
+    readers = []
+    seen = set()
+    worklist = [(block["name"], idx)]
+    while len(worklist):
+        name, start = worklist.pop()
+        statements = code["blocks"][blocks[name]]["code"]
+        for s in statements[start:]:
+            if branch_condition(s):
+                readers.append(branch_condition(s))
+            if sets_flags(s):
+                break
+        else:
+            for succ in code["blocks"][blocks[name]]["next_block"]:
+                if succ not in seen:
+                    seen.add(succ)
+                    worklist.append((succ, 0))
+    return readers
+
+"""
+Returns the statement in `block` defining `var` if its only use is `user`,
+otherwise None.
+"""
+def _single_use_def(block, variables, var, user):
+    if not is_var(var) or var not in variables:
+        return None
+    site = variables[var].get("def_site")
+    uses = variables[var]["uses"]
+    if site is None or site["block"] != block["name"] or len(uses) != 1:
+        return None
+    definition = block["code"][site["statement"]]
+    if block["code"][uses[0]["statement"]] is not user or uses[0]["block"] != block["name"]:
+        return None
+    return definition
+
+PATTERNS = [
+    ("multiply-accumulate", _fuse_multiply_accumulate),
+    ("shifted operand", _fuse_shifted_operand),
+    ("flag setting", _fuse_compare_with_zero),
+]
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        peephole(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
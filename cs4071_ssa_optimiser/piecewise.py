@@ -0,0 +1,245 @@
+import copy
+import json
+from block_profile import attach_profile, strip_profile
+from dataflow import liveness, _uses
+from pipeline import optimise, PIPELINE
+from util import build_graph, get_blocks, split_op, COMPARISON_OPS
+
+# Fewest blocks in each piece of a function optimised piecewise. Consecutive
+# regions are joined until they have at least this many blocks, as code in
+# different pieces is not optimised together.
+REGION_SIZE = 50
+
+# Registers read by statements without naming them: R0 holds the result of a
+# function, and R0-R3 the arguments of a call.
+IMPLICIT_USES = {"return": ["R0"], "BX": ["R0"], "BL": ["R0", "R1", "R2", "R3"]}
+
+"""
+Optimises a large function a piece at a time. Several passes take time more
+than linear in the size of a function, so optimising pieces of a few hundred
+blocks each is much faster than optimising a function of many thousands of
+blocks whole, while code in different pieces is not optimised together.
+
+The function is divided at the outermost canonical single entry single exit
+regions of its program structure tree, found by
+Graph.program_structure_tree. These run one after another, so each is only
+entered from the one before it, and their registers are passed from one to
+the next. Consecutive regions are joined into pieces of at least
+`region_size` blocks, and a region which is entered with flags it did not
+set is kept in the same piece as the region setting them.
+
+Each piece is made into a function of its own, ending in a block returning
+every register live after the piece, and optimised with `optimise`, looking
+up and storing results in `cache` if it is given. As each piece is optimised
+by itself, analyses cached on its graph only cover the piece. If `processes`
+is given, the pieces are optimised by a pool of that many processes.
+
+The optimised pieces are then joined again, their returns replaced by copies
+of the returned values into the variables the next piece reads the registers
+from on entry, subscript 0 of each register in SSA form, eg. R1-0.
+Transforms `code` in place and returns it. A function with fewer than two
+pieces is optimised whole. `profile` is as for `optimise`.
+"""
+def optimise_piecewise(code, cache=None, passes=PIPELINE, processes=None,
+                       region_size=REGION_SIZE, profile=None):
+    if profile is not None:
+        attach_profile(code, profile)
+    pieces = _pieces(code, region_size)
+    if len(pieces) < 2:
+        return optimise(code, cache, passes)
+
+    live_in, _ = liveness(code, _implicit_uses)
+    functions = [_piece_function(code, piece, live_in) for piece in pieces]
+    items = [(function, cache, passes) for function in functions]
+    if processes is None or processes == 1:
+        results = map(_optimise_piece, items)
+    else:
+        # Imported here rather than at the top, as it is slow to import and
+        # not needed otherwise.
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            results = pool.map(_optimise_piece, items)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    _join(code, results)
+    strip_profile(code)
+    return code
+
+"""
+Divides the blocks of `code` reachable from its starting block into pieces
+run one after another, each at least `region_size` blocks where possible.
+Returns a list of (blocks, entry, exit) for each piece, in order, where
+`blocks` is the set of names of its blocks, `entry` the name of the block it
+is entered at and `exit` the edge (block, successor) it is left through, or
+None for the last piece.
+"""
+def _pieces(code, region_size):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    regions = graph.program_structure_tree().children
+    blocks = code["blocks"]
+    index = get_blocks(code)
+    pieces = []
+    for region in regions:
+        exit = region.exit
+        if exit is not None and exit[1] is None:
+            # The region ends the function at a single exit.
+            exit = None
+        if (len(pieces) and (len(pieces[-1][0]) < region_size or
+                             _reads_flags_on_entry(blocks[index[region.entry[1]]]))):
+            pieces[-1] = (pieces[-1][0] | region.nodes, pieces[-1][1], exit)
+        else:
+            pieces.append((set(region.nodes), region.entry[1], exit))
+    # The last piece is joined to the one before it if it is too small, and
+    # must hold every exit.
+    while len(pieces) > 1 and (len(pieces[-1][0]) < region_size or pieces[-1][2] is not None):
+        last = pieces.pop()
+        pieces[-1] = (pieces[-1][0] | last[0], pieces[-1][1], last[2])
+    return pieces
+
+"""
+True if `block` starts by reading the flags, with a conditional statement
+before any statement setting them.
+"""
+def _reads_flags_on_entry(block):
+    for statement in block["code"]:
+        base, condition, sets_flags = split_op(statement["op"])
+        if condition is not None:
+            return True
+        if sets_flags or base in COMPARISON_OPS:
+            return False
+    return False
+
+"""
+Returns a copy of the piece `piece` of `code` as a function of its own. The
+edge leaving the piece is redirected to a new block returning each register
+in `live_in` of the block it led to, each return marked with an "exit" field
+naming the register.
+"""
+def _piece_function(code, piece, live_in):
+    names, entry, exit = piece
+    blocks = [copy.deepcopy(b) for b in code["blocks"] if b["name"] in names]
+    function = {"blocks": blocks, "starting_block": [entry]}
+    if any(entry in b["next_block"] for b in blocks):
+        # A piece starting with a loop is given an entry block outside it.
+        start = _new_name(names, "entry")
+        blocks.insert(0, {"name": start, "code": [], "next_block": [entry]})
+        function["starting_block"] = [start]
+    else:
+        blocks.sort(key=lambda b: b["name"] != entry)
+    if exit is not None:
+        source, target = exit
+        returns = [{"op": "return", "src1": r, "exit": r} for r in sorted(live_in[target])]
+        if not len(returns):
+            # Keeps the block, so the piece still has a way out.
+            returns = [{"op": "return", "exit": None}]
+        name = _new_name(names, "exit")
+        exit_block = {"name": name, "code": returns, "next_block": []}
+        source_block = blocks[get_blocks(function)[source]]
+        source_block["next_block"] = [name if b == target else b for b in source_block["next_block"]]
+        if "count" in source_block:
+            exit_block["count"] = source_block["count"]
+        blocks.append(exit_block)
+    return function
+
+def _optimise_piece(item):
+    function, cache, passes = item
+    return optimise(function, cache, passes)
+
+"""
+Replaces the blocks of `code` with the optimised pieces in `results`, in
+order, connecting each to the next.
+"""
+def _join(code, results):
+    blocks = []
+    taken = set()
+    for number, function in enumerate(results):
+        renamed = {}
+        for block in function["blocks"]:
+            if block["name"] in taken:
+                renamed[block["name"]] = _new_name(taken, block["name"])
+            taken.add(renamed.get(block["name"], block["name"]))
+        for block in function["blocks"]:
+            block["name"] = renamed.get(block["name"], block["name"])
+            block["next_block"] = [renamed.get(b, b) for b in block["next_block"]]
+        function["starting_block"] = [renamed.get(b, b) for b in function["starting_block"]]
+
+        for block in function["blocks"]:
+            returns = [s for s in block["code"] if s["op"] == "return" and "exit" in s]
+            if not len(returns):
+                continue
+            block["code"] = [s for s in block["code"] if s not in returns]
+            # Each piece reads the value of a register on entry to it as
+            # subscript 0 of the register, eg. R1-0.
+            assignments = [(s["exit"] + "-0", s["src1"]) for s in returns if s["exit"] is not None]
+            for dest, src in _sequential_copies(assignments, "RegionCopy%d_" % number):
+                block["code"].append({"op": "MOV", "dest": dest, "src": src})
+            block["next_block"] = [results[number + 1]["starting_block"][0]]
+        blocks.extend(function["blocks"])
+
+    starts = [f["starting_block"][0] for f in results]
+    for idx, block in enumerate(blocks):
+        # Blocks falling through to a different piece than the one placed
+        # after them need a branch.
+        if (len(block["next_block"]) == 1 and block["next_block"][0] in starts and
+                (idx + 1 == len(blocks) or blocks[idx + 1]["name"] != block["next_block"][0]) and
+                not (len(block["code"]) and block["code"][-1]["op"] == "B")):
+            block["code"].append({"op": "B"})
+    code["blocks"] = blocks
+    code["starting_block"] = [results[0]["starting_block"][0]]
+
+"""
+Orders the parallel copies `assignments`, (dest, src) pairs, so that no
+register is overwritten before it is read, breaking cycles with temporaries
+named from `prefix`. Returns the (dest, src) pairs to copy one after another.
+"""
+def _sequential_copies(assignments, prefix):
+    pending = [(dest, src) for dest, src in assignments if dest != src]
+    ordered = []
+    temporaries = 0
+    while len(pending):
+        sources = set(src for _, src in pending)
+        ready = [(dest, src) for dest, src in pending if dest not in sources]
+        if not len(ready):
+            # Every register left is read by another copy, so they form
+            # cycles. Save one in a temporary to break its cycle.
+            dest = pending[0][0]
+            temporary = prefix + str(temporaries)
+            temporaries += 1
+            ordered.append((temporary, dest))
+            pending = [(d, temporary if s == dest else s) for d, s in pending]
+            continue
+        ordered.extend(ready)
+        pending = [p for p in pending if p not in ready]
+    return ordered
+
+def _implicit_uses(statement):
+    uses = _uses(statement)
+    base = split_op(statement["op"])[0]
+    if base in IMPLICIT_USES and "src1" not in statement:
+        uses.extend(IMPLICIT_USES[base])
+    return uses
+
+def _new_name(names, name):
+    candidate = name
+    i = 1
+    while candidate in names:
+        candidate = name + str(i)
+        i += 1
+    return candidate
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        optimise_piecewise(code, region_size=1)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import json
+
+# The module defining each pass, by name. Passes are only imported when they
+# are first run, so a program using a few of them does not pay for loading
+# the rest.
+PASSES = {
+    "toSSA": "ssa",
+    "fromSSA": "fromSSA",
+    "constant_propagation": "constant_propagation",
+    "conditional_propagation": "conditional_constant_propagation",
+    "dead_code_elimination": "dead_code_elimination",
+    "jump_threading": "jump_threading",
+    "global_value_numbering": "global_value_numbering",
+    "memory_optimisation": "memory_optimisation",
+    "loop_invariant_code_motion": "loop_invariant_code_motion",
+    "strength_reduction": "strength_reduction",
+    "peephole": "peephole",
+    "aggressive_dead_code_elimination": "aggressive_dead_code_elimination",
+    "if_conversion": "if_conversion",
+    "block_layout": "block_layout",
+    "register_allocation": "register_allocation",
+    "value_range_propagation": "value_range_propagation",
+}
+
+# The names of the passes `optimise` runs, in order.
+PIPELINE = [
+    "toSSA",
+    "conditional_propagation",
+    "constant_propagation",
+    "value_range_propagation",
+    "jump_threading",
+    "global_value_numbering",
+    "constant_propagation",
+    "memory_optimisation",
+    "constant_propagation",
+    "loop_invariant_code_motion",
+    "strength_reduction",
+    "dead_code_elimination",
+    "aggressive_dead_code_elimination",
+    "peephole",
+    #"conditional_propagation",
+    "constant_propagation",
+    "fromSSA",
+    "if_conversion",
+    "block_layout",
+]
+
+_loaded = {}
+
+"""
+Returns the function for the pass called `name` in PASSES, importing its
+module the first time it is needed. Raises KeyError for an unknown pass.
+"""
+def load_pass(name):
+    if name not in _loaded:
+        module = __import__(PASSES[name], globals(), {}, [name])
+        _loaded[name] = getattr(module, name)
+    return _loaded[name]
+
+"""
+Runs every pass named in `passes`, by default PIPELINE, over `code` in turn,
+and returns it. The default passes convert `code` to SSA form and back; a
+different list must do the same if it includes passes needing SSA form.
+
+If `cache` is given, a ResultCache, the result is looked up there first, and
+stored there once optimised.
+
+If `profile` is given, a dictionary mapping block names to execution counts,
+it is attached to `code` with block_profile.attach_profile before optimising,
+so that passes can favour the code which runs most often. A profile which no
+longer matches `code` is ignored. Block counts are removed from the result.
+"""
+def optimise(code, cache=None, passes=PIPELINE, profile=None):
+    # Imported here, like the passes, to keep importing the pipeline fast.
+    from block_profile import attach_profile, strip_profile
+    if profile is not None:
+        attach_profile(code, profile)
+    if cache is not None:
+        key = cache.key(code, passes)
+        result = cache.get(key)
+        if result is not None:
+            code.clear()
+            code.update(result)
+            return code
+    for name in passes:
+        load_pass(name)(code)
+    strip_profile(code)
+    if cache is not None:
+        cache.put(key, code)
+    return code
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        optimise(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
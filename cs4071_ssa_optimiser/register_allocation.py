@@ -0,0 +1,449 @@
+import json
+import re
+from dataflow import liveness, solve, Universe, FORWARD, UNION, _graph, _members
+from fromSSA import fromSSA
+from ssa import toSSA
+from util import (get_blocks,
+                  is_predicated,
+                  is_var,
+                  split_op,
+                  _constant)
+
+REGISTERS = ["R" + str(n) for n in range(13)]
+EXIT_OPS = ["return", "BX"]
+# Operations whose operands are labels rather than registers.
+LABEL_OPS = ["B", "BL"]
+
+FIXED_REGISTER = re.compile(r"^(R(?:[0-9]|1[0-2]))(-0)?$")
+# The stack pointer, link register and program counter, and every version of
+# them in SSA form, eg. SP-1, are never allocated.
+RESERVED_REGISTER = re.compile(r"^(SP|LR|PC|R1[3-5])(-[0-9]+)?$")
+# R0 and its versions in SSA form, eg. R0-2, hold the result of the function.
+RESULT_REGISTER = re.compile(r"^R0(-[0-9]+)?$")
+
+"""
+Linear scan register allocation, after Poletto and Sarkar, for code that has
+been converted out of SSA form.
+
+Transforms `code` in place, replacing every variable with one of the ARM
+registers R0-R12, and returns the number of variables spilled to the stack.
+
+    1. Instructions are numbered in the order of `code["blocks"]` and each
+       variable is given a single live interval covering every instruction
+       from its first definition to its last use, extended to cover the
+       blocks it is live into or out of.
+    2. Variables named after a register, and the values registers hold on
+       entry to the function (eg. R3-0), are fixed to that register. SP, LR
+       and PC and their versions are left in their registers, and the
+       version of R0 reaching an exit is copied into R0 there.
+    3. Copies whose source and destination intervals do not overlap are
+       coalesced into a single interval, and the resulting MOV Rn, Rn
+       statements deleted.
+    4. Intervals are assigned registers in order of their start, spilling the
+       interval which ends last whenever no register is free.
+    5. Spilled variables are kept in stack slots, loaded with LDR before each
+       use and stored with STR after each definition, using the highest
+       free registers as scratch registers, as many as the most operands
+       any statement reads. The stack pointer is lowered on entry to make
+       room for the slots and restored before every exit, and the code's own
+       uses of it are offset to address the stack above the slots.
+"""
+def register_allocation(code):
+    results = _result_versions(code)
+    fixed = _pin_entry_values(code, results)
+    intervals, copies = _build_intervals(code, results)
+    groups = _coalesce(intervals, copies, fixed)
+    assignment, spilled = _linear_scan(groups, fixed, REGISTERS)
+    scratch = []
+    if len(spilled):
+        pinned = set(fixed[g] for g in fixed)
+        needed = max([1] + [len(set(_uses(s))) for b in code["blocks"] for s in b["code"]])
+        scratch = [r for r in reversed(REGISTERS) if r not in pinned][:needed]
+        if len(scratch) < needed:
+            raise ValueError("Too few registers left for %d scratch registers" % needed)
+        registers = [r for r in REGISTERS if r not in scratch]
+        assignment, spilled = _linear_scan(groups, fixed, registers)
+    names = {}
+    for group in groups:
+        for var in groups[group]["members"]:
+            names[var] = group
+    _rewrite(code, names, assignment, spilled, scratch, results)
+    return len(spilled)
+
+"""
+Returns a dictionary mapping each variable fixed to a register to that
+register. Where two variables would be fixed to the same register with
+overlapping lifetimes the entry value is instead copied out of the register at
+the start of the function, and left for the allocator to place.
+"""
+def _pin_entry_values(code, results):
+    fixed = {}
+    for var in _all_variables(code) | set(results.values()):
+        match = FIXED_REGISTER.match(var)
+        if match:
+            fixed[var] = match.group(1)
+    intervals, _ = _build_intervals(code, results)
+    taken = {}
+    for var in sorted(fixed, key=lambda v: intervals[v]["start"]):
+        register = fixed[var]
+        clash = [v for v in taken.get(register, []) if _overlaps(intervals[v], intervals[var])]
+        if len(clash) and var.endswith("-0"):
+            del fixed[var]
+            fixed[register] = register
+            start = code["blocks"][get_blocks(code)[code["starting_block"][0]]]
+            start["code"].insert(0, {"op": "MOV", "dest": var, "src1": register})
+        else:
+            taken.setdefault(register, []).append(var)
+    return fixed
+
+"""
+Returns a dictionary mapping each statement leaving the function with its
+result in R0, BX or a return without an operand, to the version of R0 defined
+last on every path reaching it. R0-0 is the value R0 holds on entry. Exits
+reached by different versions are left out. Statements are keyed by id().
+"""
+def _result_versions(code):
+    universe = Universe([None])
+    versions = {None: "R0-0"}
+    for block in code["blocks"]:
+        for idx, statement in enumerate(block["code"]):
+            for var in _defs(statement):
+                if RESULT_REGISTER.match(var):
+                    versions[(block["name"], idx)] = var
+                    universe.add((block["name"], idx))
+    everything = (1 << len(universe.items)) - 1
+
+    gen = {}
+    kill = {}
+    for block in code["blocks"]:
+        block_gen = 1 if block["name"] == code["starting_block"][0] else 0
+        block_kill = 0
+        for idx, statement in enumerate(block["code"]):
+            if (block["name"], idx) not in versions:
+                continue
+            bit = 1 << universe.index[(block["name"], idx)]
+            if is_predicated(statement):
+                block_gen |= bit
+            else:
+                block_gen = bit
+                block_kill = everything
+        gen[block["name"]] = block_gen
+        kill[block["name"]] = block_kill & ~block_gen
+    reach_in, _ = solve(_graph(code), gen, kill, FORWARD, UNION)
+    reach_in = _members(universe, reach_in)
+
+    results = {}
+    for block in code["blocks"]:
+        reaching = set(reach_in.get(block["name"], []))
+        if block["name"] == code["starting_block"][0]:
+            reaching.add(None)
+        for idx, statement in enumerate(block["code"]):
+            if (statement["op"] == "BX" or
+                    (statement["op"] == "return" and "src1" not in statement)):
+                names = set(versions[d] for d in reaching)
+                if len(names) == 1:
+                    results[id(statement)] = names.pop()
+            if (block["name"], idx) in versions:
+                if not is_predicated(statement):
+                    reaching = set()
+                reaching.add((block["name"], idx))
+    return results
+
+"""
+Computes the live interval of every variable. Returns a dictionary mapping
+variables to intervals {"start", "end"} and a list of (dest, src) pairs for the
+plain copies which are candidates for coalescing. The version of R0 in
+`results` for an exit is live up to it.
+
+Instruction i reads its operands at position 2i and writes its result at
+position 2i + 1, so an operand whose last use is instruction i can share a
+register with the result of instruction i.
+"""
+def _build_intervals(code, results):
+    def uses(statement):
+        if id(statement) in results:
+            return _uses(statement) + [results[id(statement)]]
+        return _uses(statement)
+
+    live_in, live_out = liveness(code, uses, _defs)
+    intervals = {}
+    copies = []
+    position = 0
+
+    def extend(var, pos):
+        if var not in intervals:
+            intervals[var] = {"start": pos, "end": pos}
+        intervals[var]["start"] = min(intervals[var]["start"], pos)
+        intervals[var]["end"] = max(intervals[var]["end"], pos)
+
+    for block in code["blocks"]:
+        first = position
+        for statement in block["code"]:
+            for var in uses(statement):
+                extend(var, position)
+            for var in _defs(statement):
+                extend(var, position + 1)
+            if _is_plain_copy(statement) and is_var(_copy_source(statement)):
+                copies.append((statement["dest"], _copy_source(statement)))
+            position += 2
+        for var in live_in[block["name"]]:
+            extend(var, first)
+        for var in live_out[block["name"]]:
+            extend(var, position)
+        # Keep a position for empty blocks so values live through them
+        # overlap values defined in them.
+        if position == first:
+            position += 2
+    return intervals, copies
+
+"""
+Coalesces copy related intervals which do not overlap. Returns a dictionary
+mapping a representative variable for each group of coalesced variables to
+{"start", "end", "members"}.
+"""
+def _coalesce(intervals, copies, fixed):
+    groups = {}
+    group_of = {}
+    for var in intervals:
+        groups[var] = {"start": intervals[var]["start"],
+                       "end": intervals[var]["end"],
+                       "members": [var]}
+        group_of[var] = var
+    for dest, src in copies:
+        if dest not in group_of or src not in group_of:
+            continue
+        a, b = group_of[dest], group_of[src]
+        if a == b or _overlaps(groups[a], groups[b]):
+            continue
+        if a in fixed and b in fixed:
+            if fixed[a] != fixed[b]:
+                continue
+        elif b in fixed:
+            a, b = b, a
+        if a in fixed and _pinned_overlap(a, b, groups, fixed):
+            continue
+        groups[a]["start"] = min(groups[a]["start"], groups[b]["start"])
+        groups[a]["end"] = max(groups[a]["end"], groups[b]["end"])
+        groups[a]["members"].extend(groups[b]["members"])
+        for var in groups[b]["members"]:
+            group_of[var] = a
+        del groups[b]
+    return groups
+
+"""
+True if merging group `b` into the fixed group `a` would give an interval
+overlapping another group fixed to the same register.
+"""
+def _pinned_overlap(a, b, groups, fixed):
+    merged = {"start": min(groups[a]["start"], groups[b]["start"]),
+              "end": max(groups[a]["end"], groups[b]["end"])}
+    return any(_overlaps(merged, groups[g]) for g in groups
+               if g in fixed and g not in (a, b) and fixed[g] == fixed[a])
+
+"""
+Assigns a register from `registers` to every group, or spills it. Returns the
+dictionary mapping groups to registers and the list of spilled groups.
+"""
+def _linear_scan(groups, fixed, registers):
+    assignment = {}
+    spilled = []
+    active = []
+    fixed_intervals = {}
+    for group in groups:
+        if group in fixed:
+            fixed_intervals.setdefault(fixed[group], []).append(groups[group])
+
+    def blocked(register, interval):
+        return any(_overlaps(interval, f) for f in fixed_intervals.get(register, [])
+                   if f is not interval)
+
+    for group in sorted(groups, key=lambda g: (groups[g]["start"], g)):
+        interval = groups[group]
+        active = [g for g in active if groups[g]["end"] > interval["start"]]
+        if group in fixed:
+            assignment[group] = fixed[group]
+            active.append(group)
+            continue
+        in_use = set(assignment[g] for g in active)
+        free = [r for r in registers if r not in in_use and not blocked(r, interval)]
+        if len(free):
+            assignment[group] = free[0]
+            active.append(group)
+            continue
+        candidates = [g for g in active if g not in fixed and
+                      not blocked(assignment[g], interval)]
+        victim = max(candidates, key=lambda g: groups[g]["end"]) if len(candidates) else None
+        if victim is not None and groups[victim]["end"] > interval["end"]:
+            assignment[group] = assignment[victim]
+            del assignment[victim]
+            active.remove(victim)
+            spilled.append(victim)
+            active.append(group)
+        else:
+            spilled.append(group)
+    return assignment, spilled
+
+"""
+Rewrites every variable in `code` with its register, inserting loads and
+stores for spilled variables and deleting copies made redundant by coalescing.
+Each exit in `results` is preceded by a copy of the version of R0 reaching it
+into R0.
+"""
+def _rewrite(code, names, assignment, spilled, scratch, results):
+    slots = dict((group, 4 * idx) for idx, group in enumerate(sorted(spilled)))
+    for block in code["blocks"]:
+        new_code = []
+        for statement in block["code"]:
+            loads = []
+            stores = []
+            loaded = set()
+            coalesced = (_is_plain_copy(statement) and
+                         names.get(statement["dest"]) == names.get(_copy_source(statement)))
+            # Every spilled operand is loaded into a scratch register of its
+            # own. A destination which is not also read is only written
+            # after the operands are read, so it can reuse the first.
+            spilled_uses = sorted(set(v for v in _uses(statement) if names[v] not in assignment))
+            temps = dict((var, scratch[idx]) for idx, var in enumerate(spilled_uses))
+            fields = sorted(statement)
+            if split_op(statement["op"])[0] in LABEL_OPS:
+                fields = []
+            for field in fields:
+                if not (field == "dest" or field.startswith("src")):
+                    continue
+                var = statement[field]
+                reserved = RESERVED_REGISTER.match(var)
+                if reserved:
+                    statement[field] = reserved.group(1)
+                    continue
+                if var not in names:
+                    continue
+                group = names[var]
+                if group in assignment:
+                    statement[field] = assignment[group]
+                    continue
+                if var not in temps:
+                    temps[var] = scratch[0]
+                statement[field] = temps[var]
+                if field == "dest":
+                    stores.append({"op": "STR", "src1": temps[var], "src2": "SP",
+                                   "src3": "#" + str(slots[group])})
+                if (field != "dest" or is_predicated(statement)) and var not in loaded:
+                    loaded.add(var)
+                    loads.append({"op": "LDR", "dest": temps[var], "src1": "SP",
+                                  "src2": "#" + str(slots[group])})
+            # A copy between two spilled variables may use one scratch
+            # register for both, but must still be loaded and stored.
+            if (_is_plain_copy(statement) and statement["dest"] == _copy_source(statement) and
+                    (coalesced or not len(stores))):
+                continue
+            if len(slots):
+                _skip_frame(statement, 4 * len(slots))
+            if id(statement) in results:
+                new_code.extend(_move_result(results[id(statement)], names, assignment, slots))
+            new_code.extend(loads)
+            # The slots are read before the stack pointer is restored.
+            if len(slots) and statement["op"] in EXIT_OPS:
+                new_code.append(_adjust_stack("ADD", len(slots)))
+            new_code.append(statement)
+            new_code.extend(stores)
+        block["code"] = new_code
+    if len(slots):
+        start = code["blocks"][get_blocks(code)[code["starting_block"][0]]]
+        start["code"].insert(0, _adjust_stack("SUB", len(slots)))
+
+"""
+Rewrites `statement` to use the stack pointer as it was before `frame` bytes
+were reserved below it for stack slots. Raises ValueError if the statement
+writes the stack pointer, or reads it other than as the base address of a
+load or store with a constant offset or in adding a constant to it.
+"""
+def _skip_frame(statement, frame):
+    fields = sorted(x for x in statement if (x == "dest" or x.startswith("src")) and
+                    statement[x] == "SP")
+    if not len(fields):
+        return
+    base = split_op(statement["op"])[0]
+    offset = {"LDR": ("src1", "src2"), "STR": ("src2", "src3")}.get(base)
+    arithmetic = {"ADD": 1, "SUB": -1}.get(base)
+    if offset is not None and fields == [offset[0]] and "shift" not in statement:
+        constant = statement.get(offset[1], "#0")
+        if is_var(constant):
+            raise ValueError("Cannot offset stack access by register: %s" % statement["op"])
+        statement[offset[1]] = "#" + str(_constant(constant) + frame)
+    elif (arithmetic is not None and fields == ["src1"] and "shift" not in statement and
+          not is_var(statement.get("src2", "R"))):
+        statement["src2"] = "#" + str(_constant(statement["src2"]) + arithmetic * frame)
+    elif _is_plain_copy(statement) and fields in (["src"], ["src1"]):
+        del statement[fields[0]]
+        statement.update({"op": "ADD", "src1": "SP", "src2": "#" + str(frame)})
+    else:
+        raise ValueError("Cannot spill in code using the stack pointer in %s" % statement["op"])
+
+"""
+Returns the statements copying the variable `var` into R0, loading it from
+its stack slot if it was spilled.
+"""
+def _move_result(var, names, assignment, slots):
+    group = names[var]
+    if group not in assignment:
+        return [{"op": "LDR", "dest": "R0", "src1": "SP", "src2": "#" + str(slots[group])}]
+    if assignment[group] == "R0":
+        return []
+    return [{"op": "MOV", "dest": "R0", "src1": assignment[group]}]
+
+def _adjust_stack(op, slots):
+    return {"op": op, "dest": "SP", "src1": "SP", "src2": "#" + str(4 * slots)}
+
+def _overlaps(a, b):
+    return a["start"] < b["end"] and b["start"] < a["end"]
+
+"""
+Returns the variables read by `statement`. A predicated definition also reads
+its destination, which keeps its value when the statement is not executed.
+"""
+def _uses(statement):
+    if split_op(statement["op"])[0] in LABEL_OPS:
+        return []
+    uses = [statement[x] for x in statement
+            if x.startswith("src") and _is_allocatable(statement[x])]
+    if is_predicated(statement):
+        uses.extend(_defs(statement))
+    return uses
+
+def _defs(statement):
+    if split_op(statement["op"])[0] in LABEL_OPS:
+        return []
+    if "dest" in statement and _is_allocatable(statement["dest"]):
+        return [statement["dest"]]
+    return []
+
+def _is_allocatable(val):
+    return is_var(val) and not RESERVED_REGISTER.match(val)
+
+def _all_variables(code):
+    return set(v for b in code["blocks"] for s in b["code"] for v in _uses(s) + _defs(s))
+
+"""
+True if `statement` is a copy of a single operand. The copies fromSSA inserts
+name their operand "src" rather than "src1".
+"""
+def _is_plain_copy(statement):
+    srcs = [x for x in statement if x.startswith("src")]
+    return (statement["op"] == "MOV" and "dest" in statement and
+            "shift" not in statement and len(srcs) == 1)
+
+def _copy_source(statement):
+    return [statement[x] for x in statement if x.startswith("src")][0]
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        fromSSA(code)
+        spills = register_allocation(code)
+        print json.dumps(code, indent=4)
+        print "Spilled", spills
+
+if __name__ == "__main__":
+    main()
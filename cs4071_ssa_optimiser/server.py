@@ -0,0 +1,110 @@
+import errno
+import json
+import os
+import signal
+import socket
+import SocketServer
+import stat
+import sys
+from multiprocessing import Pool
+from batch import optimise_document, _describe, _ignore_interrupts
+from cache import CACHE_SIZE
+from client import read_message, write_message, ProtocolError
+
+"""
+Runs an optimiser server listening on the Unix domain socket `path` until it
+is interrupted or terminated.
+
+Each connection may send any number of requests, each a message holding the
+JSON object
+    {"document": <function or module>, "allocate_registers": <bool>}
+and receives for each a message holding the JSON object
+    {"result": <optimised document>}  or  {"error": <description>}
+in the same order. Connections are handled on separate threads, and the
+optimisation itself runs on a pool of `processes` worker processes, by default
+one for each CPU. The workers live as long as the server, so their caches,
+including the ResultCache in `cache_dir` if given, stay warm between requests.
+"""
+def serve(path, processes=None, cache_dir=None, cache_size=CACHE_SIZE):
+    _remove_stale_socket(path)
+    pool = Pool(processes, _ignore_interrupts)
+    server = OptimiserServer(path, pool, (cache_dir, cache_size))
+    # Clean up on kill as well as on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.terminate()
+        pool.join()
+        _remove(path)
+
+class OptimiserServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, pool, options):
+        SocketServer.UnixStreamServer.__init__(self, path, OptimiserHandler)
+        self.pool = pool
+        self.options = options
+
+class OptimiserHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = read_message(self.rfile)
+            except ProtocolError as e:
+                write_message(self.wfile, json.dumps({"error": str(e)}))
+                return
+            if request is None:
+                return
+            response = self.server.pool.apply(_handle_request, (request, self.server.options))
+            write_message(self.wfile, response)
+
+"""
+Optimises the document in the JSON request `request`. Runs in a worker
+process and returns the response as JSON.
+"""
+def _handle_request(request, options):
+    cache_dir, cache_size = options
+    try:
+        request = json.loads(request)
+        document = request["document"]
+        allocate_registers = bool(request.get("allocate_registers", False))
+    except (ValueError, KeyError, TypeError) as e:
+        return json.dumps({"error": "Invalid request: {}".format(_describe(e))})
+    return json.dumps(optimise_document(document, allocate_registers, cache_dir, cache_size))
+
+"""
+Deletes the socket at `path` left behind by a server which is no longer
+running. Raises socket.error if a server is still listening there.
+"""
+def _remove_stale_socket(path):
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise socket.error(errno.EEXIST, "{} exists and is not a socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error:
+        _remove(path)
+        return
+    finally:
+        probe.close()
+    raise socket.error(errno.EADDRINUSE, "A server is already listening on {}".format(path))
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "optimiser.sock"
+    serve(path)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,13 @@
 import copy
 import json
-from util import build_graph
+from util import (build_graph,
+                  is_predicated,
+                  new_block_name,
+                  sets_flags,
+                  split_op,
+                  statement_condition,
+                  COMPARISON_OPS,
+                  INVERSE_CONDITIONS)
 
 def getName(name, num):
     return name + "-" + str(num)
@@ -37,7 +44,7 @@ def renameVars(code, graph, blocks, block, done, counts, stacks):
     for stat in blocks[block]['code']:
 
         if stat['op'] != 'phi':
-            for x in ['src1', 'src2']:
+            for x in [x for x in stat if x.startswith('src')]:
                 renamePart(x, stat, counts, stacks)
 
         if 'dest' in stat:
@@ -122,13 +129,77 @@ def insertPhis(code, graph, blocks):
                     if y not in defsites[var]:
                         worklist.add(y)
 
+"""
+Replaces each run of statements predicated on the same condition, starting with
+a definition, with a branch around the statements unpredicated. A predicated
+definition leaves its destination unchanged when its condition does not hold,
+which in SSA form would leave the new variable it defines without a value, so
+the old and new values are merged by a phi function at the join instead:
+
+    b1: CMP R1, #0                  b1: CMP R1, #0
+        MOVEQ R2, #1        --->        BNE b1_join
+        ADD R3, R2, R1              b1_then: MOV R2, #1
+                                    b1_join: ADD R3, R2, R1
+
+if_conversion predicates such statements again after fromSSA. Operates
+in-place, returning true if `code` was changed.
+"""
+def expandPredicated(code):
+    changed = False
+    i = 0
+    while i < len(code["blocks"]):
+        block = code["blocks"][i]
+        starts = [idx for idx, s in enumerate(block["code"]) if is_predicated(s) and "dest" in s]
+        if not len(starts):
+            i += 1
+            continue
+        start = starts[0]
+        condition = statement_condition(block["code"][start])
+        end = start + 1
+        # Statements after one setting the flags test the new flags.
+        while (end < len(block["code"]) and is_predicated(block["code"][end]) and
+               statement_condition(block["code"][end]) == condition and
+               not sets_flags(block["code"][end - 1])):
+            end += 1
+
+        then = new_block_name(code, block["name"] + "_then")
+        join = new_block_name(code, block["name"] + "_join")
+        statements = [dict(s, op=unpredicated(s["op"])) for s in block["code"][start:end]]
+        new_blocks = [{"name": then, "code": statements, "next_block": [join]},
+                      {"name": join, "code": block["code"][end:], "next_block": block["next_block"]}]
+        if "count" in block:
+            for new_block in new_blocks:
+                new_block["count"] = block["count"]
+        block["code"] = block["code"][:start] + [{"op": "B" + INVERSE_CONDITIONS[condition]}]
+        block["next_block"] = [join, then]
+        code["blocks"][i + 1:i + 1] = new_blocks
+        # The rest of the block may hold more predicated statements.
+        i += 2
+        changed = True
+    return changed
+
+"""
+Returns the mnemonic `op` without its condition, eg. ADDS for ADDEQS.
+"""
+def unpredicated(op):
+    base, _, flags = split_op(op)
+    if flags and base not in COMPARISON_OPS:
+        return base + "S"
+    return base
+
 """
 Converts code to SSA form.
 Operates in-place
+
+`graph` may be given as the control flow graph of `code`, rooted at its first
+block, to reuse dominators or dominance frontiers already computed for it. It
+is not used if predicated definitions have to be replaced by branches first,
+with `expandPredicated`.
 """
-def toSSA(code):
-    graph = build_graph(code)
-    graph.set_root(code["blocks"][0]["name"])
+def toSSA(code, graph=None):
+    if expandPredicated(code) or graph is None:
+        graph = build_graph(code)
+        graph.set_root(code["blocks"][0]["name"])
     blocks = {b["name"]: b for b in code["blocks"]}
     insertPhis(code, graph, blocks)
     renameVars(code, graph, blocks, graph.root, set(), {}, {})
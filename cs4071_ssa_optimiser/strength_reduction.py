@@ -0,0 +1,288 @@
+import json
+from ssa import toSSA
+from block_profile import hottest_first
+from loop_invariant_code_motion import get_preheader
+from util import (build_graph,
+                  get_blocks,
+                  get_variables,
+                  is_constant_val,
+                  is_var,
+                  phi_operands,
+                  set_phi_operands,
+                  new_variable,
+                  remove_marked_statements)
+
+INT_MIN = -(1 << 31)
+INT_MAX = (1 << 31) - 1
+
+"""
+Strength reduction of multiplications over code in SSA form.
+
+Transforms `code` in place with three transformations:
+    * Finds the basic induction variables of each natural loop, header phi
+      functions i <- phi(i0, i') where i' <- i + c is computed in the loop
+      for a constant c, and the derived induction variables j <- i * k for a
+      constant k. Each multiplication is replaced by a new induction variable
+      j' <- phi(i0 * k, j' + c * k), so that the loop performs one addition per
+      iteration instead of a MUL.
+    * Linear function test replacement. Where a basic induction variable is
+      only used by its own increment and the comparison controlling the loop
+      exit, the comparison is rewritten in terms of a derived induction
+      variable and the basic induction variable is deleted.
+    * Multiplications by a constant are rewritten as shifts, additions or
+      reverse subtractions with a shifted operand, eg.
+        MUL R1, R0, #8  --->  LSL R1, R0, #3
+        MUL R1, R0, #5  --->  ADD R1, R0, R0, LSL #2
+        MUL R1, R0, #7  --->  RSB R1, R0, R0, LSL #3
+
+MUL takes several cycles on the ARM7 whereas the replacements take a single
+cycle. If the blocks have counts from block_profile.attach_profile, loops are
+reduced most frequently executed first, and loops which are never entered are
+left alone.
+"""
+def strength_reduction(code):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    for header in hottest_first(code, graph.loops().keys()):
+        _reduce_loop(code, header)
+    for block in code["blocks"]:
+        i = 0
+        while i < len(block["code"]):
+            replacement = _decompose_multiplication(code, block["code"][i])
+            block["code"][i:i + 1] = replacement
+            i += len(replacement)
+
+"""
+Replaces multiplications of the induction variables of the loop headed by
+`header` with new induction variables, then removes basic induction variables
+made dead by linear function test replacement.
+"""
+def _reduce_loop(code, header):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    body = graph.loops()[header]
+    if not len(_find_reducible_multiplications(code, graph, header, body)):
+        return
+    # A preheader gives a single place to compute the initial values.
+    preheader = get_preheader(code, graph, header)
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    body = graph.loops()[header]
+    reduced = {}
+    for statement, iv, k in _find_reducible_multiplications(code, graph, header, body):
+        phi = iv[0]
+        if (phi["dest"], k) not in reduced:
+            reduced[(phi["dest"], k)] = _new_induction_variable(code, graph, header,
+                                                              preheader, iv, k)
+        new_phi, new_increment = reduced[(phi["dest"], k)]
+        operand = statement["src1"] if is_var(statement["src1"]) else statement["src2"]
+        del statement["src2"]
+        statement["op"] = "MOV"
+        statement["src1"] = new_phi["dest"] if operand == phi["dest"] else new_increment["dest"]
+    for (iv_name, k), (new_phi, new_increment) in reduced.items():
+        _replace_test(code, header, body, iv_name, k, new_phi, new_increment)
+
+"""
+Finds the basic induction variables of the loop headed by `header` in `graph`.
+Returns a dictionary mapping the variables holding the induction variable, ie.
+both the phi function destination and the incremented value, to tuples of
+(phi statement, increment statement, initial value, step).
+"""
+def _find_induction_variables(code, graph, header, body):
+    variables = get_variables(code)
+    blocks = get_blocks(code)
+    ivs = {}
+    for phi in code["blocks"][blocks[header]]["code"]:
+        if phi["op"] != "phi":
+            continue
+        operands = phi_operands(graph, header, phi)
+        entering = set(operands[p] for p in operands if p not in body)
+        looping = set(operands[p] for p in operands if p in body)
+        if len(entering) != 1 or len(looping) != 1:
+            continue
+        increment = _def_statement(code, blocks, variables, looping.pop())
+        if increment is None or increment["dest"] == phi["dest"]:
+            continue
+        if variables[increment["dest"]]["def_site"]["block"] not in body:
+            continue
+        step = _constant_step(increment, phi["dest"])
+        if step is None:
+            continue
+        iv = (phi, increment, entering.pop(), step)
+        ivs[phi["dest"]] = iv
+        ivs[increment["dest"]] = iv
+    return ivs
+
+"""
+Returns a list of (statement, induction variable, k) for every statement in
+the loop multiplying an induction variable by a constant k.
+"""
+def _find_reducible_multiplications(code, graph, header, body):
+    ivs = _find_induction_variables(code, graph, header, body)
+    found = []
+    for block in [b for b in code["blocks"] if b["name"] in body]:
+        for statement in block["code"]:
+            if statement["op"] != "MUL" or "shift" in statement:
+                continue
+            for var, const in [("src1", "src2"), ("src2", "src1")]:
+                if statement[var] in ivs and is_constant_val(statement[const]):
+                    found.append((statement, ivs[statement[var]], _int(statement[const])))
+                    break
+    return found
+
+"""
+Inserts a new induction variable j' <- phi(i0 * k, j' + c * k) for the basic
+induction variable `iv`. The increment of the new variable is placed directly
+after the increment of `iv`. Returns the new phi and increment statements.
+"""
+def _new_induction_variable(code, graph, header, preheader, iv, k):
+    phi, increment, init, step = iv
+    blocks = get_blocks(code)
+    base = "SR" + phi["dest"].rsplit("-", 1)[0]
+    new_phi = {"op": "phi", "dest": new_variable(code, base)}
+    code["blocks"][blocks[header]]["code"].insert(0, new_phi)
+    new_increment = {"op": "ADD", "dest": new_variable(code, base),
+                     "src1": new_phi["dest"], "src2": "#" + str(step * k)}
+    for block in code["blocks"]:
+        for idx, statement in enumerate(block["code"]):
+            if statement is increment:
+                block["code"].insert(idx + 1, new_increment)
+                break
+    if is_constant_val(init):
+        start = "#" + str(_int(init) * k)
+    else:
+        start = new_variable(code, base)
+        code["blocks"][blocks[preheader]]["code"].append(
+            {"op": "MUL", "dest": start, "src1": init, "src2": "#" + str(k)})
+    operands = {}
+    for pred in graph.pred(header):
+        operands[pred] = start if pred == preheader else new_increment["dest"]
+    set_phi_operands(graph, header, new_phi, operands)
+    return new_phi, new_increment
+
+"""
+Linear function test replacement. If the only uses of the basic induction
+variable `iv_name` are its own increment and a single comparison against a
+constant, rewrites the comparison in terms of the induction variable derived
+from it by multiplying by `k` and deletes the basic induction variable.
+
+Only applied when k is positive and the initial value is constant, and when
+neither the initial value nor the bound overflow 32 bits once multiplied, so
+that every comparison has the same outcome.
+"""
+def _replace_test(code, header, body, iv_name, k, new_phi, new_increment):
+    graph = build_graph(code)
+    graph.set_root(code["starting_block"][0])
+    ivs = _find_induction_variables(code, graph, header, body)
+    if iv_name not in ivs or k <= 0:
+        return
+    phi, increment, init, step = ivs[iv_name]
+    if not is_constant_val(init):
+        return
+    variables = get_variables(code)
+    blocks = get_blocks(code)
+    uses = [code["blocks"][blocks[u["block"]]]["code"][u["statement"]]
+            for var in [phi["dest"], increment["dest"]]
+            for u in variables[var]["uses"]]
+    tests = [s for s in uses if s is not phi and s is not increment]
+    if len(tests) != 1 or tests[0]["op"] != "CMP":
+        return
+    test = tests[0]
+    ivs_field = [x for x in ["src1", "src2"] if test[x] in (phi["dest"], increment["dest"])]
+    bound_field = [x for x in ["src1", "src2"] if x not in ivs_field]
+    if len(ivs_field) != 1 or not is_constant_val(test[bound_field[0]]):
+        return
+    bound = _int(test[bound_field[0]])
+    if not all(INT_MIN <= v * k <= INT_MAX for v in [_int(init), bound, bound + step]):
+        return
+    ivs_field = ivs_field[0]
+    test[ivs_field] = new_phi["dest"] if test[ivs_field] == phi["dest"] else new_increment["dest"]
+    test[bound_field[0]] = "#" + str(bound * k)
+    phi["delete"] = True
+    increment["delete"] = True
+    remove_marked_statements(code)
+
+"""
+Returns the list of statements which compute `statement`, a multiplication by
+a constant, with shifts and additions. If no such rewrite is known the list
+holds only `statement`.
+"""
+def _decompose_multiplication(code, statement):
+    if statement["op"] != "MUL" or "shift" in statement:
+        return [statement]
+    if is_constant_val(statement["src2"]) and is_var(statement["src1"]):
+        var, k = statement["src1"], _int(statement["src2"])
+    elif is_constant_val(statement["src1"]) and is_var(statement["src2"]):
+        var, k = statement["src2"], _int(statement["src1"])
+    else:
+        return [statement]
+    dest = statement["dest"]
+    if k == 0:
+        return [{"op": "MOV", "dest": dest, "src1": "#0"}]
+    if k == 1:
+        return [{"op": "MOV", "dest": dest, "src1": var}]
+    if k < 0:
+        return [statement]
+    # k = m * 2^n for odd m
+    n = 0
+    while not k & 1:
+        k >>= 1
+        n += 1
+    if k == 1:
+        return [{"op": "LSL", "dest": dest, "src1": var, "src2": "#" + str(n)}]
+    odd = _shifted_sum(dest, var, k)
+    if odd is None:
+        return [statement]
+    if n == 0:
+        return [odd]
+    odd["dest"] = new_variable(code, dest)
+    return [odd, {"op": "LSL", "dest": dest, "src1": odd["dest"], "src2": "#" + str(n)}]
+
+"""
+Computes `dest` <- `var` * k in a single ADD or RSB with a shifted operand
+when k is one more or one less than a power of two. Returns None otherwise.
+"""
+def _shifted_sum(dest, var, k):
+    for op, power in [("ADD", k - 1), ("RSB", k + 1)]:
+        if power & (power - 1) == 0:
+            shift = len(bin(power)) - 3
+            return {"op": op, "dest": dest, "src1": var, "src2": var,
+                    "shift": "LSL #" + str(shift)}
+    return None
+
+"""
+Returns c if `increment` computes `var` + c or `var` - c for a constant c,
+None otherwise.
+"""
+def _constant_step(increment, var):
+    if "shift" in increment:
+        return None
+    if increment["op"] == "ADD":
+        if increment["src1"] == var and is_constant_val(increment["src2"]):
+            return _int(increment["src2"])
+        if increment["src2"] == var and is_constant_val(increment["src1"]):
+            return _int(increment["src1"])
+    if increment["op"] == "SUB":
+        if increment["src1"] == var and is_constant_val(increment["src2"]):
+            return -_int(increment["src2"])
+    return None
+
+def _def_statement(code, blocks, variables, var):
+    if not is_var(var) or "def_site" not in variables[var]:
+        return None
+    site = variables[var]["def_site"]
+    return code["blocks"][blocks[site["block"]]]["code"][site["statement"]]
+
+def _int(val):
+    return int(val[1:])
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        cfg = toSSA(code)
+        strength_reduction(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,34 @@
 from graphs import Graph
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-DEFINING_OPS = ["MOV", "ADD", "MUL", "SUB", "RSB", "LDR", "phi"]
+DEFINING_OPS = ["MOV", "MVN", "ADD", "MUL", "MLA", "SUB", "RSB", "AND", "ORR",
+                "EOR", "BIC", "LSL", "LSR", "ASR", "ROR", "LDR", "phi"]
+
+SHIFT_OPS = ["LSL", "LSR", "ASR", "ROR"]
 
 UNCONDITIONAL_BRANCHES = ["B", "BX", "BL"]
 
+CONDITION_CODES = ["EQ", "NE", "CS", "CC", "MI", "PL", "VS", "VC",
+                   "HI", "LS", "GE", "LT", "GT", "LE"]
+
+# Operations which may set the flags, given an S suffix.
+DATA_PROCESSING_OPS = ["MOV", "MVN", "ADD", "SUB", "RSB", "MUL", "MLA", "AND",
+                       "ORR", "EOR", "BIC", "LSL", "LSR", "ASR", "ROR"]
+
+# Operations which always set the flags.
+COMPARISON_OPS = ["CMP", "CMN", "TST", "TEQ"]
+
+# Every operation which may be given a condition code suffix.
+CONDITIONAL_OPS = (DATA_PROCESSING_OPS + COMPARISON_OPS +
+                   ["LDR", "STR", "B", "BL", "BX", "SWI"])
+# Longest first, so that eg. BLEQ is split as BL rather than B.
+_OPS_BY_LENGTH = sorted(CONDITIONAL_OPS, key=len, reverse=True)
+
+INVERSE_CONDITIONS = {"EQ": "NE", "NE": "EQ", "CS": "CC", "CC": "CS",
+                      "MI": "PL", "PL": "MI", "VS": "VC", "VC": "VS",
+                      "HI": "LS", "LS": "HI", "GE": "LT", "LT": "GE",
+                      "GT": "LE", "LE": "GT"}
+
 """
 Constructs the control flow graph of `code`
 """
@@ -40,13 +64,67 @@ def get_statements_in_block(block):
 Returns true if `statement` defines a variable
 """
 def defines_variable(statement):
-    return statement["op"] in DEFINING_OPS
+    return split_op(statement["op"])[0] in DEFINING_OPS
+
+"""
+Splits an ARM mnemonic into its operation, condition code and whether it sets
+the flags, eg. ("ADD", "EQ", True) for ADDEQS or ADDSEQ, and ("B", "LS", False)
+for BLS. The condition is None for unconditional operations. Mnemonics which
+are not recognised are returned whole.
+"""
+def split_op(op):
+    for base in _OPS_BY_LENGTH:
+        if not op.startswith(base):
+            continue
+        rest = op[len(base):]
+        candidates = [(rest, False)]
+        if base in DATA_PROCESSING_OPS:
+            if rest.startswith("S"):
+                candidates.append((rest[1:], True))
+            if rest.endswith("S"):
+                candidates.append((rest[:-1], True))
+        for condition, sets_flags in candidates:
+            if condition == "" or condition in CONDITION_CODES:
+                return base, condition or None, sets_flags or base in COMPARISON_OPS
+    return op, None, False
+
+"""
+Returns the condition code `statement` is executed under, or None if it is
+always executed.
+"""
+def statement_condition(statement):
+    return split_op(statement["op"])[1]
+
+"""
+Returns true if `statement` writes the flags.
+"""
+def sets_flags(statement):
+    return split_op(statement["op"])[2]
+
+"""
+Returns true if `statement` is a conditionally executed operation other than a
+branch. A predicated definition leaves its destination unchanged when not
+executed, so it also reads the destination.
+"""
+def is_predicated(statement):
+    base, condition, _ = split_op(statement["op"])
+    return condition is not None and base not in UNCONDITIONAL_BRANCHES
 
 """
 Returns true if `statement` is a conditional branch.
 """
 def is_conditional_branch(statement):
-    return statement["op"].startswith("B") and statement["op"] not in UNCONDITIONAL_BRANCHES
+    base, condition, _ = split_op(statement["op"])
+    return base == "B" and condition is not None
+
+"""
+Returns the condition code tested by `statement`, eg. "EQ" for BEQ, or None if
+it is not a conditional branch.
+"""
+def branch_condition(statement):
+    if is_conditional_branch(statement):
+        return statement["op"][1:]
+    return None
 
 """
 Returns a dictionary mapping block names to indexes in the "blocks" array of `code`.
@@ -98,6 +176,87 @@ def get_variables(code):
             variables[v]["uses"] = []
     return variables
 
+"""
+Returns the operands of the phi function `statement` in block `block` as an
+OrderedDict mapping each predecessor of the block in `graph` to the value
+flowing along the edge from that predecessor. Operand srcN of a phi function
+corresponds to the Nth predecessor returned by `graph.pred`.
+"""
+def phi_operands(graph, block, statement):
+    operands = OrderedDict()
+    for idx, pred in enumerate(graph.pred(block).keys()):
+        src = "src" + str(idx + 1)
+        if src in statement:
+            operands[pred] = statement[src]
+    return operands
+
+"""
+Rewrites the operands of the phi function `statement` in block `block` from
+`operands`, a mapping of predecessor to value as returned by `phi_operands`.
+Used after the predecessors of a block have been changed to renumber the
+operands to match the predecessor order of the new `graph`.
+"""
+def set_phi_operands(graph, block, statement, operands):
+    for src in [x for x in statement if x.startswith("src")]:
+        del statement[src]
+    for idx, pred in enumerate(graph.pred(block).keys()):
+        if pred in operands:
+            statement["src" + str(idx + 1)] = operands[pred]
+
+"""
+Renumbers the operands of every phi function in `code` after its control flow
+graph has changed. `graph` must be the control flow graph the phi functions
+were numbered against. Operands from predecessors which have been removed are
+dropped.
+"""
+def update_phis(code, graph):
+    new_graph = build_graph(code)
+    for block in code["blocks"]:
+        if block["name"] not in graph:
+            continue
+        for statement in block["code"]:
+            if statement["op"] == "phi":
+                operands = phi_operands(graph, block["name"], statement)
+                set_phi_operands(new_graph, block["name"], statement, operands)
+
+"""
+Returns a variable name of the form `name`-N not yet used anywhere in `code`,
+where `name` is the variable `var` with any SSA subscript removed.
+"""
+def new_variable(code, var):
+    name = var.rsplit("-", 1)[0] if "-" in var else var
+    highest = 0
+    for block in code["blocks"]:
+        for statement in block["code"]:
+            for field in statement:
+                if field == "dest" or field.startswith("src"):
+                    parts = statement[field].rsplit("-", 1)
+                    if parts[0] == name and len(parts) == 2 and parts[1].isdigit():
+                        highest = max(highest, int(parts[1]))
+    return name + "-" + str(highest + 1)
+
+"""
+Returns a block name starting with `name` not yet used in `code`.
+"""
+def new_block_name(code, name):
+    names = set(b["name"] for b in code["blocks"])
+    candidate = name
+    i = 1
+    while candidate in names:
+        candidate = name + str(i)
+        i += 1
+    return candidate
+
+"""
+Deletes every block of `code` which cannot be reached from the starting block,
+dropping the operands of phi functions for edges from the deleted blocks.
+"""
+def delete_unreachable_blocks(code):
+    graph = build_graph(code)
+    reachable = graph.reachable(code["starting_block"][0])
+    code["blocks"][:] = [b for b in code["blocks"] if b["name"] in reachable]
+    update_phis(code, graph)
+
 """
 Modifies `code` in place to delete statement. Can throw KeyError if code passed
 is not well formed.
@@ -134,10 +293,11 @@ def is_var(val):
     return not is_constant_val(val)
 
 """
-True if statement is a copy operation, ie. statement["op"] == "MOV.
+True if statement is a copy operation, ie. statement["op"] == "MOV" with no
+shift applied to its operand.
 """
 def is_copy(statement):
-    return statement["op"] == "MOV"
+    return statement["op"] == "MOV" and "shift" not in statement
 
 """
 Returns true if a statement is a Phi function and all operands of the phi
@@ -150,42 +310,216 @@ def is_constant_phi(statement):
 
 """
 Performs constant folding in place. For an operation to be successfully folded
-three predicates must be true:
+two predicates must be true:
 
     * All src parameters for the statement must be constant values.
     * statement["op"] must be in FOLDABLE_OPS
-    * statement["op"] must have a case in `_do_op`
 
 If any of these predicates are false calling _fold_constant(statement) will have
 no effect on `statement`.
 """
 def _fold_constant(statement):
+    srcs = sorted(x for x in statement if x.startswith("src"))
+    if not len(srcs) or not all(is_constant_val(statement[x]) for x in srcs):
+        return
     try:
-        val1 = int(statement["src1"][1:])
-        val2 = int(statement["src2"][1:])
+        vals = [_constant(statement[x]) for x in srcs]
+        if "shift" in statement:
+            vals[-1] = _do_shift(statement["shift"], vals[-1])
     except ValueError:
+        # Not a literal, or the shift amount is held in a register.
         return
-    const = _do_op(statement["op"], val1, val2)
+    const = _do_op(statement["op"], *vals)
     if const is not None:
-        statement["op"] = "MOV"
-        statement["src1"] = "#" + str(const)
-        del statement["src2"]
+        _replace_with_copy(statement, "#" + str(const))
+
+"""
+Simplifies `statement` in place where one of its operands makes the result
+independent of the other, eg.
+
+    ADD R0, R1, #0  --->  MOV R0, R1
+    MUL R0, R1, #0  --->  MOV R0, #0
+    SUB R0, R1, R1  --->  MOV R0, #0
+
+Statements with a shifted operand are left unchanged.
+"""
+def _apply_identities(statement):
+    if statement["op"] not in IDENTITIES or "shift" in statement:
+        return
+    srcs = sorted(x for x in statement if x.startswith("src"))
+    vals = [statement[x] for x in srcs]
+    try:
+        consts = [_wrap(_constant(v)) if is_constant_val(v) else None for v in vals]
+    except ValueError:
+        return
+    for rule in IDENTITIES[statement["op"]]:
+        result = rule(vals, consts)
+        if result is not None:
+            _replace_with_copy(statement, result)
+            return
+
+def _replace_with_copy(statement, val):
+    for field in [x for x in statement if x.startswith("src") or x == "shift"]:
+        del statement[field]
+    statement["op"] = "MOV"
+    statement["src1"] = val
+
+"""
+Converts `val` to a signed 32-bit int, as held in an ARM7 register.
+"""
+def _wrap(val):
+    val &= 0xFFFFFFFF
+    return val - (1 << 32) if val & 0x80000000 else val
+
+"""
+Returns the int value of the constant literal `val`, eg. "#12" or "#0xC".
+
+Throws ValueError if `val` is not a valid literal.
+"""
+def _constant(val):
+    if not is_constant_val(val):
+        raise ValueError(val)
+    val = val[1:]
+    if val.lstrip("-").lower().startswith("0x"):
+        return int(val, 16)
+    return int(val)
+
+"""
+Table used by constant folding, instructing the optimizer how to fold an
+operation correctly. Each entry takes the values of the src operands in order,
+with any shift already applied to the last of them.
+"""
+OPERATIONS = {
+    "MOV": lambda a: a,
+    "MVN": lambda a: ~a,
+    "ADD": lambda a, b: a + b,
+    "SUB": lambda a, b: a - b,
+    "RSB": lambda a, b: b - a,
+    "MUL": lambda a, b: a * b,
+    "MLA": lambda a, b, c: a * b + c,
+    "AND": lambda a, b: a & b,
+    "ORR": lambda a, b: a | b,
+    "EOR": lambda a, b: a ^ b,
+    "BIC": lambda a, b: a & ~b,
+    "LSL": lambda a, b: _shift("LSL", a, b),
+    "LSR": lambda a, b: _shift("LSR", a, b),
+    "ASR": lambda a, b: _shift("ASR", a, b),
+    "ROR": lambda a, b: _shift("ROR", a, b),
+}
+
+FOLDABLE_OPS = sorted(OPERATIONS)
 
+_same = lambda vals, consts: vals[0] == vals[1]
+
+"""
+Algebraic identities used by `_apply_identities`. Each rule takes the src
+operands and their int values, None for variables, and returns the value the
+statement copies, or None if the rule does not apply.
 """
-Switch statement used by constant folding optimization, instructing the
-optimizer how to fold an operation correctly.
+IDENTITIES = {
+    "ADD": [lambda v, c: v[0] if c[1] == 0 else None,
+            lambda v, c: v[1] if c[0] == 0 else None],
+    "SUB": [lambda v, c: v[0] if c[1] == 0 else None,
+            lambda v, c: "#0" if _same(v, c) else None],
+    "RSB": [lambda v, c: v[1] if c[0] == 0 else None,
+            lambda v, c: "#0" if _same(v, c) else None],
+    "MUL": [lambda v, c: "#0" if 0 in c else None,
+            lambda v, c: v[0] if c[1] == 1 else None,
+            lambda v, c: v[1] if c[0] == 1 else None],
+    "MLA": [lambda v, c: v[2] if c[0] == 0 or c[1] == 0 else None],
+    "AND": [lambda v, c: "#0" if 0 in c else None,
+            lambda v, c: v[0] if c[1] == -1 or _same(v, c) else None,
+            lambda v, c: v[1] if c[0] == -1 else None],
+    "ORR": [lambda v, c: v[0] if c[1] == 0 or _same(v, c) else None,
+            lambda v, c: v[1] if c[0] == 0 else None],
+    "EOR": [lambda v, c: v[0] if c[1] == 0 else None,
+            lambda v, c: v[1] if c[0] == 0 else None,
+            lambda v, c: "#0" if _same(v, c) else None],
+    "BIC": [lambda v, c: v[0] if c[1] == 0 else None,
+            lambda v, c: "#0" if c[0] == 0 or _same(v, c) else None],
+    "LSL": [lambda v, c: v[0] if c[1] == 0 else None],
+    "LSR": [lambda v, c: v[0] if c[1] == 0 else None],
+    "ASR": [lambda v, c: v[0] if c[1] == 0 else None],
+    "ROR": [lambda v, c: v[0] if c[1] == 0 else None],
+}
 
-Parameter `op` should be statement["op"] from the code, and all arguments
-in `vals` should be of type int.
+"""
+Computes `op` applied to the int arguments `vals` with the 32-bit two's
+complement arithmetic of the ARM7. Returns None if `op` cannot be folded.
 
 Throws TypeError if all vals are not ints.
 """
 def _do_op(op, *vals):
-    if not all(isinstance(val, int) for val in vals):
+    if not all(isinstance(val, (int, long)) for val in vals):
         raise TypeError
-    return {
-        "MUL": vals[0] * vals[1],
-        "SUB": vals[0] - vals[1],
-        "RSB": vals[1] - vals[0],
-        "ADD": vals[0] + vals[1]
-    }.get(op, None)
+    if op not in OPERATIONS:
+        return None
+    return _wrap(OPERATIONS[op](*[_wrap(val) for val in vals]))
+
+"""
+Applies the barrel shifter operation `shift`, eg. "LSL #2", to the int `val`
+as the ARM7 would to the second operand of a data processing instruction.
+Shifts operate on the 32-bit two's complement representation of `val` and the
+result is returned as a signed 32-bit int.
+
+Throws ValueError if the shift amount is not a constant literal.
+"""
+def _do_shift(shift, val):
+    kind, amount = shift.split()
+    return _shift(kind, val, _constant(amount))
+
+"""
+Shifts `val` by `amount` places. As when the amount is taken from a register,
+only the bottom byte of `amount` is used, and logical shifts of 32 places or
+more give 0.
+"""
+def _shift(kind, val, amount):
+    amount &= 0xFF
+    val &= 0xFFFFFFFF
+    if kind == "LSL":
+        val = val << amount if amount < 32 else 0
+    elif kind == "LSR":
+        val = val >> amount if amount < 32 else 0
+    elif kind == "ASR":
+        val = _wrap(val) >> min(amount, 31)
+    elif kind == "ROR":
+        amount %= 32
+        val = (val >> amount) | (val << (32 - amount))
+    return _wrap(val)
+
+"""
+Returns the condition flags set by CMP `val1`, `val2` as a dictionary mapping
+"N", "Z", "C" and "V" to bools.
+"""
+def compare_flags(val1, val2):
+    a = val1 & 0xFFFFFFFF
+    b = val2 & 0xFFFFFFFF
+    result = _wrap(a - b)
+    return {"N": result < 0,
+            "Z": result == 0,
+            "C": a >= b,
+            "V": _wrap(val1) - _wrap(val2) != result}
+
+CONDITIONS = {
+    "EQ": lambda f: f["Z"],
+    "NE": lambda f: not f["Z"],
+    "CS": lambda f: f["C"],
+    "CC": lambda f: not f["C"],
+    "MI": lambda f: f["N"],
+    "PL": lambda f: not f["N"],
+    "VS": lambda f: f["V"],
+    "VC": lambda f: not f["V"],
+    "HI": lambda f: f["C"] and not f["Z"],
+    "LS": lambda f: not f["C"] or f["Z"],
+    "GE": lambda f: f["N"] == f["V"],
+    "LT": lambda f: f["N"] != f["V"],
+    "GT": lambda f: not f["Z"] and f["N"] == f["V"],
+    "LE": lambda f: f["Z"] or f["N"] != f["V"],
+}
+
+"""
+True if the condition code `condition`, eg. "LT", holds for `flags` as
+returned by `compare_flags`.
+"""
+def evaluate_condition(condition, flags):
+    return CONDITIONS[condition](flags)
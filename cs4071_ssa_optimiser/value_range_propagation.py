@@ -0,0 +1,473 @@
+import json
+from ssa import toSSA
+from dataflow import reverse_postorder
+from jump_threading import _reads_flags_on_entry
+from util import (build_graph,
+                  branch_condition,
+                  is_constant_val,
+                  is_var,
+                  phi_operands,
+                  split_op,
+                  update_phis,
+                  delete_unreachable_blocks,
+                  INVERSE_CONDITIONS,
+                  OPERATIONS,
+                  _constant,
+                  _do_op,
+                  _shift,
+                  _wrap)
+
+INT_MIN = -(1 << 31)
+INT_MAX = (1 << 31) - 1
+FULL = (INT_MIN, INT_MAX)
+
+# Number of times a phi function at a loop header may grow before its range is
+# widened to the limits of a 32-bit int, so that the analysis of a loop
+# finishes however many times the loop runs.
+WIDENING_DELAY = 2
+# Number of passes over the function recomputing every range from the ranges
+# found, taking back some of what was lost by widening.
+NARROWING_ROUNDS = 2
+
+# The signed conditions ranges are narrowed and decided by, mapped to the
+# condition holding with the operands of the comparison swapped.
+SWAPPED_CONDITIONS = {"EQ": "EQ", "NE": "NE", "LT": "GT", "LE": "GE", "GT": "LT", "GE": "LE"}
+
+"""
+Value range propagation over code in SSA form.
+
+Transforms `code` in place. Finds an interval [lo, hi] holding every value each
+variable may take, as signed 32-bit ints, and deletes the conditional branches
+decided by them:
+
+    b1: R1-1 <- phi(#0, R1-2)          b1: R1-1 <- phi(#0, R1-2)
+        CMP R1-1, #10                      CMP R1-1, #10
+        BGE b4                             BGE b4
+    b2: CMP R1-1, #0           --->    b2: R1-2 <- ADD R1-1, #1
+        BLT b5                             B b1
+    b3: R1-2 <- ADD R1-1, #1
+        B b1
+
+The analysis is sparse, like conditional constant propagation: a statement is
+only evaluated again when the range of one of its operands grows, and only
+along edges found to be executable. A phi function at a loop header which keeps
+growing is widened to the limits of an int after WIDENING_DELAY changes, and
+the ranges are then recomputed NARROWING_ROUNDS times without widening.
+
+A comparison followed by a conditional branch narrows the ranges of its
+operands along each edge out of its block, according to the condition tested
+on that edge, eg. R1-1 is in [0, 9] on the edge from b1 to b2 above. The
+narrowed range is used for phi operands flowing along the edge, and for uses
+in blocks only entered along it. Only the signed conditions EQ, NE, LT, LE, GT
+and GE are understood.
+
+A branch always or never taken is deleted along with the successor it no
+longer leads to, and the comparison with it unless something else reads the
+flags. Blocks which can then no longer be reached are deleted.
+"""
+def value_range_propagation(code):
+    analysis = _RangeAnalysis(code)
+    analysis.solve()
+    graph = analysis.graph
+    folded = False
+    for block in code["blocks"]:
+        if block["name"] not in analysis.reached or block["name"] not in analysis.tests:
+            continue
+        taken = analysis.decide(block["name"])
+        if taken is not None:
+            _fold_branch(code, block, analysis.tests[block["name"]], taken)
+            folded = True
+    if folded:
+        update_phis(code, graph)
+        delete_unreachable_blocks(code)
+
+"""
+The ranges of the variables of a function in SSA form, and the blocks and
+edges which may be executed.
+"""
+class _RangeAnalysis(object):
+    def __init__(self, code):
+        self.code = code
+        self.graph = build_graph(code)
+        self.graph.set_root(code["starting_block"][0])
+        self.order = reverse_postorder(self.graph)
+        position = dict((name, idx) for idx, name in enumerate(self.order))
+        # Loop headers are the targets of edges leading back in reverse
+        # postorder, which covers the headers of irreducible loops as well as
+        # of natural loops.
+        self.headers = set(succ for name in self.graph for succ in self.graph[name]
+                           if position[succ] <= position[name])
+        self.blocks = dict((b["name"], b) for b in code["blocks"])
+        self.ranges = {}
+        self.changes = {}
+        self.edges = set()
+        self.reached = set()
+        self.defined = set()
+        self.uses = {}
+        # Comparisons of two variables, so that a use of one is evaluated
+        # again when the range of the other narrowing it grows.
+        self.partners = {}
+        self.tests = {}
+        self.guards = {}
+        for block in code["blocks"]:
+            for statement in block["code"]:
+                if "dest" in statement and is_var(statement["dest"]):
+                    self.defined.add(statement["dest"])
+                for var in _operands(statement):
+                    self.uses.setdefault(var, []).append((block["name"], statement))
+            test = _test(block)
+            if test is not None:
+                self.tests[block["name"]] = test
+                self._add_guards(block, *test)
+
+    """
+    Records the ranges each edge out of `block`, ending in the comparison
+    `compare` and a branch testing `condition`, narrows. Only edges to a block
+    with no other predecessor narrow the ranges of uses in the blocks they
+    lead to, as only those blocks are always entered along the edge.
+    """
+    def _add_guards(self, block, compare, condition):
+        src1, src2 = compare["src1"], compare["src2"]
+        if is_var(src1) and is_var(src2) and "shift" not in compare:
+            self.partners.setdefault(src1, set()).add(src2)
+            self.partners.setdefault(src2, set()).add(src1)
+        for idx, succ in enumerate(block["next_block"]):
+            if len(self.graph.pred(succ)) != 1 or succ == block["name"]:
+                continue
+            holds = condition if idx == 0 else INVERSE_CONDITIONS[condition]
+            if is_var(src1):
+                self.guards.setdefault(src1, []).append((succ, holds, src2, compare.get("shift")))
+            if is_var(src2) and "shift" not in compare:
+                self.guards.setdefault(src2, []).append((succ, SWAPPED_CONDITIONS[holds], src1, None))
+
+    """
+    Finds the ranges of the variables, then narrows them.
+    """
+    def solve(self):
+        flow = [(None, self.graph.root)]
+        ssa = []
+        while len(flow) or len(ssa):
+            if len(flow):
+                pred, name = flow.pop()
+                if (pred, name) in self.edges:
+                    continue
+                self.edges.add((pred, name))
+                block = self.blocks[name]
+                if name in self.reached:
+                    statements = [s for s in block["code"] if s["op"] == "phi"]
+                else:
+                    self.reached.add(name)
+                    statements = block["code"]
+                    if name not in self.tests:
+                        flow.extend((name, succ) for succ in block["next_block"])
+                for statement in statements:
+                    self._visit(name, statement, flow, ssa)
+            else:
+                name, statement = ssa.pop()
+                if name in self.reached:
+                    self._visit(name, statement, flow, ssa)
+
+        for _ in range(NARROWING_ROUNDS):
+            for name in self.order:
+                if name not in self.reached:
+                    continue
+                for statement in self.blocks[name]["code"]:
+                    if "dest" in statement and is_var(statement["dest"]):
+                        value = self._evaluate(name, statement)
+                        if value is not None:
+                            self.ranges[statement["dest"]] = value
+
+    def _visit(self, name, statement, flow, ssa):
+        if self.tests.get(name, (None,))[0] is statement:
+            taken = self.decide(name)
+            successors = self.blocks[name]["next_block"]
+            if taken is None:
+                flow.extend((name, succ) for succ in successors)
+            else:
+                flow.append((name, successors[0 if taken else 1]))
+        if not ("dest" in statement and is_var(statement["dest"])):
+            return
+        value = self._evaluate(name, statement)
+        if value is None:
+            return
+        dest = statement["dest"]
+        old = self.ranges.get(dest)
+        if old is not None:
+            value = _hull(old, value)
+            if value == old:
+                return
+            if statement["op"] == "phi" and name in self.headers:
+                self.changes[dest] = self.changes.get(dest, 0) + 1
+                if self.changes[dest] > WIDENING_DELAY:
+                    value = (old[0] if value[0] >= old[0] else INT_MIN,
+                             old[1] if value[1] <= old[1] else INT_MAX)
+        self.ranges[dest] = value
+        ssa.extend(self.uses.get(dest, []))
+        for partner in self.partners.get(dest, ()):
+            ssa.extend(self.uses.get(partner, []))
+
+    """
+    Returns the range of the value `statement` in block `name` assigns, or
+    None if it is not yet known to be executed.
+    """
+    def _evaluate(self, name, statement):
+        if statement["op"] == "phi":
+            value = None
+            for pred, val in phi_operands(self.graph, name, statement).iteritems():
+                if (pred, name) in self.edges:
+                    operand = self._edge_range(val, pred, name)
+                    if operand is not None:
+                        value = operand if value is None else _hull(value, operand)
+            return value
+
+        base, condition, _ = split_op(statement["op"])
+        if condition is not None or base not in OPERATIONS:
+            # A predicated statement may leave the old value, and loads and
+            # calls give any value.
+            return FULL
+        vals = [self.range_at(statement[x], name)
+                for x in sorted(x for x in statement if x.startswith("src"))]
+        if None in vals:
+            return None
+        if "shift" in statement:
+            vals[-1] = self._shifted(vals[-1], statement["shift"], name)
+            if vals[-1] is None:
+                return None
+        if all(lo == hi for lo, hi in vals):
+            value = _do_op(base, *[lo for lo, _ in vals])
+            return (value, value)
+        if base in _TRANSFER:
+            return _TRANSFER[base](*vals)
+        return FULL
+
+    """
+    Returns the range of `val` in block `name`, narrowed by the branches on the
+    way there, or None if it is not yet known to be assigned.
+    """
+    def range_at(self, val, name):
+        value = self._range(val)
+        for succ, condition, other, shift in self.guards.get(val, ()):
+            if value is None:
+                break
+            if self.graph.dom(succ, name):
+                value = self._narrowed(value, condition, other, shift, name)
+        return value
+
+    """
+    Returns the range of `val` flowing along the edge from `pred` to `succ`.
+    """
+    def _edge_range(self, val, pred, succ):
+        value = self.range_at(val, pred)
+        test = self.tests.get(pred)
+        successors = self.blocks[pred]["next_block"]
+        if value is None or test is None or successors.count(succ) != 1:
+            return value
+        compare, condition = test
+        if successors.index(succ) == 1:
+            condition = INVERSE_CONDITIONS[condition]
+        if compare["src1"] == val:
+            value = self._narrowed(value, condition, compare["src2"], compare.get("shift"), pred)
+        if value is not None and compare["src2"] == val and "shift" not in compare:
+            value = self._narrowed(value, SWAPPED_CONDITIONS[condition], compare["src1"], None, pred)
+        return value
+
+    """
+    Returns `value` narrowed to the values for which `condition` holds
+    compared with `other`, shifted by `shift`, or None if there are none. The
+    range of `other` is not itself narrowed, so that narrowing two variables
+    by each other does not recurse forever.
+    """
+    def _narrowed(self, value, condition, other, shift, name):
+        other = self._range(other)
+        if other is not None and shift is not None:
+            other = self._shifted(other, shift, name)
+        if other is None:
+            return value
+        return _narrow(value, condition, other)
+
+    """
+    Returns true if the branch ending block `name` is always taken, false if
+    it is never taken, and None if it may go either way.
+    """
+    def decide(self, name):
+        compare, condition = self.tests[name]
+        val1 = self.range_at(compare["src1"], name)
+        val2 = self.range_at(compare["src2"], name)
+        if val2 is not None and "shift" in compare:
+            val2 = self._shifted(val2, compare["shift"], name)
+        if val1 is None or val2 is None:
+            return None
+        if _narrow(val1, condition, val2) is None:
+            return False
+        if _narrow(val1, INVERSE_CONDITIONS[condition], val2) is None:
+            return True
+        return None
+
+    def _range(self, val):
+        if is_constant_val(val):
+            try:
+                value = _wrap(_constant(val))
+            except ValueError:
+                return FULL
+            return (value, value)
+        if val not in self.defined:
+            # Registers read before they are assigned hold the arguments.
+            return FULL
+        return self.ranges.get(val)
+
+    def _shifted(self, value, shift, name):
+        kind, amount = shift.split()
+        amount = self.range_at(amount, name)
+        if amount is None:
+            return None
+        if amount[0] != amount[1]:
+            return FULL
+        return _shift_range(kind, value, amount[0])
+
+"""
+Returns the comparison and the condition tested by the conditional branch
+ending `block`, if the branch reads the flags set by the comparison and it
+leads to one of two different successors, otherwise None.
+"""
+def _test(block):
+    successors = block["next_block"]
+    if len(successors) != 2 or successors[0] == successors[1]:
+        return None
+    statements = list(block["code"])
+    while len(statements) and statements[-1]["op"] == "B":
+        statements.pop()
+    if not len(statements) or branch_condition(statements[-1]) not in SWAPPED_CONDITIONS:
+        return None
+    for statement in reversed(statements[:-1]):
+        base, condition, sets_flags = split_op(statement["op"])
+        if sets_flags:
+            if statement["op"] == "CMP" and "src1" in statement and "src2" in statement:
+                return statement, branch_condition(statements[-1])
+            return None
+    return None
+
+"""
+Deletes the conditional branch ending `block`, which is always `taken` or
+never, and the successor it does not lead to. The comparison is also deleted
+unless the flags it sets may be read by other statements.
+"""
+def _fold_branch(code, block, test, taken):
+    compare, _ = test
+    branch = [s for s in block["code"] if branch_condition(s)][-1]
+    block["code"] = [s for s in block["code"] if s is not branch]
+    block["next_block"] = [block["next_block"][0 if taken else 1]]
+    following = block["code"][[i for i, s in enumerate(block["code"]) if s is compare][0] + 1:]
+    successor = [b for b in code["blocks"] if b["name"] == block["next_block"][0]][0]
+    if (not any(split_op(s["op"])[1] is not None for s in following) and
+            not _reads_flags_on_entry(successor)):
+        block["code"] = [s for s in block["code"] if s is not compare]
+
+def _operands(statement):
+    operands = [statement[x] for x in statement if x.startswith("src") and is_var(statement[x])]
+    if "shift" in statement and is_var(statement["shift"].split()[1]):
+        operands.append(statement["shift"].split()[1])
+    return operands
+
+"""
+Returns the smallest range containing the ranges `a` and `b`.
+"""
+def _hull(a, b):
+    return (min(a[0], b[0]), max(a[1], b[1]))
+
+"""
+Returns the range of values in `value` for which `condition` holds when
+compared with a value in `other`, or None if there are none.
+"""
+def _narrow(value, condition, other):
+    lo, hi = value
+    if condition == "LT":
+        hi = min(hi, other[1] - 1)
+    elif condition == "LE":
+        hi = min(hi, other[1])
+    elif condition == "GT":
+        lo = max(lo, other[0] + 1)
+    elif condition == "GE":
+        lo = max(lo, other[0])
+    elif condition == "EQ":
+        lo, hi = max(lo, other[0]), min(hi, other[1])
+    elif condition == "NE" and other[0] == other[1]:
+        if lo == other[0]:
+            lo += 1
+        if hi == other[0]:
+            hi -= 1
+    if lo > hi:
+        return None
+    return (lo, hi)
+
+"""
+Returns the range `lo` to `hi`, or FULL if it does not fit in an int, as the
+operation computing it may have overflowed.
+"""
+def _bounded(lo, hi):
+    if lo < INT_MIN or hi > INT_MAX:
+        return FULL
+    return (lo, hi)
+
+def _multiply(a, b):
+    products = [x * y for x in a for y in b]
+    return _bounded(min(products), max(products))
+
+def _and(a, b):
+    # Masking with a non-negative value gives a value between 0 and it.
+    limits = [r[1] for r in (a, b) if r[0] >= 0]
+    if not len(limits):
+        return FULL
+    return (0, min(limits))
+
+"""
+Returns the range of the values in `value` shifted by the barrel shifter
+operation `kind` by `amount` places, as `_shift` shifts a single value.
+"""
+def _shift_range(kind, value, amount):
+    lo, hi = value
+    if lo == hi:
+        result = _shift(kind, lo, amount)
+        return (result, result)
+    amount &= 0xFF
+    if amount == 0:
+        return value
+    if kind == "LSL" and amount < 32:
+        return _bounded(lo << amount, hi << amount)
+    if kind == "ASR":
+        return (lo >> min(amount, 31), hi >> min(amount, 31))
+    if kind == "LSR":
+        if amount >= 32:
+            return (0, 0)
+        if lo >= 0:
+            return (lo >> amount, hi >> amount)
+        return (0, 0xFFFFFFFF >> amount)
+    return FULL
+
+# The range of the result of each operation given the ranges of its operands,
+# with any shift already applied to the last, for operations whose operands
+# are not all constants.
+_TRANSFER = {
+    "MOV": lambda a: a,
+    "MVN": lambda a: (~a[1], ~a[0]),
+    "ADD": lambda a, b: _bounded(a[0] + b[0], a[1] + b[1]),
+    "SUB": lambda a, b: _bounded(a[0] - b[1], a[1] - b[0]),
+    "RSB": lambda a, b: _bounded(b[0] - a[1], b[1] - a[0]),
+    "MUL": _multiply,
+    "MLA": lambda a, b, c: _TRANSFER["ADD"](_multiply(a, b), c),
+    "AND": _and,
+    "BIC": lambda a, b: (0, a[1]) if a[0] >= 0 else FULL,
+    "LSL": lambda a, b: _shift_range("LSL", a, b[0]) if b[0] == b[1] else FULL,
+    "LSR": lambda a, b: _shift_range("LSR", a, b[0]) if b[0] == b[1] else FULL,
+    "ASR": lambda a, b: _shift_range("ASR", a, b[0]) if b[0] == b[1] else FULL,
+}
+
+
+def main():
+    with open('example.json') as input_code:
+        code = json.loads(input_code.read())
+        toSSA(code)
+        value_range_propagation(code)
+        print json.dumps(code, indent=4)
+
+if __name__ == "__main__":
+    main()